@@ -14,6 +14,10 @@ __version__ = '1.6.2'
 
 from .core import Social
 from .datastore import SQLAlchemyConnectionDatastore, \
-     MongoEngineConnectionDatastore, PeeweeConnectionDatastore
+     MongoEngineConnectionDatastore, PeeweeConnectionDatastore, \
+     ConnectionRecord, SQLAlchemyProviderDatastore, \
+     MongoEngineProviderDatastore, PeeweeProviderDatastore, \
+     SQLAlchemySocialEdgeDatastore, MongoEngineSocialEdgeDatastore, \
+     PeeweeSocialEdgeDatastore
 from .signals import connection_created, connection_failed, login_failed, \
-     connection_removed, login_completed
+     connection_removed, login_completed, publish_completed
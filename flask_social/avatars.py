@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.avatars
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the on-disk cache of connection avatars served by
+    the avatar endpoint
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+try:
+    from httplib import HTTPConnection, HTTPSConnection
+    from urllib2 import (HTTPDefaultErrorHandler, HTTPErrorProcessor,
+                         HTTPHandler, HTTPRedirectHandler, HTTPSHandler,
+                         OpenerDirector)
+    from urlparse import urlparse
+except ImportError:
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlparse
+    from urllib.request import (HTTPDefaultErrorHandler, HTTPErrorProcessor,
+                                HTTPHandler, HTTPRedirectHandler,
+                                HTTPSHandler, OpenerDirector)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Loopback, private, link local, shared and reserved IPv4 networks
+_PRIVATE_NETWORKS = [
+    (struct.unpack('!I', socket.inet_aton(network))[0],
+     (0xffffffff << (32 - bits)) & 0xffffffff)
+    for network, bits in (('0.0.0.0', 8), ('10.0.0.0', 8),
+                          ('100.64.0.0', 10), ('127.0.0.0', 8),
+                          ('169.254.0.0', 16), ('172.16.0.0', 12),
+                          ('192.168.0.0', 16), ('224.0.0.0', 3))]
+
+
+def _is_public(address):
+    address = address.split('%')[0]
+    try:
+        packed = bytearray(socket.inet_pton(socket.AF_INET6, address))
+    except (socket.error, ValueError):
+        packed = None
+    if packed is not None:
+        if packed[:12] != bytearray(10) + bytearray(b'\xff\xff'):
+            # Loopback, unspecified, unique local, link local and multicast
+            return not (packed[:15] == bytearray(15) and packed[15] <= 1 or
+                        packed[0] & 0xfe == 0xfc or
+                        packed[0] == 0xfe and packed[1] & 0xc0 == 0x80 or
+                        packed[0] == 0xff)
+        address = socket.inet_ntoa(bytes(packed[12:]))
+    value = struct.unpack('!I', socket.inet_aton(address))[0]
+    return not any(value & mask == network
+                   for network, mask in _PRIVATE_NETWORKS)
+
+
+def _check_peer(connection):
+    address = connection.sock.getpeername()[0]
+    if not _is_public(address):
+        connection.close()
+        raise ValueError('%s is not a public address' % address)
+
+
+class _PublicHTTPConnection(HTTPConnection):
+
+    def connect(self):
+        HTTPConnection.connect(self)
+        _check_peer(self)
+
+
+class _PublicHTTPSConnection(HTTPSConnection):
+
+    def connect(self):
+        HTTPSConnection.connect(self)
+        _check_peer(self)
+
+
+class _PublicHTTPHandler(HTTPHandler):
+
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(HTTPSHandler):
+
+    def https_open(self, req):
+        kwargs = {}
+        if getattr(self, '_context', None) is not None:
+            kwargs['context'] = self._context
+        return self.do_open(_PublicHTTPSConnection, req, **kwargs)
+
+
+# Only HTTP and HTTPS, without proxies, and every redirect is connected to
+# through the same checks
+_opener = OpenerDirector()
+for _handler in (_PublicHTTPHandler(), _PublicHTTPSHandler(),
+                 HTTPRedirectHandler(), HTTPDefaultErrorHandler(),
+                 HTTPErrorProcessor()):
+    _opener.add_handler(_handler)
+
+
+def urlopen(url, timeout):
+    """Opens an HTTP or HTTPS URL, refusing to connect to, or be redirected
+    to, anything but a public address"""
+    if urlparse(url).scheme not in ('http', 'https'):
+        raise ValueError('%s is not an HTTP URL' % url)
+    return _opener.open(url, timeout=timeout)
+
+
+class Avatar(object):
+    """A cached avatar.
+
+    :param path: The path of the image file
+    :param etag: The strong ETag of the image, a hash of its bytes
+    :param mimetype: The content type the image was served with
+    """
+
+    def __init__(self, path, etag, mimetype):
+        self.path = path
+        self.etag = etag
+        self.mimetype = mimetype
+
+
+class AvatarCache(object):
+    """Keeps avatar images on disk, keyed by a hash of their URL, and evicts
+    the least recently served images once they take more than `max_size`
+    bytes. Missing images are fetched by a small pool of threads, and an
+    image requested again while it is being fetched is not fetched twice.
+    Redirects, such as those of Facebook's picture URLs, are followed. Only
+    HTTP and HTTPS URLs of public addresses are fetched.
+
+    The directory may be shared by every worker process on a host. Images
+    are looked up on disk, so an image fetched by one worker is served by
+    the others, and the size of the cache is counted from the directory
+    whenever an image is added, while holding a lock on the directory.
+
+    :param path: The directory holding the images
+    :param max_size: The maximum number of bytes of images kept
+    :param max_image_size: The maximum size of a single image in bytes.
+                           Larger images are not cached
+    :param workers: The number of threads fetching images
+    :param timeout: The timeout of each fetch in seconds
+    """
+
+    def __init__(self, path, max_size=50 * 1024 * 1024,
+                 max_image_size=1024 * 1024, workers=2, timeout=10):
+        self.path = path
+        self.max_size = max_size
+        self.max_image_size = max_image_size
+        self.workers = workers
+        self.timeout = timeout
+        self.fetched = 0
+        self.failed = 0
+        self.evicted = 0
+        self._images = 0
+        self._size = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._evict()
+
+    def key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key)
+
+    def _touch(self, filename):
+        # Explicit times, as file timestamps are only as fine as the kernel
+        # clock tick
+        now = time.time()
+        os.utime(filename, (now, now))
+
+    def get(self, url):
+        """Returns the cached :class:`Avatar` for `url`, or `None`"""
+        filename = self._filename(self.key(url))
+        try:
+            with open(filename + '.json') as f:
+                meta = json.load(f)
+            self._touch(filename)
+        except (IOError, OSError, ValueError):
+            return None
+        return Avatar(filename, meta['etag'], meta['mimetype'])
+
+    def fill(self, url):
+        """Fetches `url` into the cache in the background unless it is
+        already being fetched. Returns the :class:`threading.Event` set once
+        the fetch is over."""
+        with self._lock:
+            done = self._pending.get(url)
+            if done is not None:
+                return done
+            done = self._pending[url] = threading.Event()
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+        self._pool.apply_async(self._fetch, (url, done))
+        return done
+
+    def _fetch(self, url, done):
+        try:
+            self.put(url, *self._download(url))
+        except Exception:
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self._pending.pop(url, None)
+            done.set()
+
+    def _download(self, url):
+        response = urlopen(url, timeout=self.timeout)
+        try:
+            mimetype = response.info().get('Content-Type', '')
+            data = response.read(self.max_image_size + 1)
+        finally:
+            response.close()
+        if not mimetype.startswith('image/'):
+            raise ValueError('%s is not an image' % url)
+        if len(data) > self.max_image_size:
+            raise ValueError('%s is larger than %d bytes' % (
+                url, self.max_image_size))
+        return data, mimetype.split(';')[0]
+
+    def put(self, url, data, mimetype):
+        """Stores the image `data` fetched from `url`"""
+        filename = self._filename(self.key(url))
+        meta = dict(etag=hashlib.sha1(data).hexdigest(), mimetype=mimetype,
+                    url=url)
+        # The image is moved into place before its metadata, so an image is
+        # never served without its whole file
+        for target, content in ((filename, data),
+                                (filename + '.json', json.dumps(meta))):
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content if isinstance(content, bytes)
+                        else content.encode('utf-8'))
+            os.rename(tmp, target)
+        self._touch(filename)
+        with self._lock:
+            self.fetched += 1
+        self._evict()
+
+    @contextmanager
+    def _directory_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.path, '.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _scan(self):
+        # Images by serving time, which is their modification time
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-5]
+            try:
+                stat = os.stat(self._filename(key))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, key, stat.st_size))
+        return sorted(entries)
+
+    def _evict(self):
+        with self._directory_lock():
+            entries = self._scan()
+            size = sum(entry[2] for entry in entries)
+            evicted = 0
+            for mtime, key, image_size in entries:
+                if size <= self.max_size:
+                    break
+                for filename in (self._filename(key) + '.json',
+                                 self._filename(key)):
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass
+                size -= image_size
+                evicted += 1
+        with self._lock:
+            self._images = len(entries) - evicted
+            self._size = size
+            self.evicted += evicted
+
+    def stats(self):
+        """Returns a snapshot of the cache's counters. The number of images
+        and their size are those counted when an image was last added."""
+        with self._lock:
+            return dict(images=self._images, size=self._size,
+                        fetched=self.fetched, failed=self.failed,
+                        evicted=self.evicted, pending=len(self._pending))
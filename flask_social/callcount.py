@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.callcount
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the per request datastore call counter used to find
+    views querying the datastore in loops
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, request
+
+from .datastore import INSTRUMENTED_METHODS, instrument
+
+
+def _module_path(filename):
+    return os.path.splitext(os.path.abspath(filename))[0]
+
+
+# Frames in these modules are skipped when looking for the call site
+_INTERNAL = frozenset(_module_path(os.path.join(os.path.dirname(__file__),
+                                                name))
+                      for name in ('callcount.py', 'datastore.py',
+                                   'tracing.py'))
+
+
+def _get_call_site():
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        if _module_path(code.co_filename) not in _INTERNAL:
+            return '%s:%d in %s' % (code.co_filename, frame.f_lineno,
+                                    code.co_name)
+        frame = frame.f_back
+    return '<unknown>'
+
+
+class CallLog(object):
+    """The datastore calls made while a :class:`CallCounter` scope was
+    active, as a list of `(method name, call site)` pairs"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+    def call_sites(self):
+        """Returns the number of calls made from each call site, most
+        frequent first"""
+        counts = {}
+        for name, site in self.calls:
+            counts[(name, site)] = counts.get((name, site), 0) + 1
+        return sorted(counts.items(), key=lambda item: -item[1])
+
+    def format(self):
+        return '\n'.join('  %3d x %s at %s' % (count, name, site)
+                         for (name, site), count in self.call_sites())
+
+
+class CallCounter(object):
+    """Counts the calls made to a connection datastore. These are method
+    calls rather than queries: `commit` is counted, and the query returned
+    by `find_connections` is counted when it is made, not when it is run.
+    Calls the datastore makes to its own methods are not counted.
+
+    :param threshold: The number of calls a request may make before it is
+                      logged. `None` disables logging
+    """
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold
+        self.datastore = None
+        self._local = threading.local()
+        self._replaced = {}
+
+    def install(self, datastore):
+        """Instruments `datastore`. Does nothing if it already is"""
+        if self.datastore is datastore:
+            return
+        self.uninstall()
+        # Methods already wrapped on the instance, for instance by tracing
+        self._replaced = dict((name, datastore.__dict__.get(name))
+                              for name in INSTRUMENTED_METHODS)
+        instrument(datastore, self._wrap)
+        self.datastore = datastore
+
+    def uninstall(self):
+        """Restores the methods of the instrumented datastore"""
+        datastore = self.datastore
+        if datastore is None:
+            return
+        for name, method in self._replaced.items():
+            if method is None:
+                datastore.__dict__.pop(name, None)
+            else:
+                setattr(datastore, name, method)
+        self._replaced = {}
+        self.datastore = None
+
+    def init_app(self, app):
+        """Logs the requests to `app` making more datastore calls than the
+        threshold"""
+        app.before_request(self._start_request)
+        app.teardown_request(self._finish_request)
+
+    def _wrap(self, name, method):
+        local = self._local
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            depth = getattr(local, 'depth', 0)
+            scopes = getattr(local, 'scopes', None)
+            if depth == 0 and scopes:
+                call = (name, _get_call_site())
+                for log in scopes:
+                    log.calls.append(call)
+            local.depth = depth + 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                local.depth = depth
+        return wrapper
+
+    def start(self):
+        """Starts counting calls made by the current thread. Returns the
+        :class:`CallLog` the calls are added to"""
+        log = CallLog()
+        self._local.__dict__.setdefault('scopes', []).append(log)
+        return log
+
+    def stop(self, log):
+        """Stops adding calls to `log`"""
+        self._local.scopes.remove(log)
+
+    @contextmanager
+    def count(self):
+        """Counts the calls made by the current thread in a block"""
+        log = self.start()
+        try:
+            yield log
+        finally:
+            self.stop(log)
+
+    def _start_request(self):
+        self._local.request_log = self.start()
+
+    def _finish_request(self, exc=None):
+        log = self._local.__dict__.pop('request_log', None)
+        if log is None:
+            return
+        self.stop(log)
+        if self.threshold is not None and len(log) > self.threshold:
+            current_app.logger.warning(
+                '%s %s made %d datastore calls, more than %d:\n%s',
+                request.method, request.path, len(log), self.threshold,
+                log.format())
+
+
+@contextmanager
+def assert_max_calls(max_calls, app=None):
+    """Fails with an `AssertionError` listing the call sites if the block
+    makes more than `max_calls` datastore calls::
+
+        with assert_max_calls(3):
+            client.get('/connect/twitter?oauth_token=...')
+
+    :param max_calls: The maximum number of datastore calls
+    :param app: The application. Defaults to the current application
+    """
+    state = (app or current_app).extensions['social']
+    counter = state.call_counter
+    # Only a datastore counted for every request stays instrumented
+    installed = counter.datastore is None
+    counter.install(state.datastore)
+    try:
+        with counter.count() as log:
+            yield log
+    finally:
+        if installed:
+            counter.uninstall()
+    if len(log) > max_calls:
+        raise AssertionError('%d datastore calls made, expected at most %d:'
+                             '\n%s' % (len(log), max_calls, log.format()))
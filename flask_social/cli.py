@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.cli
+    ~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the Flask-Social commands for the `flask` command
+    line interface
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from .graph import get_edge_kinds, import_graph
+from .sync import Checkpoint, sync_profiles
+from .transfer import FORMATS, export_connections, import_connections
+
+social_cli = AppGroup('social', help='Flask-Social commands.')
+
+
+@social_cli.command('sync-profiles')
+@click.option('--provider', 'provider_ids', multiple=True,
+              help='Provider to sync. May be repeated. Defaults to all.')
+@click.option('--page-size', default=100, show_default=True,
+              help='Connections per page and per commit.')
+@click.option('--workers', default=4, show_default=True,
+              help='Concurrent calls per provider.')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='File used to resume an interrupted sync.')
+@click.option('--restart', is_flag=True,
+              help='Ignore and reset the checkpoint file.')
+@click.option('--dry-run', is_flag=True,
+              help='Report changes without writing them.')
+def sync_profiles_command(provider_ids, page_size, workers, checkpoint,
+                          restart, dry_run):
+    """Refresh the stored profiles of connections."""
+    checkpoint = Checkpoint(checkpoint)
+    if restart:
+        checkpoint.clear()
+
+    def progress(provider_id, stats):
+        click.echo('%s: %d processed, %d updated, %d failed' % (
+            provider_id, stats['processed'], stats['updated'],
+            stats['failed']))
+
+    results = sync_profiles(list(provider_ids), checkpoint=checkpoint,
+                            page_size=page_size, workers=workers,
+                            dry_run=dry_run, progress=progress)
+
+    for provider_id, stats in sorted(results.items()):
+        click.echo('%s done: %d processed, %d %s, %d failed' % (
+            provider_id, stats['processed'], stats['updated'],
+            'would be updated' if dry_run else 'updated', stats['failed']))
+
+
+def _echo_throughput(count, elapsed):
+    rate = count / elapsed if elapsed else 0
+    click.echo('%d connections (%.0f/s)' % (count, rate), err=True)
+
+
+@social_cli.command('export')
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--format', type=click.Choice(FORMATS), default='jsonl',
+              show_default=True, help='Serialization format.')
+@click.option('--provider', 'provider_id',
+              help='Only export connections to this provider.')
+@click.option('--page-size', default=1000, show_default=True,
+              help='Connections read per query.')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='File used to resume an interrupted export.')
+def export_command(output, format, provider_id, page_size, checkpoint):
+    """Export connections to a file."""
+    checkpoint = Checkpoint(checkpoint)
+    kwargs = dict(provider_id=provider_id) if provider_id else {}
+    mode = 'ab' if checkpoint.get('export') is not None else 'wb'
+    with open(output, mode) as f:
+        count = export_connections(f, format=format, checkpoint=checkpoint,
+                                   page_size=page_size,
+                                   progress=_echo_throughput, **kwargs)
+    click.echo('Exported %d connections' % count)
+
+
+@social_cli.command('import')
+@click.argument('input', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', type=click.Choice(FORMATS), default='jsonl',
+              show_default=True, help='Serialization format.')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Connections per transaction.')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='File used to resume an interrupted import.')
+@click.option('--user-map', type=click.Path(exists=True, dir_okay=False),
+              help='JSON file mapping exported user IDs to new user IDs.')
+def import_command(input, format, batch_size, checkpoint, user_map):
+    """Import connections from a file."""
+    checkpoint = Checkpoint(checkpoint)
+    user_id_map = None
+    if user_map:
+        with open(user_map) as f:
+            user_id_map = json.load(f)
+    with open(input, 'rb') as f:
+        stats = import_connections(f, format=format, checkpoint=checkpoint,
+                                   batch_size=batch_size,
+                                   user_id_map=user_id_map,
+                                   progress=_echo_throughput)
+    click.echo('Imported %(imported)d connections, skipped %(skipped)d '
+               'existing connections' % stats)
+
+
+@social_cli.command('import-graph')
+@click.option('--provider', 'provider_ids', multiple=True,
+              help='Provider to import. May be repeated. Defaults to all '
+                   'supporting it.')
+@click.option('--kind', 'kinds', multiple=True,
+              help='Kind of edges to import, such as followers. May be '
+                   'repeated. Defaults to all.')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Edges per insert.')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='File used to resume an interrupted import.')
+@click.option('--max-wait', type=float,
+              help='Seconds to wait for a rate limit per account and kind '
+                   'before giving up. Defaults to waiting as long as needed.')
+def import_graph_command(provider_ids, kinds, batch_size, checkpoint,
+                         max_wait):
+    """Import the followers and friends of connected accounts."""
+    state = current_app.extensions['social']
+    if state.edge_datastore is None:
+        raise click.UsageError('No edge datastore was passed to Social')
+    supported = set()
+    for provider in state.providers.values():
+        supported.update(get_edge_kinds(provider))
+    for kind in kinds:
+        if kind not in supported:
+            raise click.BadParameter(
+                '%s is not supported by any provider' % kind,
+                param_hint='--kind')
+    checkpoint = Checkpoint(checkpoint)
+
+    def progress(provider_id, kind, stats):
+        click.echo('%s %s: %d seen, %d created' % (
+            provider_id, kind, stats['seen'], stats['created']), err=True)
+
+    results = import_graph(list(provider_ids), kinds=list(kinds),
+                           checkpoint=checkpoint, batch_size=batch_size,
+                           progress=progress, max_wait=max_wait)
+
+    for provider_id, stats in sorted(results.items()):
+        click.echo('%s done: %d connections, %d edges seen, %d created, '
+                   '%d removed' % (provider_id, stats['connections'],
+                                   stats['seen'], stats['created'],
+                                   stats['removed']))
+
+
+@social_cli.command('populate-identity-index')
+@click.option('--page-size', default=1000, show_default=True,
+              help='Connections read per query.')
+def populate_identity_index_command(page_size):
+    """Fill the shared identity index with every stored connection."""
+    state = current_app.extensions['social']
+    if state.identity_index is None:
+        raise click.UsageError('SOCIAL_IDENTITY_INDEX_PATH is not set')
+    count = state.identity_index.populate(state.datastore,
+                                          page_size=page_size)
+    click.echo('Indexed %d connections' % count)
@@ -8,15 +8,33 @@
     :copyright: (c) 2012 by Matt Wright.
     :license: MIT, see LICENSE for more details.
 """
+import copy
+import json
+import threading
+import time
+from contextlib import contextmanager
 from importlib import import_module
 
-from flask import current_app
+from flask import current_app, redirect, request
 from flask_oauthlib.client import OAuthRemoteApp as BaseRemoteApp
 from flask.ext.security import current_user
 from werkzeug.local import LocalProxy
 
-from .utils import get_config, update_recursive
+from .avatars import AvatarCache
+from .datastore import TOKEN_FIELDS
+from .health import HealthMonitor, ProviderHealth
+from .httpcache import ResponseCache
+from .identity import IdentityFilter, SharedIdentityIndex
+from .ratelimit import RateLimiter, RateLimitedAPI
+from .resilience import Bulkhead, RetryPolicy, is_transient_error
+from .utils import LRUCache, get_config, token_key, update_recursive
+from .signals import (connection_created, connection_failed,
+                      connection_removed, login_completed, login_failed)
+from .publish import Publisher
+from .callcount import CallCounter
+from .tracing import TracedAPI, instrument_datastore, span, trace_signals
 from .views import create_blueprint
+from .warmup import ClientPool
 
 _security = LocalProxy(lambda: current_app.extensions['security'])
 
@@ -33,29 +51,455 @@ default_config = {
     'SOCIAL_CONNECT_DENY_VIEW': '/',
     'SOCIAL_POST_OAUTH_CONNECT_SESSION_KEY': 'post_oauth_connect_url',
     'SOCIAL_POST_OAUTH_LOGIN_SESSION_KEY': 'post_oauth_login_url',
-    'SOCIAL_APP_URL': 'http://localhost'
+    'SOCIAL_APP_URL': 'http://localhost',
+    'SOCIAL_STATELESS_STATE': False,
+    'SOCIAL_STATE_MAX_AGE': 600,
+    'SOCIAL_STATE_COOKIE_NAME': 'social_oauth_state',
+    'SOCIAL_CALLBACK_URL_CACHE_SIZE': 100,
+    'SOCIAL_TENANT_CACHE_SIZE': 1000,
+    'SOCIAL_PROVIDER_POLL_INTERVAL': 5,
+    'SOCIAL_USE_IDENTITY_FILTER': False,
+    'SOCIAL_IDENTITY_FILTER_CAPACITY': 100000,
+    'SOCIAL_IDENTITY_FILTER_ERROR_RATE': 0.01,
+    'SOCIAL_IDENTITY_FILTER_REFRESH_INTERVAL': 60,
+    'SOCIAL_IDENTITY_INDEX_PATH': None,
+    'SOCIAL_IDENTITY_INDEX_SLOTS': 65536,
+    'SOCIAL_DATASTORE_CALL_THRESHOLD': None,
+    'SOCIAL_HEALTH_PROBE_INTERVAL': None,
+    'SOCIAL_HEALTH_PROBE_TIMEOUT': 5,
+    'SOCIAL_HEALTH_CACHE_TTL': 5,
+    'SOCIAL_HEALTH_ERROR_THRESHOLD': 0.5,
+    'SOCIAL_WARM_API_CLIENTS': False,
+    'SOCIAL_WARM_API_CLIENT_TTL': 60,
+    'SOCIAL_WARM_API_CLIENT_POOL_SIZE': 1000,
+    'SOCIAL_PUBLISH_WORKERS': 4,
+    'SOCIAL_PUBLISH_TIMEOUT': 10,
+    'SOCIAL_CACHE_PROFILES': False,
+    'SOCIAL_PROFILE_CACHE_SIZE': 1000,
+    'SOCIAL_PROFILE_CACHE_DIR': None,
+    'SOCIAL_PROFILE_CACHE_DISK_SIZE': 10 * 1024 * 1024,
+    'SOCIAL_PROFILE_CACHE_MAX_AGE': 7 * 24 * 60 * 60,
+    'SOCIAL_AVATAR_CACHE_DIR': None,
+    'SOCIAL_AVATAR_CACHE_SIZE': 50 * 1024 * 1024,
+    'SOCIAL_AVATAR_MAX_AGE': 30 * 24 * 60 * 60
 }
 
 
+class Settings(object):
+    """The Social configuration of an app, compiled once by `init_app` so
+    hot paths read plain attributes instead of building config keys. Each
+    attribute is named after a key of `default_config` without the `SOCIAL_`
+    prefix, in lower case. Settings are frozen: changes to `app.config` made
+    after `init_app` are not seen.
+
+    :param config: The app's config
+    """
+
+    __slots__ = tuple(sorted(key[len('SOCIAL_'):].lower()
+                             for key in default_config))
+
+    def __init__(self, config):
+        for name in self.__slots__:
+            object.__setattr__(self, name, config['SOCIAL_' + name.upper()])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Settings are read only')
+
+    def __delattr__(self, name):
+        raise AttributeError('Settings are read only')
+
+    def __repr__(self):
+        values = ('%s=%r' % (name, getattr(self, name))
+                  for name in self.__slots__)
+        return '<Settings %s>' % ', '.join(values)
+
+
 class OAuthRemoteApp(BaseRemoteApp):
 
     def __init__(self, id, module, install, *args, **kwargs):
+        bulkhead = kwargs.pop('bulkhead', None) or {}
+        retry = kwargs.pop('retry', None) or {}
+        rate_limit = kwargs.pop('rate_limit', None)
+        health = kwargs.pop('health', None) or {}
+        publish_timeout = kwargs.pop('publish_timeout', None)
         BaseRemoteApp.__init__(self, None, **kwargs)
         self.id = id
         self.module = module
+        self.bulkhead = Bulkhead(id, **bulkhead)
+        self.retry = RetryPolicy(id, **retry)
+        self.health = ProviderHealth(id, **health)
+        self.publish_timeout = publish_timeout
+        self.profile_cache = None
+        self.rate_limiter = None
+        if rate_limit:
+            # `True` uses the limits of the provider module, and a dict is
+            # merged over them
+            rate_limit = update_recursive(
+                dict(getattr(import_module(module), 'RATE_LIMIT', {})),
+                rate_limit if isinstance(rate_limit, dict) else {})
+            self.rate_limiter = RateLimiter(id, **rate_limit)
+
+    def _call(self, name, *args, **kwargs):
+        """Calls the named function of the provider module inside the
+        provider's bulkhead, retrying transient failures. Only use this for
+        idempotent calls such as profile lookups."""
+        func = getattr(import_module(self.module), name)
+        is_transient = self._is_transient_error
+
+        def attempt():
+            with self.bulkhead:
+                with span('social.provider.%s' % name,
+                          {'social.provider_id': self.id}):
+                    with self._observe(is_transient):
+                        return func(*args, **kwargs)
+
+        return self.retry.call(attempt, is_transient)
+
+    @property
+    def _is_transient_error(self):
+        # Also decides what counts against the provider's health, so forged
+        # callbacks failing before any request is made do not mark it down
+        module = import_module(self.module)
+        return getattr(module, 'is_transient_error', is_transient_error)
 
-    def get_connection(self):
-        return _social.datastore.find_connection(provider_id=self.id,
+    @contextmanager
+    def _observe(self, is_failure=None, token_exchange=False):
+        # Errors such as expired tokens are answers from a working provider
+        start = time.time()
+        try:
+            yield
+        except Exception as e:
+            error = e if is_failure is None or is_failure(e) else None
+            self.health.record(time.time() - start, error,
+                               token_exchange=token_exchange)
+            raise
+        self.health.record(time.time() - start,
+                           token_exchange=token_exchange)
+
+    def _profile_kwargs(self):
+        # Only passed when enabled, so provider modules need not accept it
+        if self.profile_cache is None:
+            return {}
+        return dict(profile_cache=self.profile_cache)
+
+    def get_provider_user_id(self, response):
+        return self._call('get_provider_user_id', response,
+                          **self._profile_kwargs())
+
+    def get_connection_values(self, response):
+        return self._call('get_connection_values', response,
+                          consumer_key=self.consumer_key,
+                          consumer_secret=self.consumer_secret,
+                          **self._profile_kwargs())
+
+    def refresh_connection_values(self, connections):
+        """Fetches fresh connection values for stored connections. Returns
+        a list in the same order as `connections`. Providers that support
+        batch requests fetch many connections per call.
+
+        :param connections: The connections to refresh
+        """
+        module = import_module(self.module)
+        if hasattr(module, 'get_connection_values_batch'):
+            return self._call('get_connection_values_batch', connections,
+                              consumer_key=self.consumer_key,
+                              consumer_secret=self.consumer_secret)
+        return [self.get_connection_values(
+                module.get_response_from_connection(c)) for c in connections]
+
+    @property
+    def _stateless(self):
+        # OAuth 1.0a providers keep their request token in the session
+        return (self.request_token_url is None and
+                _social.settings.stateless_state)
+
+    @property
+    def access_token_params(self):
+        params = dict(self._get_property('access_token_params', {}))
+        if self._stateless:
+            # The callback URL is not kept in the session, but it is the URL
+            # the provider redirected to
+            params.setdefault('redirect_uri', request.base_url)
+        return params
+
+    def authorize(self, callback=None, state=None, **kwargs):
+        if not self._stateless:
+            return BaseRemoteApp.authorize(self, callback, state, **kwargs)
+
+        # The base implementation stores the callback URL in the session
+        params = dict(self.request_token_params or {})
+        params.update(**kwargs)
+        params.pop('state', None)
+        scope = params.pop('scope', None)
+        if isinstance(scope, str):
+            scope = scope.decode(self.encoding)
+
+        url = self.make_client().prepare_request_uri(
+            self.expand_url(self.authorize_url), redirect_uri=callback,
+            scope=scope, state=state, **params)
+        return redirect(url)
+
+    def handle_oauth1_response(self):
+        with self.bulkhead:
+            with span('social.token_exchange',
+                      {'social.provider_id': self.id}):
+                with self._observe(self._is_transient_error,
+                                   token_exchange=True):
+                    return BaseRemoteApp.handle_oauth1_response(self)
+
+    def handle_oauth2_response(self):
+        with self.bulkhead:
+            with span('social.token_exchange',
+                      {'social.provider_id': self.id}):
+                with self._observe(self._is_transient_error,
+                                   token_exchange=True):
+                    return BaseRemoteApp.handle_oauth2_response(self)
+
+    def get_connection(self, only=None):
+        """Returns the current user's connection to the provider.
+
+        :param only: The names of the connection fields to load. Defaults to
+                     all fields
+        """
+        return _social.datastore.find_connection(only=only,
+                                                 provider_id=self.id,
                                                  user_id=current_user.id)
 
-    def get_api(self):
+    def get_api(self, connection=None):
+        """Returns an API client for `connection`, or for the current
+        user's connection to the provider. With a tracer, each call made
+        through the client runs in a span"""
         module = import_module(self.module)
-        connection = self.get_connection()
+        if connection is None:
+            connection = self.get_connection(only=TOKEN_FIELDS)
         if connection is None:
             return None
-        return module.get_api(connection=connection,
-                              consumer_key=self.consumer_key,
-                              consumer_secret=self.consumer_secret)
+        pool = _social.client_pool
+        api = pool.take(self, connection) if pool is not None else None
+        if api is None:
+            api = module.get_api(connection=connection,
+                                 consumer_key=self.consumer_key,
+                                 consumer_secret=self.consumer_secret)
+        if self.rate_limiter is not None:
+            api = RateLimitedAPI(api, self.rate_limiter,
+                                 token_key(connection.access_token), module)
+        if _social.tracer is not None:
+            api = TracedAPI(api, self.id)
+        return api
+
+
+def _create_provider(provider_id, config):
+    """Builds the :class:`OAuthRemoteApp` for `provider_id` from its config,
+    merged over the defaults of its provider module"""
+    default_module_name = 'flask_social.providers.%s' % provider_id
+    module = import_module(config.get('module', default_module_name))
+    config = update_recursive(copy.deepcopy(module.config), config)
+    provider = OAuthRemoteApp(**config)
+    provider.tokengetter(_get_token)
+    return provider
+
+
+_MISSING = object()
+
+
+class ProviderRegistry(object):
+    """Resolves `(tenant_id, provider_id)` to an :class:`OAuthRemoteApp`.
+
+    Apps serving many tenants, each with its own consumer keys, pass a
+    credential loader. Tenant providers are created on first use from the
+    config it returns and kept in an LRU cache, so only the tenants in use are
+    held in memory. A provider built by the registry shares the bulkhead and
+    retry budget of the app's provider with the same ID, but has its own rate
+    limiter since quotas are usually per consumer key.
+
+    Providers may also be registered, updated and disabled at runtime through
+    a :class:`~flask_social.datastore.ProviderDatastore`. Every change bumps
+    the datastore's version counter. Each worker polls the datastore at most
+    once every `poll_interval` seconds and only applies the providers changed
+    since the version it holds, so lookups stay dictionary lookups.
+
+    :param configs: The provider configs of the app by provider ID
+    :param providers: The providers configured for the app by provider ID.
+                      These are used when the tenant ID is `None`
+    :param credential_loader: A callable taking a tenant ID and a provider ID
+                              and returning a provider config, usually just
+                              the `consumer_key` and `consumer_secret`, or
+                              `None` if the tenant does not use the provider
+    :param tenant_getter: A callable returning the ID of the current tenant,
+                          for example from `request.host`
+    :param max_size: The maximum number of tenant providers cached
+    :param datastore: An optional provider datastore
+    :param poll_interval: The minimum number of seconds between two polls of
+                          the datastore's version counter
+    """
+
+    def __init__(self, configs, providers, credential_loader=None,
+                 tenant_getter=None, max_size=1000, datastore=None,
+                 poll_interval=5):
+        self.configs = configs
+        self.providers = providers
+        self.datastore = datastore
+        self.poll_interval = poll_interval
+        self.version = 0
+        self._credential_loader = credential_loader
+        self._tenant_getter = tenant_getter
+        self._tenant_providers = LRUCache(max_size)
+        self._registered = {}
+        self._next_poll = 0
+        self._refresh_lock = threading.Lock()
+
+    def credential_loader(self, func):
+        """Decorator setting the credential loader"""
+        self._credential_loader = func
+        self.invalidate()
+        return func
+
+    def tenant_getter(self, func):
+        """Decorator setting the callable returning the current tenant ID"""
+        self._tenant_getter = func
+        return func
+
+    def get_tenant_id(self):
+        if self._tenant_getter is None:
+            return None
+        return self._tenant_getter()
+
+    def get(self, tenant_id, provider_id):
+        """Returns the provider `provider_id` of the tenant `tenant_id`, or
+        `None` if the tenant does not use it or it is disabled"""
+        if self.datastore is not None:
+            self.poll()
+
+        key = (tenant_id, provider_id)
+        config = self._registered.get(key, _MISSING)
+        if config is None:
+            return None
+        if tenant_id is None:
+            return self.providers.get(provider_id)
+        if config is _MISSING and self._credential_loader is None:
+            return self.providers.get(provider_id)
+
+        provider = self._tenant_providers.get(key, _MISSING)
+        if provider is _MISSING:
+            # The loader may be slow, so it is not called under the lock. Two
+            # threads may both create the provider, which is harmless
+            if config is _MISSING:
+                config = self._credential_loader(tenant_id, provider_id)
+            provider = self._create(provider_id, config)
+            self._tenant_providers.set(key, provider)
+        return provider
+
+    def current(self, provider_id):
+        """Returns the provider `provider_id` of the current tenant"""
+        return self.get(self.get_tenant_id(), provider_id)
+
+    def _create(self, provider_id, config):
+        if config is None:
+            return None
+        config = update_recursive(
+            copy.deepcopy(self.configs.get(provider_id) or {}), config)
+        provider = _create_provider(provider_id, config)
+        shared = self.providers.get(provider_id)
+        if shared is not None:
+            provider.bulkhead = shared.bulkhead
+            provider.retry = shared.retry
+            provider.health = shared.health
+            provider.profile_cache = shared.profile_cache
+        return provider
+
+    def invalidate(self, tenant_id=None, provider_id=None):
+        """Drops cached tenant providers so they are rebuilt from fresh
+        credentials, for example after credentials are rotated. Without
+        arguments every tenant provider is dropped."""
+        if tenant_id is None and provider_id is None:
+            self._tenant_providers.clear()
+            return
+        for key in self._tenant_providers.keys():
+            if tenant_id not in (None, key[0]):
+                continue
+            if provider_id not in (None, key[1]):
+                continue
+            self._tenant_providers.pop(key)
+
+    def poll(self):
+        """Refreshes the registry if `poll_interval` seconds have passed since
+        the last poll. Only one thread polls, the others keep using the
+        providers they have."""
+        if time.time() < self._next_poll:
+            return
+        if not self._refresh_lock.acquire(False):
+            return
+        try:
+            self._next_poll = time.time() + self.poll_interval
+            self._refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def refresh(self):
+        """Loads the providers changed in the datastore since the last
+        refresh"""
+        with self._refresh_lock:
+            self._refresh()
+
+    def _refresh(self):
+        version = self.datastore.get_provider_version()
+        if version == self.version:
+            return
+        for row in self.datastore.find_providers(after_version=self.version):
+            config = json.loads(row.config or '{}') if row.enabled else None
+            self._apply(row.tenant_id, row.provider_id, config)
+            self.version = max(self.version, row.version)
+
+    def _apply(self, tenant_id, provider_id, config):
+        self._registered[tenant_id, provider_id] = config
+        if tenant_id is not None:
+            self._tenant_providers.pop((tenant_id, provider_id))
+        elif config is None:
+            self.providers.pop(provider_id, None)
+        else:
+            self.providers[provider_id] = self._create(provider_id, config)
+
+    def register(self, provider_id, config, tenant_id=None):
+        """Registers a provider, or replaces the config of a registered one,
+        and stores it in the datastore so every worker picks it up.
+
+        :param provider_id: The provider ID, such as `twitter`
+        :param config: The provider config, as in `SOCIAL_<PROVIDER>`. It is
+                       merged over the app's config of the same provider
+        :param tenant_id: The tenant to register the provider for. `None`
+                          registers it for the app
+        """
+        self._put(provider_id, tenant_id, config=config)
+
+    def update(self, provider_id, config, tenant_id=None):
+        """Merges `config` into the stored config of a provider, for example
+        to rotate its consumer secret, and enables it. Providers configured
+        in `app.config` can be updated too."""
+        stored = self._get_datastore().find_provider(provider_id, tenant_id)
+        current = json.loads(stored.config or '{}') if stored else {}
+        self._put(provider_id, tenant_id,
+                  config=update_recursive(current, config))
+
+    def disable(self, provider_id, tenant_id=None):
+        """Disables a provider. Its views return a 404 until it is registered
+        again."""
+        self._put(provider_id, tenant_id, enabled=False)
+
+    def _put(self, provider_id, tenant_id, config=None, enabled=True):
+        datastore = self._get_datastore()
+        datastore.put_provider(provider_id, config=config,
+                               tenant_id=tenant_id, enabled=enabled)
+        datastore.commit()
+        self.refresh()
+
+    def _get_datastore(self):
+        if self.datastore is None:
+            raise RuntimeError('Registering providers at runtime requires a '
+                               'provider datastore')
+        return self.datastore
+
+    def __len__(self):
+        return len(self._tenant_providers)
 
 
 def _get_state(app, datastore, providers, **kwargs):
@@ -70,7 +514,8 @@ def _get_state(app, datastore, providers, **kwargs):
     kwargs.update(dict(
         app=app,
         datastore=datastore,
-        providers=providers))
+        providers=providers,
+        callback_urls=LRUCache(kwargs['settings'].callback_url_cache_size)))
 
     return _SocialState(**kwargs)
 
@@ -88,6 +533,11 @@ class _SocialState(object):
             msg = "'_SocialState' object has no attribute '%s'" % name
             raise AttributeError(msg)
 
+    def in_flight(self):
+        """Returns the number of calls currently in flight to each provider"""
+        return dict((provider_id, provider.bulkhead.in_flight)
+                    for provider_id, provider in self.providers.items())
+
 
 def _get_token():
     # Social doesn't use the builtin remote method calls feature of the
@@ -96,48 +546,180 @@ def _get_token():
     return None
 
 
+def _connect_identity_filter(app, identity_filter):
+    def on_connection_created(sender, connection, **kwargs):
+        identity_filter.add(connection.provider_id,
+                            connection.provider_user_id)
+
+    def on_connection_removed(sender, **kwargs):
+        identity_filter.remove()
+
+    connection_created.connect(on_connection_created, sender=app, weak=False)
+    connection_removed.connect(on_connection_removed, sender=app, weak=False)
+
+
+def _connect_identity_index(app, identity_index):
+    def on_connection_created(sender, connection, **kwargs):
+        # The connection is not committed yet, so it is indexed on the first
+        # login with it instead
+        identity_index.delete(connection.provider_id,
+                              connection.provider_user_id)
+
+    connection_created.connect(on_connection_created, sender=app, weak=False)
+
+
+def _connect_client_pool(app, pool):
+    def on_login_completed(sender, user, **kwargs):
+        # A single query for every connection of the user
+        records = _social.datastore.find_connection_records(user_id=user.id)
+        connections = []
+        for record in records:
+            provider = _social.registry.current(record.provider_id)
+            if provider is not None:
+                connections.append((provider, record))
+        pool.warm(connections)
+
+    login_completed.connect(on_login_completed, sender=app, weak=False)
+
+
 class Social(object):
 
-    def __init__(self, app=None, datastore=None):
+    def __init__(self, app=None, datastore=None, credential_loader=None,
+                 tenant_getter=None, provider_datastore=None, tracer=None,
+                 edge_datastore=None):
         self.app = app
         self.datastore = datastore
+        self.credential_loader = credential_loader
+        self.tenant_getter = tenant_getter
+        self.provider_datastore = provider_datastore
+        self.edge_datastore = edge_datastore
+        self.tracer = tracer
 
         if app is not None and datastore is not None:
             self._state = self.init_app(app, datastore)
 
-    def init_app(self, app, datastore=None):
+    def init_app(self, app, datastore=None, credential_loader=None,
+                 tenant_getter=None, provider_datastore=None, tracer=None,
+                 edge_datastore=None):
         """Initialize the application with the Social extension
 
         :param app: The Flask application
         :param datastore: Connection datastore instance
+        :param credential_loader: Callable loading the provider config of a
+                                  tenant. See :class:`ProviderRegistry`
+        :param tenant_getter: Callable returning the current tenant ID
+        :param provider_datastore: Provider datastore instance holding the
+                                   providers registered at runtime
+        :param tracer: An OpenTelemetry compatible tracer. See
+                       :mod:`flask_social.tracing`
+        :param edge_datastore: Social edge datastore instance holding the
+                               imported social graph
         """
 
         datastore = datastore or self.datastore
+        credential_loader = credential_loader or self.credential_loader
+        tenant_getter = tenant_getter or self.tenant_getter
+        provider_datastore = provider_datastore or self.provider_datastore
+        tracer = tracer or self.tracer
+        edge_datastore = edge_datastore or self.edge_datastore
 
         for key, value in default_config.items():
             app.config.setdefault(key, value)
 
         providers = dict()
+        configs = dict()
 
         for key, config in app.config.items():
             if not key.startswith('SOCIAL_') or config is None or key in default_config:
                 continue
 
             suffix = key.lower().replace('social_', '')
-            default_module_name = 'flask_social.providers.%s' % suffix
-            module_name = config.get('module', default_module_name)
-            module = import_module(module_name)
-            config = update_recursive(module.config, config)
-
-            providers[config['id']] = OAuthRemoteApp(**config)
-            providers[config['id']].tokengetter(_get_token)
-
-        state = _get_state(app, datastore, providers)
+            provider = _create_provider(suffix, config)
+            providers[provider.id] = provider
+            configs[provider.id] = config
+
+        settings = Settings(app.config)
+        registry = ProviderRegistry(configs, providers, credential_loader,
+                                    tenant_getter, settings.tenant_cache_size,
+                                    provider_datastore,
+                                    settings.provider_poll_interval)
+        identity_filter = None
+        if settings.use_identity_filter:
+            identity_filter = IdentityFilter(
+                datastore, settings.identity_filter_capacity,
+                settings.identity_filter_error_rate,
+                settings.identity_filter_refresh_interval,
+                context=app.app_context)
+            _connect_identity_filter(app, identity_filter)
+        identity_index = None
+        if settings.identity_index_path:
+            identity_index = SharedIdentityIndex(
+                settings.identity_index_path, settings.identity_index_slots)
+            _connect_identity_index(app, identity_index)
+        if tracer is not None:
+            instrument_datastore(datastore)
+            trace_signals(app, (connection_created, connection_failed,
+                                connection_removed, login_completed,
+                                login_failed))
+        call_counter = CallCounter(settings.datastore_call_threshold)
+        if settings.datastore_call_threshold is not None:
+            call_counter.install(datastore)
+            call_counter.init_app(app)
+        health = HealthMonitor(registry, settings.health_probe_interval,
+                               settings.health_probe_timeout,
+                               settings.health_cache_ttl,
+                               settings.health_error_threshold)
+        health.init_app(app)
+        client_pool = None
+        if settings.warm_api_clients:
+            client_pool = ClientPool(settings.warm_api_client_pool_size,
+                                     settings.warm_api_client_ttl)
+            _connect_client_pool(app, client_pool)
+        profile_cache = None
+        if settings.cache_profiles:
+            profile_cache = ResponseCache(settings.profile_cache_size,
+                                          settings.profile_cache_dir,
+                                          settings.profile_cache_disk_size,
+                                          settings.profile_cache_max_age)
+            for provider in providers.values():
+                provider.profile_cache = profile_cache
+        avatar_cache = None
+        if settings.avatar_cache_dir is not None:
+            avatar_cache = AvatarCache(settings.avatar_cache_dir,
+                                       settings.avatar_cache_size)
+        state = _get_state(app, datastore, providers, settings=settings,
+                           registry=registry, identity_filter=identity_filter,
+                           identity_index=identity_index, tracer=tracer,
+                           call_counter=call_counter, health=health,
+                           client_pool=client_pool,
+                           profile_cache=profile_cache,
+                           avatar_cache=avatar_cache,
+                           edge_datastore=edge_datastore,
+                           publisher=Publisher(settings.publish_workers,
+                                               settings.publish_timeout))
 
         app.register_blueprint(create_blueprint(state, __name__))
         app.extensions['social'] = state
 
+        if hasattr(app, 'cli'):
+            from .cli import social_cli
+            app.cli.add_command(social_cli)
+
         return state
 
+    def publish(self, user, payload, providers=None):
+        """Posts `payload` to the providers `user` is connected to, all at
+        once, and returns a :class:`~flask_social.publish.PublishResult` for
+        each provider ID. See :meth:`flask_social.publish.Publisher.publish`.
+
+        :param user: The user to publish for
+        :param payload: A dictionary with a `message` and, optionally, a
+                        `link`
+        :param providers: The IDs of the providers to publish to. Defaults to
+                          every connected provider that supports publishing
+        """
+        publisher = current_app.extensions['social'].publisher
+        return publisher.publish(user, payload, providers)
+
     def __getattr__(self, name):
         return getattr(self._state, name, None)
@@ -9,9 +9,92 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import json
+
 from flask_security.datastore import SQLAlchemyDatastore, MongoEngineDatastore, \
     PeeweeDatastore
 
+#: The connection attributes shared by every backend
+CONNECTION_FIELDS = ('user_id', 'provider_id', 'provider_user_id',
+                     'access_token', 'secret', 'display_name', 'full_name',
+                     'profile_url', 'image_url', 'rank')
+
+#: The attributes held by a :class:`ConnectionRecord`
+RECORD_FIELDS = ('id',) + CONNECTION_FIELDS
+
+#: The attributes needed to log in with a connection or call its provider,
+#: loaded with `only=` on those paths
+TOKEN_FIELDS = ('id', 'user_id', 'provider_id', 'provider_user_id',
+                'access_token', 'secret')
+
+#: The `provider_id` of the provider row holding the version counter
+VERSION_COUNTER_ID = '__version__'
+
+#: The connection datastore methods wrapped by :func:`instrument`
+INSTRUMENTED_METHODS = ('find_connection', 'find_connections',
+                        'find_connection_record', 'find_connection_records',
+                        'find_connections_page', 'create_connection',
+                        'create_connections', 'delete_connection',
+                        'delete_connections', 'put', 'delete', 'commit')
+
+
+def instrument(datastore, wrapper):
+    """Replaces each of the :data:`INSTRUMENTED_METHODS` of a datastore
+    instance with `wrapper(name, method)`. Calls the datastore makes to its
+    own methods go through the wrappers too."""
+    for name in INSTRUMENTED_METHODS:
+        method = getattr(datastore, name, None)
+        if method is not None:
+            setattr(datastore, name, wrapper(name, method))
+
+
+class ConnectionRecord(object):
+    """An immutable, lightweight copy of a connection returned by the read
+    only lookups of a datastore. Records carry none of the session or
+    identity map overhead of a model instance, which also makes them cheap to
+    cache. Use :meth:`ConnectionDatastore.to_model` to get the model when the
+    connection has to be changed.
+
+    Fields missing from a connection model are `None`.
+    """
+
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, **kwargs):
+        for key in RECORD_FIELDS:
+            object.__setattr__(self, key, kwargs.get(key))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("'ConnectionRecord' object is immutable")
+
+    __delattr__ = __setattr__
+
+    def __getstate__(self):
+        return tuple(getattr(self, key) for key in RECORD_FIELDS)
+
+    def __setstate__(self, state):
+        for key, value in zip(RECORD_FIELDS, state):
+            object.__setattr__(self, key, value)
+
+    def __eq__(self, other):
+        if not isinstance(other, ConnectionRecord):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        rv = self.__eq__(other)
+        return rv if rv is NotImplemented else not rv
+
+    def __hash__(self):
+        return hash(self.__getstate__())
+
+    def __repr__(self):
+        return '<ConnectionRecord %s %s:%s>' % (self.id, self.provider_id,
+                                                self.provider_user_id)
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in RECORD_FIELDS)
+
 
 class ConnectionDatastore(object):
     """Abstracted oauth connection datastore. Always extend this class and
@@ -23,15 +106,97 @@ class ConnectionDatastore(object):
     def __init__(self, connection_model):
         self.connection_model = connection_model
 
-    def find_connection(self, **kwargs):
+    def find_connection(self, only=None, **kwargs):
+        """Returns the first connection matching `kwargs`, or `None`.
+
+        :param only: The names of the fields to load. Other fields are loaded
+                     on first access where the backend supports it, and are
+                     `None` otherwise. Defaults to all fields
+        """
         raise NotImplementedError
 
-    def find_connections(self, **kwargs):
+    def find_connections(self, only=None, **kwargs):
+        """Returns the connections matching `kwargs`. Accepts `only` like
+        :meth:`find_connection`."""
+        raise NotImplementedError
+
+    def _only_fields(self, only):
+        # Names missing from the model are skipped, and the ID is always
+        # loaded so the connection can be saved
+        names = ('id',) + tuple(n for n in only if n != 'id')
+        return [n for n in names if hasattr(self.connection_model, n)]
+
+    def find_connection_record(self, **kwargs):
+        """Returns a :class:`ConnectionRecord` for the first connection
+        matching `kwargs`, or `None`. Backends override this to skip building
+        model instances."""
+        connection = self.find_connection(**kwargs)
+        return self.to_record(connection) if connection else None
+
+    def find_connection_records(self, **kwargs):
+        """Returns a list of :class:`ConnectionRecord` for the connections
+        matching `kwargs`."""
+        return [self.to_record(c) for c in self.find_connections(**kwargs)]
+
+    def to_record(self, connection):
+        """Returns a :class:`ConnectionRecord` copy of a connection model"""
+        values = self.get_connection_values(connection)
+        return ConnectionRecord(id=connection.id, **values)
+
+    def to_model(self, record):
+        """Returns the connection model for a :class:`ConnectionRecord`,
+        which may then be changed and put back into the datastore"""
+        return self.find_connection(id=record.id)
+
+    def find_connections_page(self, after=None, limit=100, **kwargs):
+        """Returns up to `limit` connections matching `kwargs`, ordered by
+        primary key, whose primary key is greater than `after`."""
         raise NotImplementedError
 
+    def iter_connections(self, after=None, page_size=100, **kwargs):
+        """Streams all connections matching `kwargs` in pages of at most
+        `page_size` connections, starting after the primary key `after`.
+        Memory use is bounded by the page size."""
+        while True:
+            page = list(self.find_connections_page(after=after,
+                                                   limit=page_size, **kwargs))
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            after = page[-1].id
+
+    def find_identities(self, identities):
+        """Returns the set of the `(provider_id, provider_user_id)` pairs in
+        `identities` that have a connection. Backends override this to look
+        them all up in one query."""
+        return set(i for i in identities if self.find_connection_record(
+            provider_id=i[0], provider_user_id=i[1]) is not None)
+
+    def _existing_identities(self, identities, rows):
+        return set(tuple(row) for row in rows) & set(identities)
+
     def create_connection(self, **kwargs):
         return self.put(self.connection_model(**kwargs))
 
+    def create_connections(self, values):
+        """Creates a connection for each dictionary of connection values in
+        `values`. Backends override this to insert them in bulk."""
+        return [self.create_connection(**cv) for cv in values]
+
+    def get_connection_values(self, connection):
+        """Returns the values of a connection as a dictionary that can be
+        passed to :meth:`create_connection`, for instance by another
+        backend."""
+        return dict((key, getattr(connection, key)) for key in
+                    CONNECTION_FIELDS if hasattr(connection, key))
+
+    def get_user_id(self, connection):
+        """Returns the ID of the user owning a connection without loading
+        the user or the other fields of the connection"""
+        return connection.user_id
+
     def delete_connection(self, **kwargs):
         """Remove a single connection to a provider for the specified user."""
         conn = self.find_connection(**kwargs)
@@ -52,18 +217,118 @@ class ConnectionDatastore(object):
 class SQLAlchemyConnectionDatastore(SQLAlchemyDatastore, ConnectionDatastore):
     """A SQLAlchemy datastore implementation for Flask-Social."""
 
+    #: The lookups, as sorted keyword argument names, whose statements are
+    #: built and compiled once
+    CACHED_LOOKUPS = (('provider_id', 'provider_user_id'),
+                      ('provider_id', 'user_id'))
+
     def __init__(self, db, connection_model):
         SQLAlchemyDatastore.__init__(self, db)
         ConnectionDatastore.__init__(self, connection_model)
+        self._statements = {}
+        self._compiled_cache = {}
 
-    def _query(self, **kwargs):
-        return self.connection_model.query.filter_by(**kwargs)
+    def _query(self, only=None, **kwargs):
+        query = self.connection_model.query.filter_by(**kwargs)
+        if only:
+            from sqlalchemy.orm import load_only
+            query = query.options(load_only(*self._only_fields(only)))
+        return query
+
+    def _cached_query(self, kind, names, kwargs, limit=False):
+        """Returns a query running the statement of a cached lookup, built
+        once with bound parameters and compiled once per dialect, or `None`
+        if `kwargs` is not one of the :attr:`CACHED_LOOKUPS` or holds a
+        `None` value"""
+        from sqlalchemy import and_, bindparam, select
 
-    def find_connection(self, **kwargs):
-        return self._query(**kwargs).first()
+        shape = tuple(sorted(kwargs))
+        if shape not in self.CACHED_LOOKUPS:
+            return None
+        # A bound None would compare with `= NULL`, which matches nothing,
+        # where `filter_by` renders `IS NULL`
+        if any(value is None for value in kwargs.values()):
+            return None
+        key = (kind, shape, tuple(names), limit)
+        statement = self._statements.get(key)
+        if statement is None:
+            model = self.connection_model
+            # Labelled up front, as the query would otherwise label a copy
+            # on every call and miss the compiled cache
+            statement = select([getattr(model, n) for n in names]).where(
+                and_(*[getattr(model, n) == bindparam(n) for n in shape])
+            ).apply_labels()
+            if limit:
+                statement = statement.limit(1)
+            self._statements[key] = statement
 
-    def find_connections(self, **kwargs):
-        return self._query(**kwargs)
+        if kind == 'record':
+            query = self.db.session.query(*[getattr(self.connection_model, n)
+                                            for n in names])
+        else:
+            query = self.connection_model.query
+        return query.from_statement(statement).params(**kwargs) \
+            .execution_options(compiled_cache=self._compiled_cache)
+
+    def _model_fields(self, only):
+        if only:
+            return self._only_fields(only)
+        return [c.key for c in self.connection_model.__mapper__.column_attrs]
+
+    def find_connection(self, only=None, **kwargs):
+        query = self._cached_query('model', self._model_fields(only), kwargs,
+                                   limit=True)
+        if query is None:
+            return self._query(only, **kwargs).first()
+        return query.first()
+
+    def find_connections(self, only=None, **kwargs):
+        return self._query(only, **kwargs)
+
+    def _record_columns(self):
+        names = [n for n in RECORD_FIELDS if hasattr(self.connection_model, n)]
+        return names, [getattr(self.connection_model, n) for n in names]
+
+    def _record_query(self, limit, **kwargs):
+        names, columns = self._record_columns()
+        query = self._cached_query('record', names, kwargs, limit)
+        if query is None:
+            query = self._query(**kwargs).with_entities(*columns)
+        return names, query
+
+    def find_connection_record(self, **kwargs):
+        names, query = self._record_query(True, **kwargs)
+        row = query.first()
+        return ConnectionRecord(**dict(zip(names, row))) if row else None
+
+    def find_connection_records(self, **kwargs):
+        names, query = self._record_query(False, **kwargs)
+        return [ConnectionRecord(**dict(zip(names, row))) for row in query]
+
+    def to_model(self, record):
+        return self.connection_model.query.get(record.id)
+
+    def find_connections_page(self, after=None, limit=100, **kwargs):
+        pk = self.connection_model.id
+        query = self._query(**kwargs)
+        if after is not None:
+            query = query.filter(pk > after)
+        return query.order_by(pk).limit(limit)
+
+    def find_identities(self, identities):
+        identities = list(identities)
+        if not identities:
+            return set()
+        model = self.connection_model
+        rows = self.db.session.query(
+            model.provider_id, model.provider_user_id).filter(
+            model.provider_user_id.in_(set(i[1] for i in identities)))
+        return self._existing_identities(identities, rows)
+
+    def create_connections(self, values):
+        connections = [self.connection_model(**cv) for cv in values]
+        self.db.session.add_all(connections)
+        return connections
 
 
 class MongoEngineConnectionDatastore(MongoEngineDatastore, ConnectionDatastore):
@@ -82,11 +347,47 @@ class MongoEngineConnectionDatastore(MongoEngineDatastore, ConnectionDatastore):
         query = QCombination(QCombination.AND, queries)
         return self.connection_model.objects(query)
 
-    def find_connection(self, **kwargs):
-        return self._query(**kwargs).first()
+    def find_connection(self, only=None, **kwargs):
+        return self.find_connections(only, **kwargs).first()
+
+    def find_connections(self, only=None, **kwargs):
+        query = self._query(**kwargs)
+        if only:
+            query = query.only(*self._only_fields(only))
+        return query
+
+    def _to_record(self, document):
+        document['id'] = document.pop('_id', None)
+        return ConnectionRecord(**dict((str(k), v)
+                                       for k, v in document.items()))
+
+    def find_connection_record(self, **kwargs):
+        document = self._query(**kwargs).as_pymongo().first()
+        return self._to_record(document) if document else None
+
+    def find_connection_records(self, **kwargs):
+        return [self._to_record(d) for d in self._query(**kwargs).as_pymongo()]
 
-    def find_connections(self, **kwargs):
-        return self._query(**kwargs)
+    def find_connections_page(self, after=None, limit=100, **kwargs):
+        query = self._query(**kwargs)
+        if after is not None:
+            query = query.filter(id__gt=after)
+        return query.order_by('+id').limit(limit)
+
+    def find_identities(self, identities):
+        identities = list(identities)
+        if not identities:
+            return set()
+        rows = self.connection_model.objects(
+            provider_user_id__in=list(set(i[1] for i in identities))).scalar(
+            'provider_id', 'provider_user_id')
+        return self._existing_identities(identities, rows)
+
+    def create_connections(self, values):
+        if not values:
+            return []
+        connections = [self.connection_model(**cv) for cv in values]
+        return self.connection_model.objects.insert(connections)
 
 
 class PeeweeConnectionDatastore(PeeweeDatastore, ConnectionDatastore):
@@ -96,21 +397,451 @@ class PeeweeConnectionDatastore(PeeweeDatastore, ConnectionDatastore):
         PeeweeDatastore.__init__(self, db)
         ConnectionDatastore.__init__(self, connection_model)
 
-    def _query(self, **kwargs):
+    def create_connection(self, **kwargs):
+        if 'user_id' in kwargs:
+            kwargs['user'] = kwargs.pop('user_id')
+        return self.put(self.connection_model(**kwargs))
+
+    def find_identities(self, identities):
+        identities = list(identities)
+        if not identities:
+            return set()
+        model = self.connection_model
+        rows = model.select(model.provider_id, model.provider_user_id).where(
+            model.provider_user_id << list(set(i[1] for i in identities)))
+        return self._existing_identities(identities, rows.tuples())
+
+    def create_connections(self, values):
+        with self.db.database.transaction():
+            return [self.create_connection(**cv) for cv in values]
+
+    def get_connection_values(self, connection):
+        rv = ConnectionDatastore.get_connection_values(self, connection)
+        rv['user_id'] = self.get_user_id(connection)
+        return rv
+
+    def get_user_id(self, connection):
+        # Read the raw foreign key rather than loading the user
+        return connection._data.get('user')
+
+    def _only_fields(self, only):
+        fields = self.connection_model._meta.fields
+        names = ['id'] + ['user' if n == 'user_id' else n for n in only
+                          if n != 'id']
+        return [fields[n] for n in names if n in fields]
+
+    def _select(self, only, **kwargs):
         if 'user_id' in kwargs:
             kwargs['user'] = kwargs.pop('user_id')
+        fields = self._only_fields(only) if only else ()
+        query = self.connection_model.select(*fields)
+        return query.filter(**kwargs) if kwargs else query
+
+    def put(self, model):
+        # Only the changed fields of a stored connection are written, so the
+        # fields a projected query did not load, which hold their defaults,
+        # are not written back
+        pk_field = model._meta.primary_key
+        if (model._get_pk_value() is not None and
+                pk_field.name not in model._dirty):
+            if model.is_dirty():
+                model.save(only=model.dirty_fields)
+            return model
+        return PeeweeDatastore.put(self, model)
+
+    def find_connection(self, only=None, **kwargs):
         try:
-            return self.connection_model.filter(**kwargs).get()
+            return self._select(only, **kwargs).get()
         except self.connection_model.DoesNotExist:
             return None
 
-    def create_connection(self, **kwargs):
+    def find_connections(self, only=None, **kwargs):
+        return self._select(only, **kwargs)
+
+    def _record_query(self, **kwargs):
         if 'user_id' in kwargs:
             kwargs['user'] = kwargs.pop('user_id')
-        return self.put(self.connection_model(**kwargs))
+        fields = self.connection_model._meta.fields
+        columns = [fields[n] for n in RECORD_FIELDS + ('user',) if n in fields]
+        query = self.connection_model.select(*columns)
+        if kwargs:
+            query = query.filter(**kwargs)
+        return query.dicts()
+
+    def _to_record(self, row):
+        row['user_id'] = row.pop('user', None)
+        return ConnectionRecord(**row)
+
+    def find_connection_record(self, **kwargs):
+        rows = list(self._record_query(**kwargs).limit(1))
+        return self._to_record(rows[0]) if rows else None
+
+    def find_connection_records(self, **kwargs):
+        return [self._to_record(row) for row in self._record_query(**kwargs)]
+
+    def find_connections_page(self, after=None, limit=100, **kwargs):
+        if 'user_id' in kwargs:
+            kwargs['user'] = kwargs.pop('user_id')
+        pk = self.connection_model.id
+        query = self.connection_model.select()
+        if kwargs:
+            query = query.filter(**kwargs)
+        if after is not None:
+            query = query.where(pk > after)
+        return query.order_by(pk).limit(limit)
+
+
+class ProviderDatastore(object):
+    """Abstracted datastore of the providers registered at runtime. Always
+    extend this class and implement parent methods.
+
+    The provider model needs a `provider_id` string, a nullable `tenant_id`
+    string, a `config` text field holding the provider config as JSON, an
+    `enabled` boolean and an integer `version`. The version counter is kept
+    in a row of its own, with the `provider_id` :data:`VERSION_COUNTER_ID`,
+    created on the first change.
+
+    :param provider_model: The provider model"""
+
+    def __init__(self, provider_model):
+        self.provider_model = provider_model
+
+    def find_provider(self, provider_id, tenant_id=None):
+        """Returns the stored provider for `provider_id` and `tenant_id`, or
+        `None`"""
+        raise NotImplementedError
+
+    def find_providers(self, after_version=0):
+        """Returns the providers changed after `after_version`, ordered by
+        version"""
+        raise NotImplementedError
+
+    def get_provider_version(self):
+        """Returns the version of the last change, or 0"""
+        raise NotImplementedError
+
+    def _bump_provider_version(self):
+        """Increments the version counter in a single statement and returns
+        the new version, or `None` if there is no counter row yet"""
+        raise NotImplementedError
+
+    def _next_provider_version(self):
+        version = self._bump_provider_version()
+        if version is None:
+            # Start from the versions stored before the counter row existed
+            version = self.get_provider_version() + 1
+            self.put(self.provider_model(provider_id=VERSION_COUNTER_ID,
+                                         enabled=False, version=version))
+        return version
+
+    def put_provider(self, provider_id, config=None, tenant_id=None,
+                     enabled=True):
+        """Creates or updates a stored provider and bumps the version counter.
+        A `config` of `None` keeps the stored config. The counter row stays
+        locked until the change is committed, so changes commit in version
+        order."""
+        provider = self.find_provider(provider_id, tenant_id)
+        if provider is None:
+            provider = self.provider_model(provider_id=provider_id,
+                                           tenant_id=tenant_id)
+        if config is not None:
+            provider.config = json.dumps(config)
+        provider.enabled = enabled
+        provider.version = self._next_provider_version()
+        return self.put(provider)
+
+
+class SQLAlchemyProviderDatastore(SQLAlchemyDatastore, ProviderDatastore):
+    """A SQLAlchemy provider datastore implementation for Flask-Social."""
+
+    def __init__(self, db, provider_model):
+        SQLAlchemyDatastore.__init__(self, db)
+        ProviderDatastore.__init__(self, provider_model)
+
+    def find_provider(self, provider_id, tenant_id=None):
+        return self.provider_model.query.filter_by(
+            provider_id=provider_id, tenant_id=tenant_id).first()
+
+    def find_providers(self, after_version=0):
+        model = self.provider_model
+        return model.query.filter(
+            model.version > after_version,
+            model.provider_id != VERSION_COUNTER_ID).order_by(
+            model.version).all()
+
+    def get_provider_version(self):
+        model = self.provider_model
+        query = self.db.session.query(model.version)
+        version = query.filter_by(provider_id=VERSION_COUNTER_ID).scalar()
+        if version is None:
+            version = self.db.session.query(
+                self.db.func.max(model.version)).scalar()
+        return version or 0
+
+    def _bump_provider_version(self):
+        model = self.provider_model
+        query = model.query.filter_by(provider_id=VERSION_COUNTER_ID)
+        if not query.update({model.version: model.version + 1},
+                            synchronize_session=False):
+            return None
+        return self.db.session.query(model.version).filter_by(
+            provider_id=VERSION_COUNTER_ID).scalar()
+
+
+class MongoEngineProviderDatastore(MongoEngineDatastore, ProviderDatastore):
+    """A MongoEngine provider datastore implementation for Flask-Social.
+
+    The counter is incremented atomically, but without transactions a
+    change is stored after its version is given. A change stored at the same
+    moment as another may only reach other workers with the next change."""
+
+    def __init__(self, db, provider_model):
+        MongoEngineDatastore.__init__(self, db)
+        ProviderDatastore.__init__(self, provider_model)
+
+    def find_provider(self, provider_id, tenant_id=None):
+        return self.provider_model.objects(provider_id=provider_id,
+                                           tenant_id=tenant_id).first()
+
+    def find_providers(self, after_version=0):
+        return list(self.provider_model.objects(
+            version__gt=after_version,
+            provider_id__ne=VERSION_COUNTER_ID).order_by('+version'))
+
+    def get_provider_version(self):
+        objects = self.provider_model.objects.only('version')
+        latest = objects(provider_id=VERSION_COUNTER_ID).first()
+        if latest is None:
+            latest = objects.order_by('-version').first()
+        return latest.version if latest else 0
+
+    def _bump_provider_version(self):
+        counter = self.provider_model._get_collection().find_and_modify(
+            {'provider_id': VERSION_COUNTER_ID}, {'$inc': {'version': 1}},
+            fields=['version'], new=True)
+        return counter['version'] if counter else None
+
+
+class PeeweeProviderDatastore(PeeweeDatastore, ProviderDatastore):
+    """A Peewee provider datastore implementation for Flask-Social."""
+
+    def __init__(self, db, provider_model):
+        PeeweeDatastore.__init__(self, db)
+        ProviderDatastore.__init__(self, provider_model)
+
+    def find_provider(self, provider_id, tenant_id=None):
+        model = self.provider_model
+        if tenant_id is None:
+            tenant = model.tenant_id >> None
+        else:
+            tenant = model.tenant_id == tenant_id
+        rows = list(model.select().where(
+            (model.provider_id == provider_id) & tenant).limit(1))
+        return rows[0] if rows else None
+
+    def find_providers(self, after_version=0):
+        model = self.provider_model
+        return list(model.select().where(
+            (model.version > after_version) &
+            (model.provider_id != VERSION_COUNTER_ID)).order_by(model.version))
+
+    def get_provider_version(self):
+        from peewee import fn
+        model = self.provider_model
+        version = model.select(model.version).where(
+            model.provider_id == VERSION_COUNTER_ID).scalar()
+        if version is None:
+            version = model.select(fn.Max(model.version)).scalar()
+        return version or 0
+
+    def put_provider(self, *args, **kwargs):
+        # Peewee commits each statement unless it runs in a transaction
+        with self.db.database.transaction():
+            return ProviderDatastore.put_provider(self, *args, **kwargs)
+
+    def _bump_provider_version(self):
+        model = self.provider_model
+        counter = model.provider_id == VERSION_COUNTER_ID
+        if not model.update(version=model.version + 1).where(
+                counter).execute():
+            return None
+        return model.select(model.version).where(counter).scalar()
+
+
+class SocialEdgeDatastore(object):
+    """Abstracted datastore of the social graph imported from providers.
+    Always extend this class and implement parent methods.
+
+    The edge model needs `provider_id`, `provider_user_id`, `kind` and
+    `target_user_id` strings and an integer `generation`. An edge records
+    that `target_user_id` is one of the `kind`, such as `followers`, of the
+    connected account `provider_user_id`. Every import stamps the edges it
+    sees with a new generation, so the edges it did not see can be removed
+    without holding the whole list in memory.
+
+    :param edge_model: The edge model"""
+
+    def __init__(self, edge_model):
+        self.edge_model = edge_model
+
+    def find_edges(self, **kwargs):
+        raise NotImplementedError
+
+    def count_edges(self, **kwargs):
+        raise NotImplementedError
+
+    def put_edges(self, provider_id, provider_user_id, kind, target_user_ids,
+                  generation):
+        """Stamps the stored edges to `target_user_ids` with `generation` and
+        inserts the missing ones in bulk. Returns the number of edges
+        inserted."""
+        raise NotImplementedError
+
+    def delete_stale_edges(self, provider_id, provider_user_id, kind,
+                           generation):
+        """Deletes the edges not stamped with `generation`. Returns the
+        number of edges deleted."""
+        raise NotImplementedError
+
+    def _new_edges(self, provider_id, provider_user_id, kind,
+                   target_user_ids, existing, generation):
+        seen = set(existing)
+        rows = []
+        for target_user_id in target_user_ids:
+            if target_user_id in seen:
+                continue
+            seen.add(target_user_id)
+            rows.append(dict(provider_id=provider_id,
+                             provider_user_id=provider_user_id, kind=kind,
+                             target_user_id=target_user_id,
+                             generation=generation))
+        return rows
+
+
+class SQLAlchemySocialEdgeDatastore(SQLAlchemyDatastore, SocialEdgeDatastore):
+    """A SQLAlchemy social edge datastore implementation for Flask-Social."""
+
+    def __init__(self, db, edge_model):
+        SQLAlchemyDatastore.__init__(self, db)
+        SocialEdgeDatastore.__init__(self, edge_model)
+
+    def find_edges(self, **kwargs):
+        return self.edge_model.query.filter_by(**kwargs)
+
+    def count_edges(self, **kwargs):
+        return self.find_edges(**kwargs).count()
+
+    def put_edges(self, provider_id, provider_user_id, kind, target_user_ids,
+                  generation):
+        if not target_user_ids:
+            return 0
+        model = self.edge_model
+        query = self.find_edges(
+            provider_id=provider_id, provider_user_id=provider_user_id,
+            kind=kind).filter(model.target_user_id.in_(target_user_ids))
+        existing = [row[0] for row in
+                    query.with_entities(model.target_user_id)]
+        if existing:
+            query.update(dict(generation=generation),
+                         synchronize_session=False)
+        rows = self._new_edges(provider_id, provider_user_id, kind,
+                               target_user_ids, existing, generation)
+        if rows:
+            self.db.session.execute(model.__table__.insert(), rows)
+        return len(rows)
+
+    def delete_stale_edges(self, provider_id, provider_user_id, kind,
+                           generation):
+        return self.find_edges(
+            provider_id=provider_id, provider_user_id=provider_user_id,
+            kind=kind).filter(self.edge_model.generation != generation).delete(
+            synchronize_session=False)
+
+
+class MongoEngineSocialEdgeDatastore(MongoEngineDatastore,
+                                     SocialEdgeDatastore):
+    """A MongoEngine social edge datastore implementation for
+    Flask-Social."""
+
+    def __init__(self, db, edge_model):
+        MongoEngineDatastore.__init__(self, db)
+        SocialEdgeDatastore.__init__(self, edge_model)
+
+    def find_edges(self, **kwargs):
+        return self.edge_model.objects(**kwargs)
+
+    def count_edges(self, **kwargs):
+        return self.find_edges(**kwargs).count()
+
+    def put_edges(self, provider_id, provider_user_id, kind, target_user_ids,
+                  generation):
+        if not target_user_ids:
+            return 0
+        query = self.find_edges(provider_id=provider_id,
+                                provider_user_id=provider_user_id, kind=kind,
+                                target_user_id__in=target_user_ids)
+        existing = query.distinct('target_user_id')
+        if existing:
+            query.update(set__generation=generation)
+        rows = self._new_edges(provider_id, provider_user_id, kind,
+                               target_user_ids, existing, generation)
+        if rows:
+            self.edge_model.objects.insert(
+                [self.edge_model(**row) for row in rows])
+        return len(rows)
+
+    def delete_stale_edges(self, provider_id, provider_user_id, kind,
+                           generation):
+        return self.find_edges(provider_id=provider_id,
+                               provider_user_id=provider_user_id, kind=kind,
+                               generation__ne=generation).delete()
+
+
+class PeeweeSocialEdgeDatastore(PeeweeDatastore, SocialEdgeDatastore):
+    """A Peewee social edge datastore implementation for Flask-Social."""
+
+    def __init__(self, db, edge_model):
+        PeeweeDatastore.__init__(self, db)
+        SocialEdgeDatastore.__init__(self, edge_model)
+
+    def _where(self, **kwargs):
+        model = self.edge_model
+        clause = None
+        for key, value in kwargs.items():
+            expr = getattr(model, key) == value
+            clause = expr if clause is None else clause & expr
+        return clause
+
+    def find_edges(self, **kwargs):
+        query = self.edge_model.select()
+        return query.where(self._where(**kwargs)) if kwargs else query
+
+    def count_edges(self, **kwargs):
+        return self.find_edges(**kwargs).count()
 
-    def find_connection(self, **kwargs):
-        return self._query(**kwargs)
+    def put_edges(self, provider_id, provider_user_id, kind, target_user_ids,
+                  generation):
+        if not target_user_ids:
+            return 0
+        model = self.edge_model
+        where = self._where(provider_id=provider_id,
+                            provider_user_id=provider_user_id, kind=kind)
+        where &= model.target_user_id << list(target_user_ids)
+        with self.db.database.transaction():
+            existing = [e.target_user_id for e in
+                        model.select(model.target_user_id).where(where)]
+            if existing:
+                model.update(generation=generation).where(where).execute()
+            rows = self._new_edges(provider_id, provider_user_id, kind,
+                                   target_user_ids, existing, generation)
+            if rows:
+                model.insert_many(rows).execute()
+        return len(rows)
 
-    def find_connections(self, **kwargs):
-        return self._query(**kwargs)
+    def delete_stale_edges(self, provider_id, provider_user_id, kind,
+                           generation):
+        model = self.edge_model
+        where = self._where(provider_id=provider_id,
+                            provider_user_id=provider_user_id, kind=kind)
+        return model.delete().where(
+            where & (model.generation != generation)).execute()
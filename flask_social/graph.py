@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.graph
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the streaming import of the followers and friends
+    of connected accounts
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import threading
+import time
+from importlib import import_module
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+from .ratelimit import RateLimitExceeded
+from .sync import Checkpoint, _chunks
+
+_social = LocalProxy(lambda: current_app.extensions['social'])
+
+_generation = dict(last=0, lock=threading.Lock())
+
+
+def _next_generation():
+    # Seconds fit 32 bit columns, and imports started within the same second
+    # by this process still get distinct generations
+    with _generation['lock']:
+        _generation['last'] = max(int(time.time()), _generation['last'] + 1)
+        return _generation['last']
+
+
+def get_edge_kinds(provider):
+    """Returns the kinds of edges, such as `followers` and `friends`, that
+    can be imported from `provider`"""
+    module = import_module(provider.module)
+    return getattr(module, 'EDGE_KINDS', ())
+
+
+def iter_edges(provider, connection, kind, cursor=None):
+    """Pages through the `kind` edges of a connected account, yielding the
+    provider user IDs of each page with the cursor of the next page, or
+    `None` after the last page. Calls go through the provider's rate limiter.
+
+    Provider modules support this by defining `EDGE_KINDS` and
+    `iter_edges(api, connection, kind, cursor=None)`.
+
+    :param provider: The provider of the connection
+    :param connection: The connection whose edges are paged through
+    :param kind: One of the provider's edge kinds
+    :param cursor: The cursor of the page to start at
+    """
+    if kind not in get_edge_kinds(provider):
+        raise ValueError('%s does not support %s' % (provider.name, kind))
+    module = import_module(provider.module)
+    return module.iter_edges(provider.get_api(connection), connection, kind,
+                             cursor)
+
+
+def _get_edge_datastore():
+    datastore = _social.edge_datastore
+    if datastore is None:
+        raise RuntimeError('Importing the social graph requires an edge '
+                           'datastore')
+    return datastore
+
+
+def _import_kind(provider, connection, kind, checkpoint, batch_size,
+                 progress, max_wait):
+    datastore = _get_edge_datastore()
+    owner = dict(provider_id=provider.id,
+                 provider_user_id=connection.provider_user_id, kind=kind)
+    key = '%s:%s:%s' % (provider.id, connection.provider_user_id, kind)
+
+    # An interrupted import resumes at its cursor with its generation
+    generation = checkpoint.get(key + ':generation')
+    cursor = None
+    if generation is None:
+        generation = _next_generation()
+    else:
+        cursor = checkpoint.get(key + ':cursor')
+    stats = dict(seen=0, created=0, removed=0)
+    waited = 0
+
+    while True:
+        try:
+            for target_user_ids, next_cursor in iter_edges(
+                    provider, connection, kind, cursor):
+                for chunk in _chunks(target_user_ids, batch_size):
+                    stats['created'] += datastore.put_edges(
+                        target_user_ids=chunk, generation=generation,
+                        **owner)
+                datastore.commit()
+                stats['seen'] += len(target_user_ids)
+                checkpoint.set(key + ':generation', generation)
+                if next_cursor is not None:
+                    checkpoint.set(key + ':cursor', next_cursor)
+                cursor = next_cursor
+                if progress is not None:
+                    progress(provider.id, kind, stats)
+            break
+        except RateLimitExceeded as e:
+            # Large accounts take many more pages than a rate limit window
+            # allows, so the import waits for the window and goes on from
+            # the last page read
+            if max_wait is not None and waited + e.retry_after > max_wait:
+                raise
+            current_app.logger.info('%s, resuming %s %s import of %s' % (
+                e, provider.name, kind, connection.provider_user_id))
+            time.sleep(e.retry_after)
+            waited += e.retry_after
+
+    stats['removed'] = datastore.delete_stale_edges(generation=generation,
+                                                    **owner)
+    datastore.commit()
+    checkpoint.remove(key + ':generation')
+    checkpoint.remove(key + ':cursor')
+    return stats
+
+
+def import_edges(provider, connection, kinds=None, checkpoint=None,
+                 batch_size=500, progress=None, max_wait=None):
+    """Streams the followers and friends of a connected account into the
+    edge datastore, one page at a time, so memory use does not grow with the
+    size of the account. Edges that are no longer listed by the provider are
+    removed once every page was read. Returns the stats of each kind.
+
+    :param provider: The provider of the connection
+    :param connection: The connection whose edges are imported
+    :param kinds: The kinds of edges to import. Defaults to all the provider
+                  supports
+    :param checkpoint: A :class:`~flask_social.sync.Checkpoint` recording the
+                       cursor of each kind after every committed page, so an
+                       interrupted import resumes where it stopped
+    :param batch_size: The maximum number of edges per insert
+    :param progress: An optional callable called with the provider ID, the
+                     kind and the stats after every page
+    :param max_wait: The maximum number of seconds to wait for the
+                     provider's rate limit per kind before
+                     :class:`~flask_social.ratelimit.RateLimitExceeded` is
+                     raised. `None` waits as long as needed
+    """
+    checkpoint = checkpoint or Checkpoint()
+    kinds = kinds or get_edge_kinds(provider)
+    return dict((kind, _import_kind(provider, connection, kind, checkpoint,
+                                    batch_size, progress, max_wait))
+                for kind in kinds)
+
+
+def import_graph(provider_ids=None, page_size=100, kinds=None, **kwargs):
+    """Imports the edges of every connection to each provider supporting
+    it. Connections are streamed from the datastore in pages. Returns the
+    stats of each provider. Accepts the same keyword arguments as
+    :func:`import_edges`. Each provider only imports the requested `kinds`
+    it supports, and providers supporting none of them are skipped.
+
+    :param provider_ids: The IDs of the providers to import. Defaults to all
+                         providers supporting it
+    :param page_size: The number of connections read per query
+    :param kinds: The kinds of edges to import. Defaults to all each provider
+                  supports
+    """
+    _get_edge_datastore()
+    providers = _social.providers
+    results = {}
+
+    for provider_id in provider_ids or sorted(providers):
+        provider = providers[provider_id]
+        provider_kinds = [kind for kind in get_edge_kinds(provider)
+                          if not kinds or kind in kinds]
+        if not provider_kinds:
+            continue
+        stats = results[provider_id] = dict(connections=0, seen=0,
+                                            created=0, removed=0)
+        for page in _social.datastore.iter_connections(
+                page_size=page_size, provider_id=provider_id):
+            for connection in page:
+                kind_results = import_edges(provider, connection,
+                                            kinds=provider_kinds, **kwargs)
+                stats['connections'] += 1
+                for kind_stats in kind_results.values():
+                    for key, value in kind_stats.items():
+                        stats[key] += value
+
+    return results
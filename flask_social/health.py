@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.health
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the provider health tracking behind the health
+    endpoint, fed by real callbacks and an optional background prober
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from importlib import import_module
+
+try:
+    from urllib2 import HTTPError, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+
+#: The latency percentiles reported for each provider
+PERCENTILES = (50, 95, 99)
+
+
+def _percentile(values, percentile):
+    # Nearest rank on sorted values
+    index = int(math.ceil(percentile / 100.0 * len(values))) - 1
+    return values[max(0, index)]
+
+
+class ProviderHealth(object):
+    """Keeps the outcome and latency of the most recent calls made to a
+    provider, whether made for real users or by the prober.
+
+    :param name: The name of the provider, usually its ID
+    :param window: The number of recent calls kept
+    """
+
+    def __init__(self, name, window=100):
+        self.name = name
+        self.samples = deque(maxlen=window)
+        self.last_success = None
+        self.last_failure = None
+        self.last_error = None
+        self.last_probe = None
+        self.last_token_exchange = None
+        self._lock = threading.Lock()
+
+    def record(self, latency, error=None, probe=False, token_exchange=False):
+        """Records the outcome of a call.
+
+        :param latency: The duration of the call in seconds
+        :param error: The exception raised by the call, if it failed
+        :param probe: `True` if the call was made by the prober
+        :param token_exchange: `True` if the call exchanged an OAuth token
+        """
+        now = time.time()
+        with self._lock:
+            self.samples.append((latency, error is None))
+            if probe:
+                self.last_probe = now
+            if error is None:
+                self.last_success = now
+                if token_exchange:
+                    self.last_token_exchange = now
+            else:
+                self.last_failure = now
+                self.last_error = '%s: %s' % (type(error).__name__, error)
+
+    def report(self, error_threshold=0.5):
+        """Returns a dictionary describing the health of the provider. Its
+        `status` is `unknown` before any call was recorded, and `down` once
+        the error rate reaches `error_threshold`."""
+        with self._lock:
+            samples = list(self.samples)
+            rv = dict(last_success=self.last_success,
+                      last_failure=self.last_failure,
+                      last_error=self.last_error,
+                      last_probe=self.last_probe,
+                      last_token_exchange=self.last_token_exchange)
+
+        errors = len([ok for latency, ok in samples if not ok])
+        latencies = sorted(latency for latency, ok in samples)
+        rv['samples'] = len(samples)
+        rv['error_rate'] = float(errors) / len(samples) if samples else None
+        rv['latency'] = dict(('p%d' % p, _percentile(latencies, p)
+                              if latencies else None) for p in PERCENTILES)
+        if not samples:
+            rv['status'] = 'unknown'
+        elif rv['error_rate'] >= error_threshold:
+            rv['status'] = 'down'
+        else:
+            rv['status'] = 'ok'
+        return rv
+
+
+def probe(provider, timeout):
+    """Checks that the token endpoint of `provider` answers. Any response
+    below 500 counts as healthy, since the request carries no credentials.
+    Provider modules may define a `probe(provider, timeout)` function to
+    replace this check."""
+    module = import_module(provider.module)
+    if hasattr(module, 'probe'):
+        return module.probe(provider, timeout)
+    try:
+        urlopen(provider.expand_url(provider.access_token_url),
+                timeout=timeout).close()
+    except HTTPError as e:
+        if e.code >= 500:
+            raise
+
+
+class HealthMonitor(object):
+    """Reports the health of every provider of an app. Reports are built
+    from the :class:`ProviderHealth` of each provider and cached, so serving
+    them never calls a provider.
+
+    :param registry: The app's :class:`~flask_social.core.ProviderRegistry`
+    :param interval: The number of seconds between background probes.
+                     `None` disables the prober
+    :param timeout: The timeout of each probe in seconds
+    :param cache_ttl: The number of seconds a report is cached
+    :param error_threshold: The error rate at which a provider is down
+    """
+
+    def __init__(self, registry, interval=None, timeout=5, cache_ttl=5,
+                 error_threshold=0.5):
+        self.registry = registry
+        self.interval = interval
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.error_threshold = error_threshold
+        self._report = None
+        self._expires = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def report(self):
+        """Returns the cached health of each provider, keyed by provider
+        ID"""
+        now = time.time()
+        with self._lock:
+            if self._report is None or now >= self._expires:
+                self._report = dict(
+                    (provider_id, provider.health.report(
+                        self.error_threshold))
+                    for provider_id, provider in
+                    self.registry.providers.items())
+                self._expires = now + self.cache_ttl
+            return self._report
+
+    def probe(self):
+        """Probes every provider once and records the outcomes"""
+        for provider in list(self.registry.providers.values()):
+            start, error = time.time(), None
+            try:
+                probe(provider, self.timeout)
+            except Exception as e:
+                error = e
+            provider.health.record(time.time() - start, error, probe=True)
+
+    def init_app(self, app):
+        """Starts the prober on the first request to `app`, so it runs in
+        the processes serving requests rather than in one that forks them"""
+        if self.interval is not None:
+            app.before_request(self._start_on_request)
+
+    def _start_on_request(self):
+        if self._thread is None and not self._stopped.is_set():
+            self.start()
+
+    def start(self):
+        """Starts probing providers every `interval` seconds in a daemon
+        thread"""
+        with self._lock:
+            if self.interval is None or self._thread is not None:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='flask-social-health')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.probe()
+            self._stopped.wait(self.interval)
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.httpcache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the cache of provider profile responses, revalidated
+    with conditional requests
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from urllib import urlencode
+    from urllib2 import HTTPError, Request, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.parse import urlencode
+    from urllib.request import Request, urlopen
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .utils import LRUCache, token_key
+
+
+class CachedResponse(object):
+    """A response body with the validators it was served with.
+
+    :param body: The raw response body
+    :param etag: The `ETag` header, if any
+    :param last_modified: The `Last-Modified` header, if any
+    :param value: The parsed body. Parsed from `body` when first read if
+                  omitted
+    """
+
+    def __init__(self, body, etag=None, last_modified=None, value=None):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self._value = value
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = json.loads(self.body)
+        return self._value
+
+    def headers(self):
+        """Returns the headers making a request conditional on this
+        response"""
+        rv = {}
+        if self.etag:
+            rv['If-None-Match'] = self.etag
+        if self.last_modified:
+            rv['If-Modified-Since'] = self.last_modified
+        return rv
+
+    def dumps(self):
+        return json.dumps(dict(body=self.body, etag=self.etag,
+                               last_modified=self.last_modified))
+
+    @classmethod
+    def loads(cls, data):
+        item = json.loads(data)
+        return cls(item['body'], item.get('etag'), item.get('last_modified'))
+
+
+class ResponseCache(object):
+    """Holds provider responses carrying an `ETag` or `Last-Modified`
+    header, keyed by a hash of the URL and the access token the response was
+    fetched with. Recent responses are kept in memory, parsed. With a
+    `path`, every response is also written to disk so it outlives the
+    process and is shared by every worker using the directory. Responses on
+    disk are removed once they were last fetched or revalidated more than
+    `max_age` seconds ago, and the oldest are removed once the directory
+    holds more than `max_disk_size` bytes of them. The directory is only
+    scanned for this once the process wrote a tenth of `max_disk_size` since
+    the last scan, or `evict_interval` seconds passed, so it may briefly
+    hold a tenth more for each process writing to it.
+
+    :param max_size: The maximum number of responses kept in memory
+    :param path: The directory of the on-disk tier. `None` disables it
+    :param max_disk_size: The maximum number of bytes of responses on disk
+    :param max_age: The number of seconds a response is kept on disk
+    """
+
+    #: The maximum number of seconds between two scans of the directory by a
+    #: process writing to it
+    evict_interval = 60
+
+    def __init__(self, max_size=1000, path=None,
+                 max_disk_size=10 * 1024 * 1024, max_age=7 * 24 * 60 * 60):
+        self.path = path
+        self.max_disk_size = max_disk_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self._memory = LRUCache(max_size)
+        self._lock = threading.Lock()
+        self._written = 0
+        self._next_evict = time.time() + self.evict_interval
+        if path is not None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._evict()
+
+    def _incr(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def key(self, url, access_token):
+        """Returns the cache key of `url` fetched with `access_token`"""
+        return hashlib.sha1(('%s %s' % (url, token_key(access_token)))
+                            .encode('utf-8')).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        """Returns the :class:`CachedResponse` stored under `key`, or
+        `None`"""
+        item = self._memory.get(key)
+        if item is not None or self.path is None:
+            return item
+        filename = self._filename(key)
+        try:
+            if os.stat(filename).st_mtime < time.time() - self.max_age:
+                return None
+            with open(filename) as f:
+                item = CachedResponse.loads(f.read())
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        self._memory.set(key, item)
+        return item
+
+    def set(self, key, item):
+        self._memory.set(key, item)
+        self._incr('stored')
+        if self.path is None:
+            return
+        # Written to a temporary file first so readers never see a partial
+        # response
+        data = item.dumps()
+        fd, filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.rename(filename, self._filename(key))
+        except (IOError, OSError):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return
+        now = time.time()
+        with self._lock:
+            self._written += len(data)
+            if (self._written * 10 < self.max_disk_size and
+                    now < self._next_evict):
+                return
+            self._written = 0
+            self._next_evict = now + self.evict_interval
+        self._evict()
+
+    def touch(self, key):
+        """Marks the response stored under `key` as revalidated, restarting
+        its age on disk"""
+        if self.path is None:
+            return
+        now = time.time()
+        try:
+            os.utime(self._filename(key), (now, now))
+        except OSError:
+            pass
+
+    @contextmanager
+    def _directory_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.path, '.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _evict(self):
+        # Responses by the time they were last written or revalidated
+        with self._directory_lock():
+            entries = []
+            for name in os.listdir(self.path):
+                if not name.endswith('.json'):
+                    continue
+                filename = os.path.join(self.path, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, filename, stat.st_size))
+            entries.sort()
+            expires = time.time() - self.max_age
+            size = sum(entry[2] for entry in entries)
+            evicted = 0
+            for mtime, filename, file_size in entries:
+                if mtime >= expires and size <= self.max_disk_size:
+                    break
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                size -= file_size
+                evicted += 1
+        with self._lock:
+            self.evicted += evicted
+
+    def delete(self, key):
+        self._memory.pop(key)
+        if self.path is not None:
+            try:
+                os.remove(self._filename(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        self._memory.clear()
+        if self.path is not None:
+            for name in os.listdir(self.path):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(self.path, name))
+
+    def stats(self):
+        """Returns a snapshot of the cache's counters"""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        stored=self.stored, evicted=self.evicted,
+                        responses=len(self._memory))
+
+    def get_json(self, url, access_token, params=None, timeout=None):
+        """Fetches the JSON document at `url` with `access_token` passed as
+        the `access_token` query parameter. When a response for the same URL
+        and token is cached, the request is made conditional and a `304 Not
+        Modified` answer returns the cached document without parsing it
+        again. Other HTTP errors are raised as `HTTPError`.
+
+        :param url: The URL of the document
+        :param access_token: The access token the document is fetched with
+        :param params: Other query parameters
+        :param timeout: The timeout of the request in seconds
+        """
+        query = dict(params or {})
+        key = self.key(url + '?' + urlencode(sorted(query.items())),
+                       access_token)
+        query['access_token'] = access_token
+        item = self.get(key)
+
+        request = Request(url + '?' + urlencode(query),
+                          headers=item.headers() if item else {})
+        try:
+            response = urlopen(request, timeout=timeout)
+        except HTTPError as e:
+            if e.code == 304 and item is not None:
+                self._incr('hits')
+                self.touch(key)
+                return item.value
+            raise
+        try:
+            body = response.read()
+            headers = response.info()
+            etag = headers.get('ETag')
+            last_modified = headers.get('Last-Modified')
+        finally:
+            response.close()
+
+        self._incr('misses')
+        if not isinstance(body, str):
+            body = body.decode('utf-8')
+        fresh = CachedResponse(body, etag, last_modified)
+        if etag or last_modified:
+            self.set(key, fresh)
+        elif item is not None:
+            self.delete(key)
+        return fresh.value
@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.identity
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the in-process caches of known provider identities
+    consulted before the datastore when logging in
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def _identity_key(provider_id, provider_user_id):
+    key = u'%s:%s' % (provider_id, provider_user_id)
+    return key.encode('utf-8')
+
+
+def _identity_hash(provider_id, provider_user_id):
+    digest = hashlib.md5(_identity_key(provider_id, provider_user_id))
+    # Zero marks an empty slot
+    return int(digest.hexdigest()[:16], 16) or 1
+
+
+class BloomFilter(object):
+    """A fixed size Bloom filter. Adding is thread safe, checking membership
+    takes no lock.
+
+    :param capacity: The number of items the filter is sized for
+    :param error_rate: The false positive rate wanted at `capacity` items
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        size = -self.capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.size = max(int(math.ceil(size)), 8)
+        self.hashes = max(int(round(float(self.size) / self.capacity *
+                                    math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        digest = hashlib.md5(key).hexdigest()
+        h1, h2 = int(digest[:16], 16), int(digest[16:], 16) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def estimated_error_rate(self):
+        """Returns the false positive rate expected for the number of items
+        added so far"""
+        exponent = -float(self.hashes) * self.count / self.size
+        return (1 - math.exp(exponent)) ** self.hashes
+
+
+class IdentityFilter(object):
+    """A Bloom filter of the `(provider_id, provider_user_id)` pairs of every
+    stored connection, so logins with an identity that has no connection can
+    be turned away without looking the identity up in the datastore.
+
+    The filter is built in a background thread on first use and rebuilt in
+    the background every `refresh_interval` seconds, which adds the
+    connections stored by other processes since. Such a connection may be
+    turned away until the rebuild after it is stored has finished, so for up
+    to about two intervals. Connections stored by this process are added
+    straight away. Until the filter is built, or once it has not been
+    rebuilt for three intervals because the datastore cannot be read, every
+    identity may exist so logins fall back to the datastore.
+
+    Removed connections cannot be taken out of a Bloom filter. They only cost
+    a datastore query until the next rebuild.
+
+    :param datastore: The connection datastore
+    :param capacity: The number of connections the filter is sized for. It
+                     is resized on rebuild once more connections are stored
+    :param error_rate: The false positive rate wanted at `capacity`
+    :param refresh_interval: The number of seconds between rebuilds
+    :param page_size: The number of connections read per query
+    :param context: A callable returning the context manager the background
+                    builds run in, such as `app.app_context`
+    """
+
+    #: The number of seconds before a failed build is retried
+    retry_interval = 30
+
+    def __init__(self, datastore, capacity=100000, error_rate=0.01,
+                 refresh_interval=60, page_size=1000, context=None):
+        self.datastore = datastore
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.page_size = page_size
+        self.context = context
+        self.builds = 0
+        self.last_build_at = None
+        self.last_build_seconds = None
+        self.last_error = None
+        self.checks = 0
+        self.skipped = 0
+        self.fallbacks = 0
+        self.false_positives = 0
+        self.removed = 0
+        self._filter = None
+        self._pending = None
+        # Every connection committed before this time is in the filter
+        self._current_at = 0
+        self._building = False
+        self._retry_at = 0
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def _stream(self, add):
+        for page in self.datastore.iter_connections(page_size=self.page_size):
+            for connection in page:
+                add(_identity_key(connection.provider_id,
+                                  connection.provider_user_id))
+
+    def rebuild(self):
+        """Builds a new filter by streaming every stored connection and swaps
+        it in. Connections added while it is being built are not lost."""
+        with self._build_lock:
+            start = time.time()
+            with self._lock:
+                self._pending = []
+            try:
+                capacity = self.capacity
+                if self._filter is not None:
+                    capacity = max(capacity, self._filter.count * 2)
+                bloom = BloomFilter(capacity, self.error_rate)
+                self._stream(bloom.add)
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                for key in self._pending:
+                    bloom.add(key)
+                self._pending = None
+                self._filter = bloom
+                self._current_at = start
+                self.capacity = capacity
+                self.removed = 0
+                self.builds += 1
+                self.last_build_at = time.time()
+                self.last_build_seconds = self.last_build_at - start
+                self.last_error = None
+
+    def _build(self):
+        try:
+            if self.context is None:
+                self.rebuild()
+            else:
+                with self.context():
+                    self.rebuild()
+        except Exception as e:
+            with self._lock:
+                self.last_error = repr(e)
+                self._retry_at = time.time() + self.retry_interval
+        finally:
+            self._building = False
+
+    def _build_in_background(self):
+        with self._lock:
+            if self._building or time.time() < self._retry_at:
+                return
+            self._building = True
+        thread = threading.Thread(target=self._build,
+                                  name='flask-social-identity-filter')
+        thread.daemon = True
+        thread.start()
+
+    def add(self, provider_id, provider_user_id):
+        """Records a new connection"""
+        key = _identity_key(provider_id, provider_user_id)
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(key)
+            if self._pending is not None:
+                self._pending.append(key)
+
+    def remove(self):
+        """Records that a connection was removed"""
+        with self._lock:
+            self.removed += 1
+
+    def might_contain(self, provider_id, provider_user_id):
+        """Returns `False` if no connection exists for the identity, and
+        `True` if one may exist or the filter is not available"""
+        now = time.time()
+        bloom = self._filter
+        fallback = (bloom is None or
+                    now >= self._current_at + 3 * self.refresh_interval)
+        found = fallback or _identity_key(provider_id,
+                                          provider_user_id) in bloom
+        if (bloom is None or now >= self._current_at + self.refresh_interval
+                or bloom.count > bloom.capacity):
+            self._build_in_background()
+        with self._lock:
+            self.checks += 1
+            if fallback:
+                self.fallbacks += 1
+            elif not found:
+                self.skipped += 1
+        return found
+
+    def record_false_positive(self):
+        """Records that an identity the filter may contain had no
+        connection"""
+        with self._lock:
+            self.false_positives += 1
+
+    def stats(self):
+        """Returns a snapshot of the filter's metrics"""
+        with self._lock:
+            return self._stats()
+
+    def _stats(self):
+        bloom = self._filter
+        negatives = self.skipped + self.false_positives
+        return dict(
+            builds=self.builds,
+            last_build_at=self.last_build_at,
+            last_build_seconds=self.last_build_seconds,
+            last_error=self.last_error,
+            items=bloom.count if bloom else 0,
+            capacity=bloom.capacity if bloom else self.capacity,
+            removed=self.removed,
+            checks=self.checks,
+            skipped=self.skipped,
+            fallbacks=self.fallbacks,
+            false_positives=self.false_positives,
+            estimated_error_rate=bloom.estimated_error_rate() if bloom else 0,
+            observed_error_rate=(float(self.false_positives) / negatives
+                                 if negatives else 0))
+
+
+_HEADER = struct.Struct('<4sIIQ')
+_HEADER_SIZE = 64
+_MAGIC = b'FSII'
+_FORMAT = 1
+
+# seq, generation, hash, the type and bytes of the connection and user IDs,
+# then a digest of the connection's tokens. An odd seq marks an entry being
+# written.
+_ENTRY = struct.Struct('<IIQB12sB12s6s')
+_SEQ = struct.Struct('<I')
+_INT = struct.Struct('<q')
+
+_EMPTY, _INTEGER, _OBJECT_ID = 0, 1, 2
+_NO_TOKENS = b'\0' * 6
+
+
+def _token_digest(tokens):
+    if tokens is None:
+        return _NO_TOKENS
+    key = u'%s\n%s' % (tokens[0] or u'', tokens[1] or u'')
+    digest = hashlib.md5(key.encode('utf-8')).digest()[:6]
+    return digest if digest != _NO_TOKENS else b'\1' + digest[1:]
+
+
+def _encode_id(value):
+    if isinstance(value, (int, long)):
+        return _INTEGER, _INT.pack(value)
+    binary = getattr(value, 'binary', None)
+    if isinstance(binary, bytes) and len(binary) == 12:
+        return _OBJECT_ID, binary
+    return None
+
+
+def _decode_id(kind, data):
+    if kind == _INTEGER:
+        return _INT.unpack(data[:8])[0]
+    if kind == _OBJECT_ID:
+        from bson import ObjectId
+        return ObjectId(data)
+    return None
+
+
+class SharedIdentityIndex(object):
+    """A fixed size hash table in a memory mapped file, mapping a hash of
+    `(provider_id, provider_user_id)` to the `(connection_id, user_id)` of
+    its connection and a digest of the connection's tokens. Every worker
+    process on a host that opens the same file shares the table, so a
+    connection looked up by one worker is found by the others.
+
+    Reads take no lock: each entry carries a sequence number that writers
+    make odd while they change it, and readers retry if it changed under
+    them. Writes are serialized with a lock on the file, taken through a
+    descriptor opened by each process, so workers forked after the table was
+    opened exclude each other too. The table never
+    grows. When the slots an identity may use are full, an older entry is
+    replaced, so a missing entry only means the datastore must be queried.
+    Integer and ObjectId IDs are supported.
+
+    Bumping the generation in the file header with :meth:`invalidate` empties
+    the table for every process at once.
+
+    :param path: The path of the file backing the table
+    :param slots: The number of entries the table holds
+    :param probes: The number of slots an identity may use
+    """
+
+    def __init__(self, path, slots=65536, probes=8):
+        self.path = path
+        self.slots = slots
+        self.probes = min(probes, slots)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        size = _HEADER_SIZE + slots * _ENTRY.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._pid = os.getpid()
+        self._mmap = None
+        with self._write_lock():
+            error = self._open(size)
+        if error is not None:
+            self.close()
+            raise ValueError('%s holds an identity index of another %s'
+                             % (path, error))
+
+    def _open(self, size):
+        current_size = os.fstat(self._fd).st_size
+        if current_size == 0:
+            os.ftruncate(self._fd, size)
+        elif current_size != size:
+            # Other processes may have it mapped, so it is not resized
+            return 'size'
+        self._mmap = mmap.mmap(self._fd, size)
+        magic, format = _HEADER.unpack_from(self._mmap)[:2]
+        if magic != _MAGIC:
+            _HEADER.pack_into(self._mmap, 0, _MAGIC, _FORMAT, self.slots, 1)
+        elif format != _FORMAT:
+            return 'format'
+        return None
+
+    def _lock_fd(self):
+        # A forked process shares the open file of its parent, and flock
+        # does not exclude holders of the same open file, so each process
+        # locks through its own
+        if self._pid != os.getpid():
+            os.close(self._fd)
+            self._fd = os.open(self.path, os.O_RDWR)
+            self._pid = os.getpid()
+        return self._fd
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock:
+            fd = self._lock_fd()
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+    @property
+    def generation(self):
+        return _HEADER.unpack_from(self._mmap, 0)[3]
+
+    def _offsets(self, key_hash):
+        start = key_hash % self.slots
+        for i in range(self.probes):
+            yield _HEADER_SIZE + ((start + i) % self.slots) * _ENTRY.size
+
+    def _read(self, offset):
+        for attempt in range(3):
+            entry = _ENTRY.unpack(self._mmap[offset:offset + _ENTRY.size])
+            if not entry[0] & 1 and \
+                    _SEQ.unpack_from(self._mmap, offset)[0] == entry[0]:
+                return entry
+        return None
+
+    def get(self, provider_id, provider_user_id, tokens=None):
+        """Returns the `(connection_id, user_id)` stored for the identity, or
+        `None`. With `tokens`, an entry stored with another token pair is not
+        returned either, so a hit means the stored tokens are current.
+
+        :param tokens: The `(access_token, secret)` pair of the connection
+        """
+        key_hash = _identity_hash(provider_id, provider_user_id)
+        generation = self.generation
+        for offset in self._offsets(key_hash):
+            entry = self._read(offset)
+            if entry is None:
+                continue
+            entry_generation, entry_hash = entry[1:3]
+            if entry_hash == 0:
+                break
+            if entry_hash == key_hash and entry_generation == generation:
+                if tokens is not None and entry[7] != _token_digest(tokens):
+                    break
+                self.hits += 1
+                return (_decode_id(entry[3], entry[4]),
+                        _decode_id(entry[5], entry[6]))
+        self.misses += 1
+        return None
+
+    def _write(self, offset, generation, key_hash, connection_id, user_id,
+               digest=_NO_TOKENS):
+        seq = _SEQ.unpack_from(self._mmap, offset)[0]
+        _SEQ.pack_into(self._mmap, offset, seq + 1)
+        _ENTRY.pack_into(self._mmap, offset, seq + 1, generation, key_hash,
+                         connection_id[0], connection_id[1], user_id[0],
+                         user_id[1], digest)
+        _SEQ.pack_into(self._mmap, offset, seq + 2)
+
+    def set(self, provider_id, provider_user_id, connection_id, user_id,
+            tokens=None):
+        """Stores the connection and user IDs for the identity, and a digest
+        of the connection's `(access_token, secret)` pair if given. Returns
+        `False` if the IDs are of an unsupported type."""
+        connection_id, user_id = _encode_id(connection_id), _encode_id(user_id)
+        if connection_id is None or user_id is None:
+            return False
+        key_hash = _identity_hash(provider_id, provider_user_id)
+        with self._write_lock():
+            generation = self.generation
+            offsets = list(self._offsets(key_hash))
+            target = offsets[0]
+            for offset in offsets:
+                entry = _ENTRY.unpack_from(self._mmap, offset)
+                if (entry[2] == key_hash or entry[2] == 0 or
+                        entry[1] != generation):
+                    target = offset
+                    break
+            self._write(target, generation, key_hash, connection_id, user_id,
+                        _token_digest(tokens))
+        return True
+
+    def delete(self, provider_id, provider_user_id):
+        """Removes the entry of the identity, if any"""
+        key_hash = _identity_hash(provider_id, provider_user_id)
+        empty = (_EMPTY, b'')
+        with self._write_lock():
+            for offset in self._offsets(key_hash):
+                if _ENTRY.unpack_from(self._mmap, offset)[2] == key_hash:
+                    # Keep probing past the slot by leaving a stale entry
+                    self._write(offset, 0, key_hash, empty, empty)
+
+    def invalidate(self):
+        """Empties the table for every process by bumping its generation"""
+        with self._write_lock():
+            magic, format, slots, generation = _HEADER.unpack_from(self._mmap)
+            _HEADER.pack_into(self._mmap, 0, magic, format, slots,
+                              generation + 1)
+
+    def populate(self, datastore, page_size=1000):
+        """Stores every connection of the datastore, or as many as fit.
+        Returns the number of connections stored. The table is otherwise
+        only filled as users log in, see the `populate-identity-index`
+        command."""
+        count = 0
+        for page in datastore.iter_connections(page_size=page_size):
+            for connection in page:
+                count += self.set(connection.provider_id,
+                                  connection.provider_user_id, connection.id,
+                                  datastore.get_user_id(connection),
+                                  (connection.access_token,
+                                   connection.secret))
+        return count
+
+    def stats(self):
+        """Returns the table's generation and this process's approximate hit
+        counters"""
+        return dict(slots=self.slots, generation=self.generation,
+                    hits=self.hits, misses=self.misses)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        os.close(self._fd)
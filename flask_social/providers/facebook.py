@@ -11,8 +11,14 @@
 
 from __future__ import absolute_import
 
+import json
+import urllib
+import urllib2
+
 import facebook
 
+from flask_social import resilience
+
 config = {
     'id': 'facebook',
     'name': 'Facebook',
@@ -28,25 +34,83 @@ config = {
 }
 
 
+def is_transient_error(error):
+    # The Graph API reports temporary failures as error codes 1 and 2
+    if isinstance(error, facebook.GraphAPIError):
+        result = getattr(error, 'result', None)
+        if not isinstance(result, dict):
+            return False
+        details = result.get('error')
+        if isinstance(details, dict):
+            return details.get('code') in (1, 2)
+        return result.get('error_code') in (1, 2)
+    return resilience.is_transient_error(error)
+
+
+#: The kinds of social graph edges that can be imported. The Graph API only
+#: lists the friends who use the app
+EDGE_KINDS = ('friends',)
+
+# The number of friends requested per page
+EDGE_PAGE_SIZE = 500
+
+
+def iter_edges(api, connection, kind, cursor=None):
+    """Yields the IDs of a page of friends with the cursor of the next
+    page"""
+    while True:
+        args = dict(limit=EDGE_PAGE_SIZE)
+        if cursor:
+            args['after'] = cursor
+        page = api.get_connections('me', kind, **args)
+        paging = page.get('paging') or {}
+        # The after cursor is set on the last page too, but next is not
+        cursor = None
+        if paging.get('next'):
+            cursor = paging.get('cursors', {}).get('after')
+        yield [friend['id'] for friend in page.get('data', [])], cursor
+        if cursor is None:
+            return
+
+
+def publish(api, payload):
+    post = dict(message=payload['message'])
+    if payload.get('link'):
+        post['link'] = payload['link']
+    return api.put_object('me', 'feed', **post)['id']
+
+
 def get_api(connection, **kwargs):
     return facebook.GraphAPI(getattr(connection, 'access_token'))
 
 
+def _get_profile(access_token, profile_cache=None, **kwargs):
+    """Fetches the profile of the token's user. With a
+    :class:`~flask_social.httpcache.ResponseCache`, the request is
+    revalidated with the profile's ETag"""
+    if profile_cache is None:
+        return facebook.GraphAPI(access_token).get_object('me')
+    try:
+        profile = profile_cache.get_json(config['base_url'] + 'me',
+                                         access_token)
+    except urllib2.HTTPError as e:
+        try:
+            result = json.loads(e.read())
+        except ValueError:
+            raise e
+        raise facebook.GraphAPIError(result)
+    if isinstance(profile, dict) and profile.get('error'):
+        raise facebook.GraphAPIError(profile)
+    return profile
+
+
 def get_provider_user_id(response, **kwargs):
     if response:
-        graph = facebook.GraphAPI(response['access_token'])
-        profile = graph.get_object("me")
-        return profile['id']
+        return _get_profile(response['access_token'], **kwargs)['id']
     return None
 
 
-def get_connection_values(response, **kwargs):
-    if not response:
-        return None
-
-    access_token = response['access_token']
-    graph = facebook.GraphAPI(access_token)
-    profile = graph.get_object("me")
+def _get_connection_values(access_token, profile):
     profile_url = "http://facebook.com/profile.php?id=%s" % profile['id']
     image_url = "http://graph.facebook.com/%s/picture" % profile['id']
 
@@ -62,6 +126,75 @@ def get_connection_values(response, **kwargs):
         email=profile.get('email', '')
     )
 
+
+def get_connection_values(response, **kwargs):
+    if not response:
+        return None
+
+    access_token = response['access_token']
+    profile = _get_profile(access_token, **kwargs)
+    return _get_connection_values(access_token, profile)
+
+
+# The maximum number of requests the Graph API accepts in a single batch
+BATCH_SIZE = 50
+
+
+def _get_profiles_batch(access_tokens, app_token):
+    batch = [dict(method='GET',
+                  relative_url='me?' + urllib.urlencode(
+                      dict(access_token=token)))
+             for token in access_tokens]
+    graph = facebook.GraphAPI(app_token)
+    results = graph.request('', post_args=dict(batch=json.dumps(batch)))
+
+    profiles = []
+    for result in results or []:
+        profile = None
+        if result and result.get('code') == 200:
+            try:
+                profile = json.loads(result['body'])
+            except (KeyError, TypeError, ValueError):
+                pass
+        profiles.append(profile)
+    # Facebook omits trailing results when a batch times out
+    profiles.extend([None] * (len(access_tokens) - len(profiles)))
+    return profiles
+
+
+def get_connection_values_batch(connections, **kwargs):
+    """Fetches fresh connection values for many connections using Graph API
+    batch requests, packing up to :data:`BATCH_SIZE` connections into each
+    HTTP call. Returns a list of connection values in the same order as
+    `connections`, holding `None` for each connection whose profile could not
+    be fetched, for instance because its token expired.
+
+    :param connections: The connections to refresh
+    :param consumer_key: The app ID, used for the batch's fallback token
+    :param consumer_secret: The app secret
+    """
+    app_token = None
+    if kwargs.get('consumer_key') and kwargs.get('consumer_secret'):
+        app_token = '%s|%s' % (kwargs['consumer_key'],
+                               kwargs['consumer_secret'])
+
+    access_tokens = [getattr(c, 'access_token') for c in connections]
+    rv = []
+    for i in range(0, len(access_tokens), BATCH_SIZE):
+        chunk = access_tokens[i:i + BATCH_SIZE]
+        profiles = _get_profiles_batch(chunk, app_token or chunk[0])
+        for access_token, profile in zip(chunk, profiles):
+            if profile is None or 'id' not in profile:
+                rv.append(None)
+            else:
+                rv.append(_get_connection_values(access_token, profile))
+    return rv
+
+
+def get_response_from_connection(connection):
+    return dict(access_token=getattr(connection, 'access_token'))
+
+
 def get_token_pair_from_response(response):
     return dict(
         access_token = response.get('access_token', None),
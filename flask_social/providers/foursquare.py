@@ -22,9 +22,27 @@ config = {
     'base_url': 'https://api.foursquare.com/v2/',
     'request_token_url': None,
     'access_token_url': 'https://foursquare.com/oauth2/access_token',
-    'authorize_url': 'https://foursquare.com/oauth2/authenticate',
+    'authorize_url': 'https://foursquare.com/oauth2/authenticate'
 }
 
+# The rate limit applied when `rate_limit` is enabled in the provider config
+RATE_LIMIT = {
+    'rate': 0.14,
+    'burst': 50,
+    'retry_after': 60
+}
+
+
+def get_rate_limit_status(api):
+    # Read from the X-RateLimit headers of the last response
+    if getattr(api, 'rate_remaining', None) is None:
+        return None
+    return dict(limit=api.rate_limit, remaining=api.rate_remaining)
+
+
+def is_rate_limit_error(error):
+    return isinstance(error, foursquare.RateLimitExceeded)
+
 
 def get_api(connection, **kwargs):
     return foursquare.Foursquare(
@@ -62,6 +80,11 @@ def get_connection_values(response, **kwargs):
         email=user.get('contact', {}).get('email', ''),
     )
 
+
+def get_response_from_connection(connection):
+    return dict(access_token=getattr(connection, 'access_token'))
+
+
 def get_token_pair_from_response(response):
     return dict(
         access_token = response.get('access_token', None),
@@ -81,6 +81,11 @@ def get_connection_values(response, **kwargs):
         email=profile.get('email'),
     )
 
+
+def get_response_from_connection(connection):
+    return dict(access_token=getattr(connection, 'access_token'))
+
+
 def get_token_pair_from_response(response):
     return dict(
         access_token = response.get('access_token', None),
@@ -73,6 +73,11 @@ def get_connection_values(response, **kwargs):
     )
 
 
+def get_response_from_connection(connection):
+    return dict(access_token=getattr(connection, 'access_token'),
+                expires_in=getattr(connection, 'expires_in', None))
+
+
 def get_token_pair_from_reponse(response):
     return dict(
         access_token=response.get('access_token', None),
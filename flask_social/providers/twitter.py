@@ -24,6 +24,59 @@ config = {
     'authorize_url': 'https://api.twitter.com/oauth/authenticate'
 }
 
+# The rate limit applied when `rate_limit` is enabled in the provider config
+RATE_LIMIT = {
+    'rate': 0.2,
+    'burst': 15,
+    'retry_after': 60
+}
+
+# Error code Twitter returns once a rate limit window is exhausted
+RATE_LIMIT_EXCEEDED = 88
+
+
+def is_rate_limit_error(error):
+    if not isinstance(error, twitter.TwitterError) or not error.args:
+        return False
+    errors = error.args[0]
+    if not isinstance(errors, list):
+        return False
+    return any(isinstance(e, dict) and e.get('code') == RATE_LIMIT_EXCEEDED
+               for e in errors)
+
+
+#: The kinds of social graph edges that can be imported
+EDGE_KINDS = ('followers', 'friends')
+
+# The maximum number of IDs Twitter returns per page
+EDGE_PAGE_SIZE = 5000
+
+
+def iter_edges(api, connection, kind, cursor=None):
+    """Yields the IDs of a page of followers or friends with the cursor of
+    the next page, using the paged methods of python-twitter 3.0 and up"""
+    if kind == 'followers':
+        method = api.GetFollowerIDsPaged
+    else:
+        method = api.GetFriendIDsPaged
+    cursor = cursor or -1
+    while True:
+        next_cursor, previous_cursor, ids = method(
+            user_id=connection.provider_user_id, cursor=cursor,
+            count=EDGE_PAGE_SIZE, stringify_ids=True)
+        # Twitter returns 0 after the last page
+        cursor = next_cursor or None
+        yield [str(i) for i in ids], cursor
+        if cursor is None:
+            return
+
+
+def publish(api, payload):
+    status = payload['message']
+    if payload.get('link'):
+        status = '%s %s' % (status, payload['link'])
+    return str(api.PostUpdate(status).id)
+
 
 def get_api(connection, **kwargs):
     return twitter.Api(consumer_key=kwargs.get('consumer_key'),
@@ -59,6 +112,12 @@ def get_connection_values(response=None, **kwargs):
         email='',
     )
 
+
+def get_response_from_connection(connection):
+    return dict(oauth_token=connection.access_token,
+                oauth_token_secret=connection.secret)
+
+
 def get_token_pair_from_response(response):
     return dict(
         access_token = response.get('oauth_token', None),
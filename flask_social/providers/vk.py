@@ -21,9 +21,62 @@ config = {
     'base_url': 'https://api.vk.com/method/',
     'request_token_url': None,
     'access_token_url': 'https://oauth.vk.com/access_token',
-    'authorize_url': 'https://oauth.vk.com/authorize',
+    'authorize_url': 'https://oauth.vk.com/authorize'
 }
 
+# The rate limit applied when `rate_limit` is enabled in the provider config
+RATE_LIMIT = {
+    'rate': 3,
+    'burst': 3,
+    'retry_after': 1
+}
+
+# Error code VK returns for too many requests per second
+TOO_MANY_REQUESTS = 6
+
+
+def is_rate_limit_error(error):
+    return (isinstance(error, vkontakte.VKError) and
+            error.code == TOO_MANY_REQUESTS)
+
+
+#: The kinds of social graph edges that can be imported
+EDGE_KINDS = ('followers', 'friends')
+
+# The maximum number of IDs VK returns per page of each kind
+EDGE_PAGE_SIZES = {'followers': 1000, 'friends': 5000}
+
+
+def iter_edges(api, connection, kind, cursor=None):
+    """Yields the IDs of a page of followers or friends with the offset of
+    the next page"""
+    if kind == 'followers':
+        method = api.users.getFollowers
+    else:
+        method = api.friends.get
+    count = EDGE_PAGE_SIZES[kind]
+    offset = int(cursor or 0)
+    while True:
+        result = method(user_id=connection.provider_user_id, offset=offset,
+                        count=count)
+        # Versions of the API before 5.0 return a bare list
+        if isinstance(result, dict):
+            ids, total = result.get('items', []), result.get('count')
+        else:
+            ids, total = result, None
+        offset += len(ids)
+        done = len(ids) < count or (total is not None and offset >= total)
+        yield [str(i) for i in ids], None if done else offset
+        if done:
+            return
+
+
+def publish(api, payload):
+    post = dict(message=payload['message'])
+    if payload.get('link'):
+        post['attachments'] = payload['link']
+    return str(api.wall.post(**post)['post_id'])
+
 
 def get_api(connection, **kwargs):
     return vkontakte.API(
@@ -61,6 +114,11 @@ def get_connection_values(response, **kwargs):
     )
 
 
+def get_response_from_connection(connection):
+    return dict(access_token=connection.access_token,
+                user_id=connection.provider_user_id)
+
+
 def get_token_pair_from_response(response):
     return dict(
         access_token=response.get('access_token', None),
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.publish
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the concurrent publishing of an update to the
+    providers a user is connected to
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import threading
+import time
+from importlib import import_module
+from multiprocessing.pool import ThreadPool
+
+try:
+    from Queue import Empty, Queue
+except ImportError:
+    from queue import Empty, Queue
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+from .signals import publish_completed
+
+_social = LocalProxy(lambda: current_app.extensions['social'])
+
+
+class PublishTimeout(Exception):
+    """Recorded as the error of a provider that did not answer in time. If
+    the post was `started`, it may still be made once the provider answers.
+    Otherwise every thread of the pool stayed busy for the whole timeout and
+    the post is never made.
+
+    :param name: The name of the provider
+    :param timeout: The number of seconds waited
+    :param started: Whether the post was sent to the provider
+    """
+
+    def __init__(self, name, timeout, started=True):
+        self.name = name
+        self.timeout = timeout
+        self.started = started
+        if started:
+            message = '%s did not answer within %.1fs' % (name, timeout)
+        else:
+            message = 'No thread was free to post to %s within %.1fs' % (
+                name, timeout)
+        Exception.__init__(self, message)
+
+
+class PublishResult(object):
+    """The outcome of publishing to a provider.
+
+    :param provider_id: The provider ID
+    :param value: The value returned by the provider module, usually the ID
+                  of the post
+    :param error: The exception raised, if publishing failed
+    :param elapsed: The number of seconds publishing took
+    """
+
+    def __init__(self, provider_id, value=None, error=None, elapsed=0):
+        self.provider_id = provider_id
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        outcome = self.value if self.ok else self.error
+        return '<PublishResult %s %r>' % (self.provider_id, outcome)
+
+
+class _PublishTask(object):
+
+    def __init__(self, provider, api, timeout):
+        self.provider = provider
+        self.api = api
+        self.timeout = timeout
+        self.queued_at = time.time()
+        self.started_at = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    @property
+    def deadline(self):
+        # Only counted from the start of the post once it started, as posts
+        # queue behind those of other calls
+        return (self.started_at or self.queued_at) + self.timeout
+
+    def start(self):
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.started_at = time.time()
+            return True
+
+    def cancel(self):
+        """Cancels the post unless it started. Returns whether it did."""
+        with self.lock:
+            self.cancelled = self.started_at is None
+            return self.cancelled
+
+
+class Publisher(object):
+    """Runs the posts of :func:`publish` on a bounded pool of threads shared
+    by every call. Threads are started on first use.
+
+    :param workers: The number of threads
+    :param timeout: The default number of seconds to wait for a provider
+    """
+
+    def __init__(self, workers=4, timeout=10):
+        self.workers = workers
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool
+
+    def _post(self, task, payload, done):
+        if not task.start():
+            return
+        provider = task.provider
+        module = import_module(provider.module)
+        value, error = None, None
+        try:
+            with provider.bulkhead:
+                value = module.publish(task.api, payload)
+        except Exception as e:
+            error = e
+        done.put(PublishResult(provider.id, value, error,
+                               time.time() - task.started_at))
+
+    def publish(self, user, payload, providers=None):
+        """Posts `payload` to each provider `user` is connected to, all at
+        once, and returns a :class:`PublishResult` for each provider ID. The
+        `publish_completed` signal is sent from the calling thread as each
+        provider answers or times out.
+
+        :param user: The user to publish for
+        :param payload: A dictionary with a `message` and, optionally, a
+                        `link`
+        :param providers: The IDs of the providers to publish to. Defaults to
+                          every connected provider that supports publishing
+        """
+        app = current_app._get_current_object()
+        connections = {}
+        for record in _social.datastore.find_connection_records(
+                user_id=user.id):
+            connections.setdefault(record.provider_id, record)
+
+        results, pending, done = {}, {}, Queue()
+        for provider_id in providers or sorted(connections):
+            provider = _social.registry.current(provider_id)
+            module = provider and import_module(provider.module)
+            if provider is None or not hasattr(module, 'publish'):
+                if providers:
+                    results[provider_id] = PublishResult(
+                        provider_id, error=ValueError(
+                            '%s does not support publishing' % provider_id))
+                continue
+            if provider_id not in connections:
+                results[provider_id] = PublishResult(
+                    provider_id, error=ValueError(
+                        'Not connected to %s' % provider.name))
+                continue
+            # API clients are built here, in the application context
+            try:
+                api = provider.get_api(connections[provider_id])
+            except Exception as e:
+                results[provider_id] = PublishResult(provider_id, error=e)
+                continue
+            task = _PublishTask(provider, api,
+                                provider.publish_timeout or self.timeout)
+            pending[provider_id] = task
+            self._get_pool().apply_async(self._post, (task, payload, done))
+
+        for result in results.values():
+            publish_completed.send(app, user=user, result=result)
+
+        while pending:
+            deadline = min(task.deadline for task in pending.values())
+            try:
+                result = done.get(timeout=max(0, deadline - time.time()))
+            except Empty:
+                now = time.time()
+                for provider_id, task in list(pending.items()):
+                    if task.deadline > now:
+                        continue
+                    if task.started_at is None and not task.cancel():
+                        # Started since its deadline was read
+                        continue
+                    del pending[provider_id]
+                    results[provider_id] = PublishResult(
+                        provider_id, error=PublishTimeout(
+                            task.provider.name, task.timeout,
+                            task.started_at is not None),
+                        elapsed=now - (task.started_at or task.queued_at))
+                    publish_completed.send(app, user=user,
+                                           result=results[provider_id])
+                continue
+            if result.provider_id not in pending:
+                # Answered after its timeout was reported
+                continue
+            del pending[result.provider_id]
+            results[result.provider_id] = result
+            publish_completed.send(app, user=user, result=result)
+
+        return results
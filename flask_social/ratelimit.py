@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.ratelimit
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the rate limit aware wrapper for provider API clients
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import threading
+import time
+
+from .resilience import TokenBucket
+from .utils import LRUCache
+
+
+class RateLimitExceeded(Exception):
+    """Raised instead of calling a provider when its rate limit is, or is
+    about to be, exhausted.
+
+    :param name: The name of the rate limiter, usually the provider ID
+    :param retry_after: The number of seconds to wait before trying again
+    """
+
+    def __init__(self, name, retry_after):
+        self.name = name
+        self.retry_after = retry_after
+        msg = '%s rate limit exceeded, retry after %.1fs' % (name, retry_after)
+        Exception.__init__(self, msg)
+
+
+class RateLimiter(object):
+    """Tracks the remaining quota of a provider per connection and per app.
+    Calls are throttled proactively with token buckets and blocked until the
+    quota resets once a provider reports it exhausted. A limiter belongs to a
+    provider and is shared by every thread using it.
+
+    :param name: The name of the limiter, usually the provider ID
+    :param rate: The number of calls per second allowed per connection
+    :param burst: The number of calls per connection that may be made in a
+                  burst. Defaults to `rate`
+    :param app_rate: The number of calls per second allowed for the whole app.
+                     `None` means unlimited
+    :param app_burst: The number of calls for the whole app that may be made
+                      in a burst. Defaults to `app_rate`
+    :param max_wait: The maximum number of seconds a call sleeps waiting for
+                     quota before :class:`RateLimitExceeded` is raised
+    :param retry_after: The number of seconds to block a connection after the
+                        provider rejected a call for exceeding its limit
+    :param max_connections: The maximum number of connections tracked
+    """
+
+    def __init__(self, name, rate=None, burst=None, app_rate=None,
+                 app_burst=None, max_wait=0, retry_after=60,
+                 max_connections=10000):
+        self.name = name
+        self.rate = rate
+        self.burst = burst or rate
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.app_bucket = None
+        if app_rate:
+            self.app_bucket = TokenBucket(app_rate, app_burst or app_rate)
+        self.throttled = 0
+        self.rejected = 0
+        self._app_quota = {}
+        self._connections = LRUCache(max_connections)
+        self._lock = threading.Lock()
+
+    def _get_connection(self, key):
+        def factory():
+            bucket = None
+            if self.rate:
+                bucket = TokenBucket(self.rate, self.burst)
+            return dict(bucket=bucket, quota={})
+        return self._connections.setdefault(key, factory)
+
+    def _wait_time(self, connection):
+        now = time.time()
+        waits = [0.0]
+        for quota in (connection['quota'], self._app_quota):
+            if quota.get('blocked_until', 0) > now:
+                waits.append(quota['blocked_until'] - now)
+        for bucket in (connection['bucket'], self.app_bucket):
+            if bucket is not None:
+                waits.append(bucket.wait_time())
+        return max(waits)
+
+    def _consume(self, connection):
+        bucket = connection['bucket']
+        if bucket is not None and not bucket.consume():
+            return False
+        if self.app_bucket is not None and not self.app_bucket.consume():
+            # The connection's token was not used, as no call is made
+            if bucket is not None:
+                bucket.refund()
+            return False
+        return True
+
+    def acquire(self, key):
+        """Waits until a call may be made for the connection identified by
+        `key`, raising :class:`RateLimitExceeded` if that would take longer
+        than `max_wait` seconds"""
+        connection = self._get_connection(key)
+        while True:
+            wait = self._wait_time(connection)
+            if wait > self.max_wait:
+                with self._lock:
+                    self.rejected += 1
+                raise RateLimitExceeded(self.name, wait)
+            if wait > 0:
+                with self._lock:
+                    self.throttled += 1
+                time.sleep(wait)
+            if self._consume(connection):
+                return
+
+    def update(self, key, limit=None, remaining=None, reset=None,
+               scope='connection'):
+        """Records the quota reported by the provider, usually read from
+        rate limit response headers.
+
+        :param key: The key of the connection the call was made for
+        :param limit: The size of the quota
+        :param remaining: The number of calls left in the quota
+        :param reset: The UNIX timestamp at which the quota resets
+        :param scope: `connection` or `app`, depending on which quota the
+                      provider reported
+        """
+        if scope == 'app':
+            quota = self._app_quota
+        else:
+            quota = self._get_connection(key)['quota']
+        with self._lock:
+            quota.update(limit=limit, remaining=remaining, reset=reset)
+            if remaining is not None and int(remaining) <= 0:
+                quota['blocked_until'] = (reset or
+                                          time.time() + self.retry_after)
+
+    def block(self, key, retry_after=None, scope='connection'):
+        """Blocks calls until `retry_after` seconds have passed, usually after
+        the provider rejected a call for exceeding its rate limit"""
+        if scope == 'app':
+            quota = self._app_quota
+        else:
+            quota = self._get_connection(key)['quota']
+        with self._lock:
+            retry_after = retry_after or self.retry_after
+            quota['blocked_until'] = time.time() + retry_after
+
+    def quota(self, key=None):
+        """Returns the last quota reported for a connection, or for the app
+        if `key` is `None`"""
+        if key is None:
+            return dict(self._app_quota)
+        return dict(self._get_connection(key)['quota'])
+
+    def stats(self):
+        """Returns a snapshot of the limiter's counters"""
+        with self._lock:
+            return dict(throttled=self.throttled, rejected=self.rejected,
+                        connections=len(self._connections),
+                        app_quota=dict(self._app_quota))
+
+
+class RateLimitedAPI(object):
+    """Wraps a provider API client so every call goes through the provider's
+    :class:`RateLimiter`. Attributes of the client are proxied, and callable
+    attributes such as endpoint objects are wrapped in turn.
+
+    The provider module may define two hooks:
+
+    * `get_rate_limit_status(api)` returns a dictionary with the `limit`,
+      `remaining`, `reset` and, optionally, `scope` of the quota after the
+      last call, or `None` if unknown
+    * `is_rate_limit_error(error)` returns `True` if the provider rejected a
+      call for exceeding its rate limit
+
+    The wrapper is not an instance of the client's class, so `isinstance`
+    checks should be made against :attr:`wrapped` instead.
+
+    :param api: The API client to wrap
+    :param limiter: The provider's :class:`RateLimiter`
+    :param key: The key identifying the connection the client was built for
+    :param module: The provider module
+    """
+
+    def __init__(self, api, limiter, key, module, _root=None):
+        self._api = api
+        self._limiter = limiter
+        self._key = key
+        self._module = module
+        self._root = _root if _root is not None else api
+
+    @property
+    def wrapped(self):
+        """The wrapped API client"""
+        return self._api
+
+    def __getattr__(self, name):
+        value = getattr(self._api, name)
+        if name.startswith('_') or not callable(value):
+            return value
+        return RateLimitedAPI(value, self._limiter, self._key, self._module,
+                              self._root)
+
+    def __call__(self, *args, **kwargs):
+        self._limiter.acquire(self._key)
+        try:
+            rv = self._api(*args, **kwargs)
+        except Exception as e:
+            is_rate_limit_error = getattr(self._module, 'is_rate_limit_error',
+                                          None)
+            if is_rate_limit_error is None or not is_rate_limit_error(e):
+                raise
+            self._limiter.block(self._key)
+            raise RateLimitExceeded(self._limiter.name,
+                                    self._limiter.retry_after)
+        get_status = getattr(self._module, 'get_rate_limit_status', None)
+        status = get_status(self._root) if get_status else None
+        if status:
+            self._limiter.update(self._key, **status)
+        return rv
+
+    def __repr__(self):
+        return '<RateLimitedAPI %r>' % self._api
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.resilience
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the primitives used to isolate and retry outbound
+    provider calls
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import random
+import socket
+import threading
+import time
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+
+class BulkheadFull(Exception):
+    """Raised when a call could not enter a provider's bulkhead before its
+    maximum wait elapsed.
+
+    :param name: The name of the bulkhead, usually the provider ID
+    :param limit: The concurrency limit of the bulkhead
+    :param timeout: The number of seconds the call waited
+    """
+
+    def __init__(self, name, limit, timeout):
+        self.name = name
+        self.limit = limit
+        self.timeout = timeout
+        msg = ('%s bulkhead is full (%s calls in flight, waited %ss)'
+               % (name, limit, timeout))
+        Exception.__init__(self, msg)
+
+
+class Bulkhead(object):
+    """Limits the number of concurrent calls made to a single provider so a
+    slow provider can only tie up its share of the worker threads. Calls over
+    the limit queue for at most `timeout` seconds before :class:`BulkheadFull`
+    is raised. Use it as a context manager::
+
+        with provider.bulkhead:
+            api.VerifyCredentials()
+
+    :param name: The name of the bulkhead, usually the provider ID
+    :param limit: The maximum number of calls in flight. `None` means
+                  unlimited
+    :param timeout: The maximum number of seconds to wait for a slot. `None`
+                    means wait forever
+    """
+
+    def __init__(self, name, limit=None, timeout=None):
+        self.name = name
+        self.limit = limit
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        with self._cond:
+            if self.limit is not None and self.in_flight >= self.limit:
+                self._wait()
+            self.in_flight += 1
+
+    def _wait(self):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        self.waiting += 1
+        try:
+            while self.in_flight >= self.limit:
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise BulkheadFull(self.name, self.limit, self.timeout)
+                self._cond.wait(remaining)
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def stats(self):
+        """Returns a snapshot of the bulkhead's counters"""
+        with self._cond:
+            return dict(limit=self.limit, timeout=self.timeout,
+                        in_flight=self.in_flight, waiting=self.waiting,
+                        rejected=self.rejected)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+
+class TokenBucket(object):
+    """A thread safe token bucket holding at most `capacity` tokens and
+    refilling at `rate` tokens per second.
+
+    :param rate: The number of tokens added per second
+    :param capacity: The maximum number of tokens in the bucket
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        elapsed = max(now - self._updated, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self._updated = now
+
+    def consume(self, tokens=1):
+        """Takes `tokens` from the bucket if available. Returns `True` on
+        success and `False` if the bucket does not hold enough tokens"""
+        with self._lock:
+            self._refill()
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def refund(self, tokens=1):
+        """Puts back `tokens` taken for a call that was not made"""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def wait_time(self, tokens=1):
+        """Returns the number of seconds until `tokens` are available"""
+        with self._lock:
+            self._refill()
+            missing = tokens - self.tokens
+            if missing <= 0:
+                return 0.0
+            if not self.rate:
+                return float('inf')
+            return missing / self.rate
+
+
+def _get_status_code(error):
+    for attr in ('status_code', 'status', 'code'):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    resp = getattr(error, 'resp', None) or getattr(error, 'response', None)
+    for attr in ('status_code', 'status'):
+        value = getattr(resp, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_transient_error(error):
+    """Returns `True` if `error` looks like a transient failure worth
+    retrying: a 5xx response, a connection reset or a timeout"""
+    status = _get_status_code(error)
+    if status is not None and 100 <= status < 600:
+        return status >= 500
+    if getattr(error, 'type', None) == 'invalid_response':
+        # Flask-OAuthlib raises an `OAuthException` without the status for
+        # any token endpoint response other than a 200 or 201. Only an OAuth
+        # 2 error code tells a refused grant from a failing provider
+        data = getattr(error, 'data', None)
+        return not (isinstance(data, dict) and 'error' in data)
+    return isinstance(error, (socket.error, IOError, httplib.HTTPException))
+
+
+class RetryPolicy(object):
+    """Retries idempotent provider calls that fail with a transient error,
+    sleeping a jittered exponential backoff between attempts. Every retry
+    spends a token from the provider's retry budget so retries cannot
+    amplify load on a provider that is down.
+
+    :param name: The name of the policy, usually the provider ID
+    :param max_attempts: The maximum number of attempts, including the first
+    :param base_delay: The backoff before the first retry, in seconds
+    :param max_delay: The maximum backoff, in seconds
+    :param budget_rate: The number of retries the budget regains per second
+    :param budget_capacity: The maximum number of retries that may be made in
+                            a burst
+    """
+
+    def __init__(self, name, max_attempts=3, base_delay=0.1, max_delay=2.0,
+                 budget_rate=0.5, budget_capacity=10):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = TokenBucket(budget_rate, budget_capacity)
+        self.retries = 0
+        self.budget_exhausted = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def _incr(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def backoff(self, attempt):
+        """Returns the number of seconds to sleep before retry `attempt`"""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    def call(self, func, is_transient=None):
+        """Calls `func` until it succeeds, fails with an error that is not
+        transient, runs out of attempts or exhausts the retry budget. The last
+        error is re-raised.
+
+        :param func: A callable taking no arguments
+        :param is_transient: A callable classifying errors. Defaults to
+                             :func:`is_transient_error`
+        """
+        is_transient = is_transient or is_transient_error
+        attempt = 1
+        while True:
+            try:
+                return func()
+            except Exception as e:
+                if attempt >= self.max_attempts or not is_transient(e):
+                    self._incr('failures')
+                    raise
+                if not self.budget.consume():
+                    self._incr('budget_exhausted')
+                    self._incr('failures')
+                    raise
+            self._incr('retries')
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    def stats(self):
+        """Returns a snapshot of the policy's counters"""
+        with self._lock:
+            return dict(retries=self.retries,
+                        budget_exhausted=self.budget_exhausted,
+                        failures=self.failures,
+                        budget=self.budget.tokens)
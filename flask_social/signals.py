@@ -22,3 +22,5 @@ connection_removed = signals.signal("connection-removed")
 login_failed = signals.signal("login-failed")
 
 login_completed = signals.signal("login-success")
+
+publish_completed = signals.signal("publish-completed")
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.sync
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the bulk profile sync used to refresh stored
+    connection profiles
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import itertools
+import json
+import os
+from importlib import import_module
+from multiprocessing.pool import ThreadPool
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+_social = LocalProxy(lambda: current_app.extensions['social'])
+
+#: The connection attributes refreshed from the provider's profile
+PROFILE_FIELDS = ('display_name', 'full_name', 'profile_url', 'image_url')
+
+
+def _json_id(value):
+    if isinstance(value, list):
+        return [_json_id(v) for v in value]
+    if not isinstance(value, (int, long)):
+        return str(value)
+    return value
+
+
+class Checkpoint(object):
+    """Remembers the primary key of the last connection synced for each
+    provider so an interrupted sync can resume where it stopped. Positions
+    are written to a JSON file after every committed page. A position may
+    also be a list of primary keys.
+
+    :param path: The path of the checkpoint file. `None` keeps positions in
+                 memory only
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.positions = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.positions = json.load(f).get('positions', {})
+
+    def get(self, provider_id):
+        return self.positions.get(provider_id)
+
+    def set(self, provider_id, after):
+        self.positions[provider_id] = _json_id(after)
+        self._save()
+
+    def remove(self, provider_id):
+        if self.positions.pop(provider_id, None) is not None:
+            self._save()
+
+    def _save(self):
+        if self.path:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(dict(positions=self.positions), f)
+            os.rename(tmp, self.path)
+
+    def clear(self):
+        self.positions = {}
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_profile_changes(connection, cv):
+    """Returns the profile fields of `connection` that differ from the
+    freshly fetched connection values `cv`"""
+    return dict((key, cv.get(key)) for key in PROFILE_FIELDS
+                if cv.get(key) != getattr(connection, key, None))
+
+
+def _fetch(provider, connections, logger):
+    try:
+        return provider.refresh_connection_values(connections)
+    except Exception:
+        logger.exception('Failed to refresh %s profiles' % provider.name)
+        return [None] * len(connections)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def sync_provider(provider, checkpoint=None, page_size=100, workers=4,
+                  dry_run=False, progress=None):
+    """Refreshes the stored profile of every connection to `provider`.
+    Connections are streamed from the datastore in pages, fetched on a pool
+    of at most `workers` threads and written back with one commit per page.
+    The checkpoint records the connections that could not be fetched, which
+    are retried first when an interrupted sync resumes, and is removed once
+    every connection was processed.
+
+    :param provider: The provider to sync
+    :param checkpoint: A :class:`Checkpoint` to resume from and update
+    :param page_size: The number of connections per page and commit
+    :param workers: The maximum number of concurrent calls to the provider
+    :param dry_run: Compute changes without writing them
+    :param progress: An optional callable called with the provider ID and the
+                     stats after every page
+    """
+    checkpoint = checkpoint or Checkpoint()
+    datastore = _social.datastore
+    # Worker threads run outside of the application context
+    logger = current_app.logger
+    module = import_module(provider.module)
+    chunk_size = getattr(module, 'BATCH_SIZE', 1)
+    stats = dict(processed=0, updated=0, failed=0)
+
+    failed_key = provider.id + ':failed'
+    retry = [datastore.find_connection(id=id, provider_id=provider.id)
+             for id in checkpoint.get(failed_key) or []]
+    retry = [connection for connection in retry if connection is not None]
+    failed = []
+
+    pool = ThreadPool(workers)
+    try:
+        pages = datastore.iter_connections(after=checkpoint.get(provider.id),
+                                           page_size=page_size,
+                                           provider_id=provider.id)
+        for page in itertools.chain([retry] if retry else [], pages):
+            chunks = list(_chunks(page, chunk_size))
+            results = pool.map(lambda chunk: _fetch(provider, chunk, logger),
+                               chunks)
+
+            changed = []
+            for chunk, values in zip(chunks, results):
+                for connection, cv in zip(chunk, values):
+                    stats['processed'] += 1
+                    if cv is None:
+                        stats['failed'] += 1
+                        failed.append(connection.id)
+                        continue
+                    changes = get_profile_changes(connection, cv)
+                    if changes:
+                        changed.append((connection, changes))
+            stats['updated'] += len(changed)
+
+            if not dry_run:
+                for connection, changes in changed:
+                    for key, value in changes.items():
+                        setattr(connection, key, value)
+                    datastore.put(connection)
+                datastore.commit()
+                checkpoint.set(failed_key, failed)
+                if page is not retry:
+                    checkpoint.set(provider.id, page[-1].id)
+
+            if progress is not None:
+                progress(provider.id, stats)
+    finally:
+        pool.close()
+        pool.join()
+
+    if not dry_run:
+        checkpoint.remove(provider.id)
+        checkpoint.remove(failed_key)
+    return stats
+
+
+def sync_profiles(provider_ids=None, **kwargs):
+    """Refreshes the stored profiles of connections to each provider in turn.
+    Returns the stats of each provider. Accepts the same keyword arguments as
+    :func:`sync_provider`.
+
+    :param provider_ids: The IDs of the providers to sync. Defaults to all
+    """
+    provider_ids = provider_ids or sorted(_social.providers.keys())
+    return dict((provider_id,
+                 sync_provider(_social.providers[provider_id], **kwargs))
+                for provider_id in provider_ids)
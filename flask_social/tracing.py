@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.tracing
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the span instrumentation of the views, provider calls
+    and datastore methods, and a minimal OpenTelemetry compatible tracer
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import binascii
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, has_app_context, request
+
+from .datastore import instrument
+from .ratelimit import RateLimitedAPI
+
+_local = threading.local()
+
+
+def _new_id(size):
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+
+class Span(object):
+    """A span recorded by :class:`Tracer`, with the subset of the
+    OpenTelemetry span API used by Flask-Social"""
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else _new_id(16)
+        self.span_id = _new_id(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = 'UNSET'
+        self.status_description = None
+        self.start_time = time.time()
+        self.end_time = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def add_event(self, name, attributes=None):
+        self.events.append((name, time.time(), dict(attributes or {})))
+
+    def record_exception(self, exception):
+        self.add_event('exception', {
+            'exception.type': type(exception).__name__,
+            'exception.message': str(exception)})
+
+    def set_status(self, status, description=None):
+        self.status = status
+        self.status_description = description
+
+    def end(self):
+        self.end_time = time.time()
+
+    @property
+    def duration(self):
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def __repr__(self):
+        return '<Span %s %s>' % (self.name, self.span_id)
+
+
+class InMemorySpanExporter(object):
+    """Keeps finished spans in memory, mostly for tests"""
+
+    def __init__(self):
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        with self._lock:
+            self._spans.extend(spans)
+
+    def get_finished_spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        with self._lock:
+            del self._spans[:]
+
+
+class Tracer(object):
+    """A minimal tracer handing every finished :class:`Span` to an
+    exporter. Any tracer with an OpenTelemetry compatible
+    `start_as_current_span` method, such as the one returned by
+    `opentelemetry.trace.get_tracer`, can be used instead.
+
+    :param exporter: An object with an `export(spans)` method
+    """
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter or InMemorySpanExporter()
+        self._local = threading.local()
+
+    def get_current_span(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        span = Span(name, self.get_current_span(), attributes)
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.record_exception(e)
+            span.set_status('ERROR', str(e))
+            raise
+        finally:
+            stack.pop()
+            span.end()
+            self.exporter.export([span])
+
+
+def _get_tracer():
+    if not has_app_context():
+        return None
+    state = current_app.extensions.get('social')
+    return getattr(state, 'tracer', None)
+
+
+@contextmanager
+def span(name, attributes=None):
+    """Runs a block in a child span of the current span, if the app has a
+    tracer"""
+    tracer = _get_tracer()
+    if tracer is None:
+        yield None
+        return
+    stack = _local.__dict__.setdefault('stack', [])
+    with tracer.start_as_current_span(name, attributes=attributes) as s:
+        stack.append(s)
+        try:
+            yield s
+        finally:
+            stack.pop()
+
+
+def _current_span():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def set_attribute(key, value):
+    """Sets an attribute on the current Flask-Social span, if any"""
+    current = _current_span()
+    if current is not None:
+        current.set_attribute(key, value)
+
+
+def add_event(name, attributes=None):
+    """Adds an event to the current Flask-Social span, if any"""
+    current = _current_span()
+    if current is not None:
+        current.add_event(name, attributes)
+
+
+def traced_view(view):
+    """Decorator running a blueprint view in a root span"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        attributes = {'http.method': request.method,
+                      'http.route': str(request.url_rule)}
+        if 'provider_id' in kwargs:
+            attributes['social.provider_id'] = kwargs['provider_id']
+        with span('social.%s' % view.__name__, attributes):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def _traced_method(name, method):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        with span('social.datastore.%s' % name):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def instrument_datastore(datastore):
+    """Runs every datastore method in a span"""
+    instrument(datastore, _traced_method)
+
+
+class TracedAPI(object):
+    """Wraps a provider API client so every call runs in a span named after
+    the attribute called, such as `social.api.GetFollowerIDsPaged`.
+    Attributes of the client are proxied, and callable attributes such as
+    endpoint objects are wrapped in turn.
+
+    The wrapper is not an instance of the client's class, so `isinstance`
+    checks should be made against :attr:`wrapped` instead.
+
+    :param api: The API client to wrap
+    :param provider_id: The ID of the provider the client calls
+    """
+
+    def __init__(self, api, provider_id, _name='social.api'):
+        self._api = api
+        self._provider_id = provider_id
+        self._name = _name
+
+    @property
+    def wrapped(self):
+        """The wrapped API client, unwrapped from its
+        :class:`~flask_social.ratelimit.RateLimitedAPI` if rate limited"""
+        if isinstance(self._api, RateLimitedAPI):
+            return self._api.wrapped
+        return self._api
+
+    def __getattr__(self, name):
+        value = getattr(self._api, name)
+        if name.startswith('_') or not callable(value):
+            return value
+        return TracedAPI(value, self._provider_id,
+                         '%s.%s' % (self._name, name))
+
+    def __call__(self, *args, **kwargs):
+        with span(self._name, {'social.provider_id': self._provider_id}):
+            return self._api(*args, **kwargs)
+
+    def __repr__(self):
+        return '<TracedAPI %r>' % self._api
+
+
+def _signal_receiver(signal):
+    def receiver(sender, **kwargs):
+        attributes = {}
+        provider_id = kwargs.get('provider_id')
+        for key, attr in (('provider', 'id'), ('connection', 'provider_id')):
+            provider_id = provider_id or getattr(kwargs.get(key), attr, None)
+        if provider_id is not None:
+            attributes['social.provider_id'] = provider_id
+        name = 'social.signal.%s' % signal.name.replace('-', '_')
+        add_event(name, attributes)
+    return receiver
+
+
+def trace_signals(app, signals):
+    """Adds an event to the current span whenever one of `signals` is sent
+    for `app`"""
+    for signal in signals:
+        signal.connect(_signal_receiver(signal), sender=app, weak=False)
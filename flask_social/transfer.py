@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.transfer
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the streaming export and import of connections used
+    to move them between datastore backends
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import json
+import time
+from itertools import islice
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_datastore = LocalProxy(lambda: current_app.extensions['social'].datastore)
+
+#: The supported serialization formats
+FORMATS = ('jsonl', 'msgpack')
+
+_JSON_TYPES = (basestring, int, long, float, bool, type(None))
+
+
+def _serialize(values):
+    # Backend specific types such as ObjectId are exported as strings
+    return dict((key, value if isinstance(value, _JSON_TYPES)
+                 else unicode(value)) for key, value in values.items())
+
+
+def _get_writer(f, format):
+    if format == 'jsonl':
+        return lambda values: f.write(json.dumps(values) + '\n')
+    if format == 'msgpack':
+        if msgpack is None:
+            raise RuntimeError('The msgpack format requires msgpack-python')
+        packer = msgpack.Packer(use_bin_type=True)
+        return lambda values: f.write(packer.pack(values))
+    raise ValueError('Unknown format %r' % format)
+
+
+def _iter_records(f, format):
+    if format == 'jsonl':
+        return (json.loads(line) for line in f if line.strip())
+    if format == 'msgpack':
+        if msgpack is None:
+            raise RuntimeError('The msgpack format requires msgpack-python')
+        return msgpack.Unpacker(f, raw=False)
+    raise ValueError('Unknown format %r' % format)
+
+
+def export_connections(f, format='jsonl', checkpoint=None, page_size=1000,
+                       progress=None, **kwargs):
+    """Streams the connections matching `kwargs` from the datastore to the
+    file `f`, one record per connection. Memory use is bounded by
+    `page_size`. Returns the number of connections exported.
+
+    :param f: A file opened for writing in binary mode
+    :param format: `jsonl` for JSON Lines or `msgpack`
+    :param checkpoint: A :class:`~flask_social.sync.Checkpoint` recording the
+                       last exported connection. Resuming appends to `f`.
+                       It is cleared once every connection was exported
+    :param page_size: The number of connections read per query
+    :param progress: An optional callable called with the number of
+                     connections exported and the elapsed seconds after
+                     every page
+    """
+    write = _get_writer(f, format)
+    after = checkpoint.get('export') if checkpoint else None
+    count, start = 0, time.time()
+
+    for page in _datastore.iter_connections(after=after, page_size=page_size,
+                                            **kwargs):
+        for connection in page:
+            write(_serialize(_datastore.get_connection_values(connection)))
+        f.flush()
+        count += len(page)
+        if checkpoint is not None:
+            checkpoint.set('export', page[-1].id)
+        if progress is not None:
+            progress(count, time.time() - start)
+
+    if checkpoint is not None:
+        checkpoint.remove('export')
+    return count
+
+
+def _import_batch(batch, user_id_map, stats):
+    # One query for the whole batch, and records repeated within the batch
+    # are only imported once
+    identities = [(cv['provider_id'], cv['provider_user_id']) for cv in batch]
+    seen = _datastore.find_identities(identities)
+    values = []
+    for cv, identity in zip(batch, identities):
+        if identity in seen:
+            stats['skipped'] += 1
+            continue
+        seen.add(identity)
+        if user_id_map is not None:
+            cv['user_id'] = user_id_map.get(unicode(cv.get('user_id')),
+                                            cv.get('user_id'))
+        values.append(cv)
+
+    _datastore.create_connections(values)
+    _datastore.commit()
+    stats['imported'] += len(values)
+
+
+def import_connections(f, format='jsonl', checkpoint=None, batch_size=500,
+                       user_id_map=None, progress=None):
+    """Streams connections from the file `f` into the datastore, committing
+    one transaction per batch. Connections that already exist are skipped, so
+    an interrupted import can safely be run again. Returns a dictionary with
+    the number of connections `imported` and `skipped`.
+
+    :param f: A file opened for reading in binary mode
+    :param format: `jsonl` for JSON Lines or `msgpack`
+    :param checkpoint: A :class:`~flask_social.sync.Checkpoint` recording the
+                       number of records committed. Resuming skips them
+                       without querying the datastore
+    :param batch_size: The number of connections per transaction
+    :param user_id_map: An optional mapping of exported user IDs, as strings,
+                        to the user IDs of the target datastore
+    :param progress: An optional callable called with the number of records
+                     processed and the elapsed seconds after every batch
+    """
+    offset = (checkpoint.get('import') if checkpoint else None) or 0
+    records = islice(_iter_records(f, format), offset, None)
+    stats = dict(imported=0, skipped=0)
+    count, start = offset, time.time()
+
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        _import_batch(batch, user_id_map, stats)
+        count += len(batch)
+        if checkpoint is not None:
+            checkpoint.set('import', count)
+        if progress is not None:
+            progress(count, time.time() - start)
+
+    return stats
@@ -8,45 +8,122 @@
     :copyright: (c) 2012 by Matt Wright.
     :license: MIT, see LICENSE for more details.
 """
+import binascii
 import collections
+import hashlib
+import hmac
+import os
+import threading
 
 from importlib import import_module
 
-from flask import current_app, url_for, request, abort
+from flask import current_app, url_for, request, abort, after_this_request
+from flask_oauthlib.client import OAuthException
+from itsdangerous import BadData, URLSafeTimedSerializer
 
 
 def get_provider_or_404(provider_id):
-    try:
-        return current_app.extensions['social'].providers[provider_id]
-    except KeyError:
+    provider = current_app.extensions['social'].registry.current(provider_id)
+    if provider is None:
         abort(404)
+    return provider
 
 
 def config_value(key, app=None):
     app = app or current_app
+    state = app.extensions.get('social')
+    if state is not None:
+        try:
+            return getattr(state.settings, key.lower())
+        except AttributeError:
+            pass
     return app.config['SOCIAL_' + key.upper()]
 
 
 def get_authorize_callback(endpoint, provider_id):
-    """Get a qualified URL for the provider to return to upon authorization
+    """Get a qualified URL for the provider to return to upon authorization.
+    URLs are cached per URL root, so each host an app is served under gets
+    its own callback URLs.
 
     param: endpoint: Absolute path to append to the application's host
     """
-    endpoint_prefix = config_value('BLUEPRINT_NAME')
-    url = url_for(endpoint_prefix + '.' + endpoint, provider_id=provider_id)
-    return request.url_root[:-1] + url
+    state = current_app.extensions['social']
+    urls = state.callback_urls.setdefault(request.url_root, dict)
+    try:
+        return urls[endpoint, provider_id]
+    except KeyError:
+        pass
+    url = url_for(state.settings.blueprint_name + '.' + endpoint,
+                  provider_id=provider_id)
+    url = urls[endpoint, provider_id] = request.url_root[:-1] + url
+    return url
 
 
-def get_connection_values_from_oauth_response(provider, oauth_response):
-    if oauth_response is None:
+def _get_state_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key,
+                                  salt='flask-social-oauth-state')
+
+
+def encode_oauth_state(provider_id, action, next_url):
+    """Returns a signed, compact OAuth `state` value carrying the URL to
+    redirect to after the OAuth flow, together with the random nonce it
+    embeds. The nonce is also stored in a short lived cookie so the callback
+    can check that it is completing a flow started by the same browser.
+
+    :param provider_id: The ID of the provider the flow is started with
+    :param action: `login` or `connect`
+    :param next_url: The URL to redirect to after the flow
+    """
+    settings = current_app.extensions['social'].settings
+    nonce = binascii.hexlify(os.urandom(8))
+    state = _get_state_serializer().dumps([provider_id, action, next_url,
+                                           nonce])
+
+    @after_this_request
+    def set_nonce_cookie(response):
+        response.set_cookie(settings.state_cookie_name, nonce,
+                            max_age=settings.state_max_age,
+                            path=request.script_root or '/',
+                            secure=request.is_secure, httponly=True)
+        return response
+
+    return state
+
+
+def decode_oauth_state(provider_id, action):
+    """Verifies the signed OAuth `state` of the current callback request and
+    returns the URL to redirect to, or `None` if the state is missing,
+    tampered with, expired or was issued for another flow or browser.
+
+    :param provider_id: The ID of the provider the callback is for
+    :param action: `login` or `connect`
+    """
+    settings = current_app.extensions['social'].settings
+    cookie_name = settings.state_cookie_name
+    try:
+        state_provider_id, state_action, next_url, nonce = \
+            _get_state_serializer().loads(request.args.get('state', ''),
+                                          max_age=settings.state_max_age)
+    except (BadData, TypeError, ValueError):
         return None
 
-    module = import_module(provider.module)
+    if (state_provider_id != provider_id or state_action != action or
+            request.cookies.get(cookie_name) != nonce):
+        return None
+
+    @after_this_request
+    def delete_nonce_cookie(response):
+        response.delete_cookie(cookie_name, path=request.script_root or '/')
+        return response
 
-    return module.get_connection_values(
-        oauth_response,
-        consumer_key=provider.consumer_key,
-        consumer_secret=provider.consumer_secret)
+    return next_url
+
+
+def get_connection_values_from_oauth_response(provider, oauth_response):
+    if oauth_response is None or isinstance(oauth_response, OAuthException):
+        return None
+
+    return provider.get_connection_values(oauth_response)
 
 def get_token_pair_from_oauth_response(provider, oauth_response):
     module = import_module(provider.module)
@@ -75,3 +152,95 @@ def update_recursive(d, u):
         else:
             d[k] = u[k]
     return d
+
+
+def token_key(access_token):
+    """Returns a short, stable key for an access token so tokens are not kept
+    around as dictionary keys in plain text"""
+    if isinstance(access_token, unicode):
+        access_token = access_token.encode('utf-8')
+    return hashlib.sha1(access_token or '').hexdigest()[:20]
+
+
+def get_avatar_digest(image_url):
+    """Returns the hash of `image_url`, keyed with the app's secret key, that
+    avatar URLs carry"""
+    key = current_app.secret_key
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return hmac.new(key, image_url.encode('utf-8'),
+                    hashlib.sha1).hexdigest()[:20]
+
+
+def get_avatar_url(connection):
+    """Returns the URL the avatar of `connection` is served at. It changes
+    with the connection's `image_url`, and cannot be made up for other
+    identities without the app's secret key.
+
+    :param connection: The connection, which needs an `image_url`
+    """
+    state = current_app.extensions['social']
+    return url_for(state.settings.blueprint_name + '.avatar',
+                   provider_id=connection.provider_id,
+                   provider_user_id=connection.provider_user_id,
+                   digest=get_avatar_digest(connection.image_url))
+
+
+class LRUCache(object):
+    """A thread safe mapping holding at most `max_size` items, evicting the
+    least recently used item first.
+
+    :param max_size: The maximum number of items to hold
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def setdefault(self, key, factory):
+        """Returns the item for `key`, storing the result of calling
+        `factory` first if it is missing"""
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                value = factory()
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -8,21 +8,26 @@
     :copyright: (c) 2012 by Matt Wright.
     :license: MIT, see LICENSE for more details.
 """
-from importlib import import_module
-
 from flask import (Blueprint, current_app, redirect, request, session,
-                   after_this_request, abort, url_for)
+                   after_this_request, jsonify, abort, send_file)
+from werkzeug.urls import url_encode
 from flask.ext.security import current_user, login_required
 from flask.ext.security.utils import (get_post_login_redirect, login_user,
                                       logout_user, get_url, do_flash)
 from flask.ext.security.decorators import anonymous_user_required
+from flask_oauthlib.client import OAuthException
 from werkzeug.local import LocalProxy
+from werkzeug.security import safe_str_cmp
 
+from .datastore import TOKEN_FIELDS
+from .resilience import BulkheadFull
 from .signals import (connection_removed, connection_created,
                       connection_failed, login_completed, login_failed)
-from .utils import (config_value, get_provider_or_404, get_authorize_callback,
+from .tracing import set_attribute, traced_view
+from .utils import (get_provider_or_404, get_authorize_callback,
                     get_connection_values_from_oauth_response,
-                    get_token_pair_from_oauth_response)
+                    get_token_pair_from_oauth_response, encode_oauth_state,
+                    decode_oauth_state, get_avatar_digest, get_avatar_url)
 
 
 # Convenient references
@@ -32,6 +37,8 @@ _social = LocalProxy(lambda: current_app.extensions['social'])
 
 _datastore = LocalProxy(lambda: _social.datastore)
 
+_settings = LocalProxy(lambda: _social.settings)
+
 _logger = LocalProxy(lambda: current_app.logger)
 
 
@@ -40,25 +47,44 @@ def _commit(response=None):
     return response
 
 
+def _authorize(provider, action, next_url):
+    """Starts the OAuth flow, remembering where to redirect to afterwards
+    either in the session or in a signed `state` parameter"""
+    callback_url = get_authorize_callback(action, provider.id)
+
+    if not _settings.stateless_state:
+        key = getattr(_settings, 'post_oauth_%s_session_key' % action)
+        session[key] = next_url
+        return provider.authorize(callback_url)
+
+    state = encode_oauth_state(provider.id, action, next_url)
+    if provider.request_token_url:
+        # OAuth 1.0a has no state parameter, but keeps callback parameters
+        return provider.authorize(callback_url + '?' +
+                                  url_encode(dict(state=state)))
+    return provider.authorize(callback_url, state=state)
+
+
+def _get_post_oauth_redirect(action, default):
+    key = getattr(_settings, 'post_oauth_%s_session_key' % action)
+    return session.pop(key, default)
+
+
 @anonymous_user_required
 def login(provider_id):
     """Starts the provider login OAuth flow"""
     provider = get_provider_or_404(provider_id)
-    callback_url = get_authorize_callback('login', provider_id)
     post_login = request.form.get('next', get_post_login_redirect())
-    session[config_value('POST_OAUTH_LOGIN_SESSION_KEY')] = post_login
-    return provider.authorize(callback_url)
+    return _authorize(provider, 'login', post_login)
 
 
 @login_required
 def connect(provider_id):
     """Starts the provider connection OAuth flow"""
     provider = get_provider_or_404(provider_id)
-    callback_url = get_authorize_callback('connect', provider_id)
-    allow_view = get_url(config_value('CONNECT_ALLOW_VIEW'))
+    allow_view = get_url(_settings.connect_allow_view)
     pc = request.form.get('next', allow_view)
-    session[config_value('POST_OAUTH_CONNECT_SESSION_KEY')] = pc
-    return provider.authorize(callback_url)
+    return _authorize(provider, 'connect', pc)
 
 
 @login_required
@@ -69,6 +95,19 @@ def reconnect(provider_id):
     logout_user()
     return login(provider_id)
 
+def _unindex_after_commit(provider_id, provider_user_ids):
+    """Drops removed connections from the shared identity index, whose
+    entries are not checked against the datastore on login"""
+    index = _social.identity_index
+
+    def unindex(response):
+        for provider_user_id in provider_user_ids:
+            index.delete(provider_id, provider_user_id)
+        return response
+
+    after_this_request(unindex)
+
+
 @login_required
 def remove_all_connections(provider_id):
     """Remove all connections for the authenticated user to the
@@ -78,10 +117,19 @@ def remove_all_connections(provider_id):
 
     ctx = dict(provider=provider.name, user=current_user)
 
+    provider_user_ids = []
+    if _social.identity_index is not None:
+        provider_user_ids = [r.provider_user_id for r in
+                             _datastore.find_connection_records(
+                                 user_id=current_user.get_id(),
+                                 provider_id=provider_id)]
+
     deleted = _datastore.delete_connections(user_id=current_user.get_id(),
                                             provider_id=provider_id)
     if deleted:
         after_this_request(_commit)
+        if provider_user_ids:
+            _unindex_after_commit(provider_id, provider_user_ids)
         msg = ('All connections to %s removed' % provider.name, 'info')
         connection_removed.send(current_app._get_current_object(),
                                 user=current_user._get_current_object(),
@@ -109,6 +157,8 @@ def remove_connection(provider_id, provider_user_id):
 
     if deleted:
         after_this_request(_commit)
+        if _social.identity_index is not None:
+            _unindex_after_commit(provider_id, [provider_user_id])
         msg = ('Connection to %(provider)s removed' % ctx, 'info')
         connection_removed.send(current_app._get_current_object(),
                                 user=current_user._get_current_object(),
@@ -120,14 +170,70 @@ def remove_connection(provider_id, provider_user_id):
     return redirect(request.referrer or get_post_login_redirect())
 
 
-def connect_handler(cv, provider):
+def health():
+    """Reports the health of each provider from cached observations of
+    real callbacks and background probes. Responds with a 503 status once
+    every provider with a known status is down. Error messages are left
+    out, as they may reveal internal details.
+    """
+    report = dict((provider_id, dict((k, v) for k, v in r.items()
+                                     if k != 'last_error'))
+                  for provider_id, r in _social.health.report().items())
+    known = [r['status'] for r in report.values() if r['status'] != 'unknown']
+    status = 'ok'
+    if 'down' in known:
+        status = 'down' if set(known) == set(['down']) else 'degraded'
+    rv = jsonify(status=status, providers=report)
+    rv.status_code = 503 if status == 'down' else 200
+    rv.headers['Cache-Control'] = 'no-cache'
+    return rv
+
+
+def avatar(provider_id, provider_user_id, digest):
+    """Serves the avatar of a connection from the avatar cache. Avatars not
+    cached yet are fetched in the background while the client is redirected
+    to the connection's `image_url`. The URL carries a keyed hash of the
+    `image_url`, so URLs not made by
+    :func:`~flask_social.utils.get_avatar_url` respond with a 404 whether or
+    not the identity is connected.
+    """
+    connection = _datastore.find_connection_record(
+        provider_id=provider_id, provider_user_id=provider_user_id)
+    if (connection is None or not connection.image_url or
+            not safe_str_cmp(digest, get_avatar_digest(connection.image_url))):
+        abort(404)
+
+    cached = _social.avatar_cache.get(connection.image_url)
+    rv = None
+    if cached is not None:
+        try:
+            rv = send_file(cached.path, mimetype=cached.mimetype,
+                           add_etags=False,
+                           cache_timeout=_settings.avatar_max_age)
+        except (IOError, OSError):
+            # Evicted by another worker sharing the cache directory
+            pass
+    if rv is None:
+        _social.avatar_cache.fill(connection.image_url)
+        rv = redirect(connection.image_url)
+        rv.headers['Cache-Control'] = 'no-cache'
+        return rv
+
+    rv.set_etag(cached.etag)
+    rv.cache_control.public = True
+    return rv.make_conditional(request)
+
+
+def connect_handler(cv, provider, redirect_url=None):
     """Shared method to handle the connection process
 
     :param connection_values: A dictionary containing the connection values
     :param provider_id: The provider ID the connection shoudl be made to
+    :param redirect_url: The URL to redirect to. Read from the session if
+                         `None`
     """
     cv.setdefault('user_id', current_user.get_id())
-    connection = _datastore.find_connection(
+    connection = _datastore.find_connection_record(
         provider_id=cv['provider_id'], provider_user_id=cv['provider_user_id'])
 
     if connection is None:
@@ -143,8 +249,9 @@ def connect_handler(cv, provider):
         connection_failed.send(current_app._get_current_object(),
                                user=current_user._get_current_object())
 
-    redirect_url = session.pop(config_value('POST_OAUTH_CONNECT_SESSION_KEY'),
-                               get_url(config_value('CONNECT_ALLOW_VIEW')))
+    if redirect_url is None:
+        redirect_url = _get_post_oauth_redirect(
+            'connect', get_url(_settings.connect_allow_view))
 
     do_flash(*msg)
     return redirect(redirect_url)
@@ -153,37 +260,107 @@ def connect_handler(cv, provider):
 def connect_callback(provider_id):
     provider = get_provider_or_404(provider_id)
 
+    redirect_url = None
+    if _settings.stateless_state:
+        redirect_url = decode_oauth_state(provider_id, 'connect')
+        if redirect_url is None:
+            do_flash('The connection request to %s is invalid or has '
+                     'expired' % provider.name, 'error')
+            return redirect(get_url(_settings.connect_deny_view))
+
     def connect(response):
         cv = get_connection_values_from_oauth_response(provider, response)
         return cv
 
-    cv = provider.authorized_handler(connect)()
+    try:
+        cv = provider.authorized_handler(connect)()
+    except BulkheadFull:
+        do_flash('%s is not responding, please try again later' %
+                 provider.name, 'error')
+        return redirect(get_url(_settings.connect_deny_view))
     if cv is None:
         do_flash('Access was denied by %s' % provider.name, 'error')
-        return redirect(get_url(config_value('CONNECT_DENY_VIEW')))
+        return redirect(get_url(_settings.connect_deny_view))
     if 'email' in cv.keys():
         del cv['email']
-    return connect_handler(cv, provider)
+    return connect_handler(cv, provider, redirect_url)
+
+
+def _store_tokens(connection, token_pair):
+    if (token_pair['access_token'] != connection.access_token or
+            token_pair['secret'] != connection.secret):
+        connection.access_token = token_pair['access_token']
+        connection.secret = token_pair['secret']
+        _datastore.put(connection)
+
+
+def _find_login_user(provider, response, query):
+    """Finds the user to log in and stores the new tokens of their
+    connection. With a shared identity index, the connection is only loaded
+    when it is not indexed or its tokens changed. Index hits are confirmed
+    against the connection's record, as the index is only kept up to date
+    by the views of its own host."""
+    token_pair = get_token_pair_from_oauth_response(provider, response)
+    tokens = (token_pair['access_token'], token_pair['secret'])
+    provider_id = query['provider_id']
+    provider_user_id = query['provider_user_id']
+    index = _social.identity_index
+    if index is not None:
+        ids = index.get(provider_id, provider_user_id, tokens)
+        record = ids and _datastore.find_connection_record(id=ids[0])
+        user = None
+        # Connections removed or reconnected to another account elsewhere
+        # are still in this host's index
+        if (record and record.provider_id == provider_id and
+                record.provider_user_id == provider_user_id and
+                record.user_id == ids[1]):
+            user = _security.datastore.find_user(id=record.user_id)
+        set_attribute('social.identity_index.hit', user is not None)
+        if user is not None:
+            after_this_request(_commit)
+            return user
+        if ids is not None:
+            index.delete(provider_id, provider_user_id)
+
+    connection = _datastore.find_connection(only=TOKEN_FIELDS, **query)
+    if connection is None:
+        return None
+    after_this_request(_commit)
+    _store_tokens(connection, token_pair)
+
+    if index is not None:
+        connection_id = connection.id
+        user_id = _datastore.get_user_id(connection)
+
+        def index_connection(response):
+            # Only once the new tokens are committed
+            index.set(provider_id, provider_user_id, connection_id, user_id,
+                      tokens)
+            return response
+
+        after_this_request(index_connection)
+    return connection.user
 
 
 @anonymous_user_required
-def login_handler(response, provider, query):
+def login_handler(response, provider, query, redirect_url=None):
     """Shared method to handle the signin process"""
 
-    connection = _datastore.find_connection(**query)
-
-    if connection:
-        after_this_request(_commit)
-        token_pair = get_token_pair_from_oauth_response(provider, response)
-        if (token_pair['access_token'] != connection.access_token or
-            token_pair['secret'] != connection.secret):
-            connection.access_token = token_pair['access_token']
-            connection.secret = token_pair['secret']
-            _datastore.put(connection)
-        user = connection.user
+    user = None
+    identity_filter = _social.identity_filter
+    if identity_filter is None or identity_filter.might_contain(
+            query['provider_id'], query['provider_user_id']):
+        user = _find_login_user(provider, response, query)
+        if user is None and identity_filter is not None:
+            identity_filter.record_false_positive()
+    elif identity_filter is not None:
+        set_attribute('social.identity_filter.skipped', True)
+
+    if user:
         login_user(user)
-        key = _social.post_oauth_login_session_key
-        redirect_url = session.pop(key, get_post_login_redirect())
+        if redirect_url is None:
+            redirect_url = _get_post_oauth_redirect('login',
+                                                    get_post_login_redirect())
 
         login_completed.send(current_app._get_current_object(),
                              provider=provider, user=user)
@@ -201,30 +378,40 @@ def login_handler(response, provider, query):
 
 
 def login_callback(provider_id):
-    try:
-        provider = _social.providers[provider_id]
-        module = import_module(provider.module)
-    except KeyError:
-        abort(404)
+    provider = get_provider_or_404(provider_id)
+
+    redirect_url = None
+    if _settings.stateless_state:
+        redirect_url = decode_oauth_state(provider_id, 'login')
+        if redirect_url is None:
+            do_flash('The login request to %s is invalid or has '
+                     'expired' % provider.name, 'error')
+            return _security.login_manager.unauthorized()
 
     def login(response):
         _logger.debug('Received login response from '
                       '%s: %s' % (provider.name, response))
 
-        if response is None:
+        # Flask-OAuthlib passes failed token exchanges as an exception
+        if response is None or isinstance(response, OAuthException):
             do_flash('Access was denied to your %s '
                      'account' % provider.name, 'error')
             return _security.login_manager.unauthorized(), None
 
-        query = dict(provider_user_id=module.get_provider_user_id(response),
+        query = dict(provider_user_id=provider.get_provider_user_id(response),
                      provider_id=provider_id)
 
         return response, query
 
-    response, query = provider.authorized_handler(login)()
+    try:
+        response, query = provider.authorized_handler(login)()
+    except BulkheadFull:
+        do_flash('%s is not responding, please try again later' %
+                 provider.name, 'error')
+        return _security.login_manager.unauthorized()
     if query is None:
         return response
-    return login_handler(response, provider, query)
+    return login_handler(response, provider, query, redirect_url)
 
 
 def create_blueprint(state, import_name):
@@ -232,23 +419,36 @@ def create_blueprint(state, import_name):
                    url_prefix=state.url_prefix,
                    template_folder='templates')
 
-    bp.route('/login/<provider_id>')(login_callback)
+    def route(rule, **options):
+        def decorator(view):
+            if state.tracer is not None:
+                view = traced_view(view)
+            return bp.route(rule, **options)(view)
+        return decorator
+
+    route('/login/<provider_id>')(login_callback)
+
+    route('/login/<provider_id>',
+          methods=['POST'])(login)
+
+    route('/connect/<provider_id>')(connect_callback)
 
-    bp.route('/login/<provider_id>',
-             methods=['POST'])(login)
+    route('/connect/<provider_id>',
+          methods=['POST'])(connect)
 
-    bp.route('/connect/<provider_id>')(connect_callback)
+    route('/connect/<provider_id>',
+          methods=['DELETE'])(remove_all_connections)
 
-    bp.route('/connect/<provider_id>',
-             methods=['POST'])(connect)
+    route('/connect/<provider_id>/<provider_user_id>',
+          methods=['DELETE'])(remove_connection)
 
-    bp.route('/connect/<provider_id>',
-             methods=['DELETE'])(remove_all_connections)
+    route('/reconnect/<provider_id>',
+          methods=['POST'])(reconnect)
 
-    bp.route('/connect/<provider_id>/<provider_user_id>',
-             methods=['DELETE'])(remove_connection)
+    route('/health')(health)
 
-    bp.route('/reconnect/<provider_id>',
-             methods=['POST'])(reconnect)
+    if state.avatar_cache is not None:
+        route('/avatar/<provider_id>/<provider_user_id>/<digest>')(avatar)
+        bp.add_app_template_global(get_avatar_url, 'social_avatar_url')
 
     return bp
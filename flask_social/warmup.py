@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.social.warmup
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the pool of provider API clients built ahead of use
+    when a user logs in
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import threading
+import time
+from importlib import import_module
+
+try:
+    from Queue import Full, Queue
+except ImportError:
+    from queue import Full, Queue
+
+from .utils import LRUCache, token_key
+
+
+def _client_key(provider, connection):
+    return (provider.id, provider.consumer_key,
+            token_key(connection.access_token))
+
+
+class ClientPool(object):
+    """Holds provider API clients built in a background thread until the
+    first `get_api()` call for their connection takes them. Each client is
+    handed out once, so clients never need to be thread safe.
+
+    Provider modules may define `warm_api(api)`, called after the client is
+    built, to open its HTTP connection ahead of the first real call.
+
+    :param max_size: The maximum number of clients held
+    :param ttl: The number of seconds a client is held before it is dropped
+    :param queue_size: The maximum number of logins waiting to be warmed up.
+                       Logins arriving while the queue is full are skipped
+    """
+
+    def __init__(self, max_size=1000, ttl=60, queue_size=100):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.built = 0
+        self.skipped = 0
+        self.failed = 0
+        self._clients = LRUCache(max_size)
+        self._queue = Queue(queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _incr(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def warm(self, connections):
+        """Queues the building of a client for each `(provider, connection)`
+        pair. Returns `False` if the queue is full."""
+        if not connections:
+            return True
+        self._start()
+        try:
+            self._queue.put_nowait(connections)
+        except Full:
+            self._incr('skipped')
+            return False
+        return True
+
+    def take(self, provider, connection):
+        """Returns the pooled client for `connection`, removing it from the
+        pool, or `None`"""
+        item = self._clients.pop(_client_key(provider, connection))
+        if item is None or item[1] < time.time():
+            self._incr('misses')
+            return None
+        self._incr('hits')
+        return item[0]
+
+    def build(self, provider, connection):
+        """Builds and pools the client for `connection`"""
+        module = import_module(provider.module)
+        api = module.get_api(connection=connection,
+                             consumer_key=provider.consumer_key,
+                             consumer_secret=provider.consumer_secret)
+        if hasattr(module, 'warm_api'):
+            module.warm_api(api)
+        self._clients.set(_client_key(provider, connection),
+                          (api, time.time() + self.ttl))
+        self._incr('built')
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='flask-social-warmup')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            connections = self._queue.get()
+            for provider, connection in connections:
+                try:
+                    self.build(provider, connection)
+                except Exception:
+                    self._incr('failed')
+            self._queue.task_done()
+
+    def join(self):
+        """Waits until every queued login is warmed up"""
+        self._queue.join()
+
+    def stats(self):
+        """Returns a snapshot of the pool's counters"""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, built=self.built,
+                        skipped=self.skipped, failed=self.failed,
+                        clients=len(self._clients))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    bench-lookups
+    ~~~~~~~~~~~~~
+
+    Times the SQLAlchemy datastore's connection lookups on the hot paths:
+    the login lookup by provider user ID, the read only record lookup and
+    the `get_api` lookup by user ID. Uses the SQLAlchemy test app on an in
+    memory SQLite database. Run it from the repository root::
+
+        $ python scripts/bench_lookups.py
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask_social.datastore import TOKEN_FIELDS
+from tests.test_app.sqlalchemy import create_app
+
+CALLS = 2000
+REPEAT = 5
+
+
+def main():
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'}, False)
+    app.config['TESTING'] = True
+    # The test app creates its tables and users on the first request
+    app.test_client().get('/')
+
+    with app.app_context():
+        datastore = app.social.datastore
+        user = app.security.datastore.find_user(email='matt@lp.com')
+        user_id = user.id
+        datastore.create_connection(
+            user_id=user_id, provider_id='twitter', provider_user_id='1234',
+            access_token='token', secret='secret', display_name='display',
+            full_name='full', profile_url='profile', image_url='image',
+            rank=1)
+        datastore.commit()
+
+        def login():
+            datastore.find_connection(only=TOKEN_FIELDS, provider_id='twitter',
+                                      provider_user_id='1234')
+            datastore.db.session.expunge_all()
+
+        def record():
+            datastore.find_connection_record(provider_id='twitter',
+                                             provider_user_id='1234')
+
+        def get_api():
+            datastore.find_connection(only=TOKEN_FIELDS, provider_id='twitter',
+                                      user_id=user_id)
+            datastore.db.session.expunge_all()
+
+        for name, func in (('login lookup', login),
+                           ('record lookup', record),
+                           ('get_api lookup', get_api)):
+            func()
+            best = min(timeit.repeat(func, number=CALLS, repeat=REPEAT))
+            print('%-16s %6.1f us/call' % (name, best / CALLS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,29 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import urlparse
 import mock
+from flask import request
+from flask_oauthlib.client import OAuthException
+from flask_social.publish import Publisher, PublishTimeout
+from flask_social.callcount import assert_max_calls
+from flask_social.ratelimit import RateLimitExceeded
+from flask_social.resilience import BulkheadFull
+from flask_social.signals import publish_completed
+from flask_social.tracing import InMemorySpanExporter, Tracer
 from tests.test_app.sqlalchemy import create_app as create_sql_app
 from tests.test_app.mongoengine import create_app as create_mongo_app
 from tests.test_app.peewee_app import create_app as create_peewee_app
+from flask_social.datastore import TOKEN_FIELDS
+from flask_social.graph import import_graph
+from flask_social.sync import Checkpoint, sync_profiles
+from flask_social.transfer import export_connections, import_connections
+from flask_social.utils import get_avatar_url
 
 def get_mock_twitter_response():
     return {
@@ -274,9 +295,1083 @@ class TwitterSocialTests(SocialTest):
         r = self.client.delete('/connect/twitter/1234', follow_redirects=True)
         self.assertIn('Connection to Twitter removed', r.data)
 
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_sync_profiles(self,
+                           mock_authorize,
+                           mock_handle_oauth1_response,
+                           mock_get_connection_values):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+
+        cv = get_mock_twitter_connection_values()
+        cv['display_name'] = '@new_twitter_username'
+        mock_get_connection_values.return_value = cv
+
+        with self.app.app_context():
+            stats = sync_profiles(['twitter'], dry_run=True)
+            self.assertEqual(stats['twitter']['updated'], 1)
+            connection = self.app.social.datastore.find_connection(
+                provider_id='twitter', provider_user_id='1234')
+            self.assertEqual(connection.display_name, '@twitter_username')
+
+            # A sync interrupted after a failed fetch retries it on resume
+            def interrupt(provider_id, stats):
+                raise KeyboardInterrupt()
+
+            checkpoint = Checkpoint()
+            mock_get_connection_values.side_effect = IOError('timeout')
+            self.assertRaises(KeyboardInterrupt, sync_profiles, ['twitter'],
+                              checkpoint=checkpoint, progress=interrupt)
+            self.assertEqual(checkpoint.get('twitter:failed'),
+                             [checkpoint.get('twitter')])
+
+            mock_get_connection_values.side_effect = None
+            stats = sync_profiles(['twitter'], checkpoint=checkpoint)
+            self.assertEqual(stats['twitter']['processed'], 1)
+            self.assertEqual(stats['twitter']['updated'], 1)
+            self.assertEqual(checkpoint.positions, {})
+            connection = self.app.social.datastore.find_connection(
+                provider_id='twitter', provider_user_id='1234')
+            self.assertEqual(connection.display_name, '@new_twitter_username')
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_import_graph(self,
+                          mock_authorize,
+                          mock_handle_oauth1_response,
+                          mock_get_connection_values,
+                          mock_get_twitter_api):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+        api = mock_get_twitter_api.return_value
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+
+        edges = self.app.extensions['social'].edge_datastore
+        owner = dict(provider_id='twitter', provider_user_id='1234')
+        checkpoint = Checkpoint()
+        with self.app.app_context():
+            api.GetFollowerIDsPaged.side_effect = [(2, 0, [1, 2]),
+                                                   IOError('timeout')]
+            api.GetFriendIDsPaged.return_value = (0, 0, [1])
+            self.assertRaises(IOError, import_graph, ['twitter'],
+                              checkpoint=checkpoint, batch_size=1)
+            self.assertEqual(edges.count_edges(kind='followers', **owner), 2)
+
+            # Resumes at the cursor of the failed page
+            api.GetFollowerIDsPaged.side_effect = [(0, 2, [3])]
+            stats = import_graph(['twitter'], checkpoint=checkpoint)
+            self.assertEqual(api.GetFollowerIDsPaged.call_args[1]['cursor'], 2)
+            self.assertEqual(stats['twitter']['created'], 2)
+            self.assertEqual(stats['twitter']['removed'], 0)
+            self.assertEqual(checkpoint.positions, {})
+            self.assertEqual(edges.count_edges(kind='followers', **owner), 3)
+            self.assertEqual(edges.count_edges(kind='friends', **owner), 1)
+
+            # A new import removes the edges the provider no longer lists
+            api.GetFollowerIDsPaged.side_effect = [(0, 0, [1, 4, 4])]
+            stats = import_graph(['twitter'], kinds=['followers'])
+            self.assertEqual(stats['twitter']['created'], 1)
+            self.assertEqual(stats['twitter']['removed'], 2)
+            self.assertEqual(sorted(e.target_user_id for e in edges.find_edges(
+                kind='followers', **owner)), ['1', '4'])
+
+            # Waits for the rate limit and goes on from the last page read
+            api.GetFollowerIDsPaged.side_effect = [
+                (5, 0, [1]), RateLimitExceeded('twitter', 0.5), (0, 5, [4])]
+            # Only the graph module's clock, as other threads sleep too
+            with mock.patch('flask_social.graph.time', wraps=time) as clock:
+                clock.sleep = mock.Mock()
+                stats = import_graph(['twitter'], kinds=['followers'])
+                clock.sleep.assert_called_once_with(0.5)
+            self.assertEqual(api.GetFollowerIDsPaged.call_args[1]['cursor'], 5)
+            self.assertEqual(stats['twitter']['seen'], 2)
+            self.assertEqual(stats['twitter']['removed'], 0)
+
+            api.GetFollowerIDsPaged.side_effect = [
+                RateLimitExceeded('twitter', 0.5)]
+            self.assertRaises(RateLimitExceeded, import_graph, ['twitter'],
+                              kinds=['followers'], max_wait=0)
+
+            # Facebook has friends but no followers, so it is skipped
+            datastore = self.app.extensions['social'].datastore
+            datastore.create_connection(
+                user_id=self.app.get_user().id, provider_id='facebook',
+                provider_user_id='5678', access_token='token', secret=None,
+                display_name='display', full_name='full',
+                profile_url='profile', image_url='image', rank=1)
+            datastore.commit()
+            api.GetFollowerIDsPaged.side_effect = [(0, 0, [1, 4])]
+            stats = import_graph(kinds=['followers'])
+            self.assertEqual(sorted(stats), ['twitter'])
+
+            with mock.patch.object(self.app.extensions['social'],
+                                   'edge_datastore', None):
+                self.assertRaises(RuntimeError, import_graph, ['twitter'])
+
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_find_connection_only(self,
+                                  mock_authorize,
+                                  mock_handle_oauth1_response,
+                                  mock_get_connection_values):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+
+        datastore = self.app.social.datastore
+        with self.app.app_context():
+            connection = datastore.find_connection(
+                only=TOKEN_FIELDS, provider_id='twitter')
+            self.assertEqual(connection.access_token, 'the_oauth_token')
+            self.assertIsNotNone(datastore.get_user_id(connection))
+
+            # Fields that were not loaded are kept when saving
+            connection.access_token = 'new_oauth_token'
+            datastore.put(connection)
+            datastore.commit()
+            connection = datastore.find_connection(provider_id='twitter')
+            self.assertEqual(connection.access_token, 'new_oauth_token')
+            self.assertEqual(connection.display_name, '@twitter_username')
+
+            connections = list(datastore.find_connections(
+                only=TOKEN_FIELDS, provider_id='twitter'))
+            self.assertEqual(len(connections), 1)
+            connections[0].access_token = 'the_oauth_token'
+            datastore.put(connections[0])
+            datastore.commit()
+            connection = datastore.find_connection(provider_id='twitter')
+            self.assertEqual(connection.access_token, 'the_oauth_token')
+            self.assertEqual(connection.image_url,
+                             'https://cdn.twitter.com/something.png')
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_publish(self,
+                     mock_authorize,
+                     mock_handle_oauth1_response,
+                     mock_get_connection_values,
+                     mock_get_twitter_api):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+        api = mock_get_twitter_api.return_value
+        api.PostUpdate.return_value.id = 42
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+
+        completed = []
+
+        def on_completed(app, user, result):
+            completed.append(result.provider_id)
+
+        publish_completed.connect(on_completed, sender=self.app)
+        self.addCleanup(publish_completed.disconnect, on_completed)
+        with self.app.app_context():
+            user = self.app.security.datastore.find_user(email='matt@lp.com')
+            payload = dict(message='Hello', link='http://example.com')
+            results = self.app.social.publish(user, payload,
+                                              ['twitter', 'facebook'])
+            self.assertEqual(results['twitter'].value, '42')
+            api.PostUpdate.assert_called_once_with('Hello http://example.com')
+            self.assertIsInstance(results['facebook'].error, ValueError)
+            self.assertEqual(sorted(completed), ['facebook', 'twitter'])
+
+            # A provider that does not answer in time is reported as such
+            answer = threading.Event()
+            api.PostUpdate.side_effect = lambda status: answer.wait(5)
+            self.app.extensions['social'].publisher.timeout = 0.1
+            results = self.app.social.publish(user, payload)
+            answer.set()
+            self.assertEqual(list(results), ['twitter'])
+            self.assertIsInstance(results['twitter'].error, PublishTimeout)
+            self.assertTrue(results['twitter'].error.started)
+            self.assertEqual(len(completed), 3)
+
+            # A post still queued at its deadline is never made
+            publisher = Publisher(workers=1, timeout=0.1)
+            busy = threading.Event()
+            publisher._get_pool().apply_async(busy.wait, (5,))
+            posts = api.PostUpdate.call_count
+            results = publisher.publish(user, payload)
+            busy.set()
+            publisher._pool.close()
+            publisher._pool.join()
+            self.assertFalse(results['twitter'].error.started)
+            self.assertEqual(api.PostUpdate.call_count, posts)
+
+            # Errors building the client are reported for the provider
+            mock_get_twitter_api.side_effect = BulkheadFull('twitter', 1, 0)
+            results = self.app.social.publish(user, payload)
+            self.assertIsInstance(results['twitter'].error, BulkheadFull)
+
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_export_import_connections(self,
+                                       mock_authorize,
+                                       mock_handle_oauth1_response,
+                                       mock_get_connection_values):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+
+        with self.app.app_context():
+            datastore = self.app.social.datastore
+            f = io.BytesIO()
+            checkpoint = Checkpoint()
+            self.assertEqual(export_connections(f, checkpoint=checkpoint), 1)
+            # A complete export starts over the next time
+            self.assertEqual(checkpoint.positions, {})
+
+            datastore.delete_connection(provider_id='twitter',
+                                        provider_user_id='1234')
+            datastore.commit()
+            f.seek(0)
+            self.assertEqual(import_connections(f)['imported'], 1)
+            connection = datastore.find_connection(provider_id='twitter',
+                                                   provider_user_id='1234')
+            self.assertEqual(connection.access_token, 'the_oauth_token')
+
+            f.seek(0)
+            self.assertEqual(import_connections(f)['skipped'], 1)
+
+            # One lookup per batch, and repeated records are imported once
+            record = json.loads(f.getvalue().decode('utf-8'))
+            datastore.delete_connection(provider_id='twitter',
+                                        provider_user_id='1234')
+            datastore.commit()
+            lines = [record, record, dict(record, provider_id='facebook')]
+            f = io.BytesIO(b''.join(json.dumps(r).encode('utf-8') + b'\n'
+                                    for r in lines))
+            with mock.patch.object(datastore, 'find_identities',
+                                   wraps=datastore.find_identities) as find:
+                stats = import_connections(f)
+            self.assertEqual(stats, dict(imported=2, skipped=1))
+            self.assertEqual(find.call_count, 1)
+            self.assertEqual(len(datastore.find_connection_records(
+                provider_user_id='1234')), 2)
+
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_find_connection_record(self,
+                                    mock_authorize,
+                                    mock_handle_oauth1_response,
+                                    mock_get_connection_values):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+
+        with self.app.app_context():
+            datastore = self.app.social.datastore
+            record = datastore.find_connection_record(provider_id='twitter',
+                                                      provider_user_id='1234')
+            self.assertEqual(record.access_token, 'the_oauth_token')
+            self.assertEqual(str(record.user_id), str(self.app.get_user().id))
+            self.assertEqual(len(datastore.find_connection_records(
+                provider_id='twitter')), 1)
+
+            connection = datastore.to_model(record)
+            self.assertEqual(connection.id, record.id)
+            self.assertEqual(datastore.to_record(connection), record)
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_social.providers.twitter.get_token_pair_from_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_callback_call_counts(self,
+                                  mock_authorize,
+                                  mock_handle_oauth1_response,
+                                  mock_get_token_pair_from_response,
+                                  mock_get_connection_values,
+                                  mock_get_twitter_api):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_get_token_pair_from_response.return_value = get_mock_twitter_token_pair()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        with assert_max_calls(3, self.app):
+            self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+        self._get('/logout')
+        self._post('/login/twitter')
+        with assert_max_calls(2, self.app):
+            self._get('/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+
+        datastore = self.app.extensions['social'].datastore
+        with self.app.test_request_context():
+            try:
+                with assert_max_calls(2):
+                    for provider_id in ('twitter', 'facebook', 'google'):
+                        datastore.find_connection(provider_id=provider_id)
+            except AssertionError as e:
+                self.assertIn('3 datastore calls made', str(e))
+                self.assertIn('3 x find_connection at ', str(e))
+            else:
+                self.fail('AssertionError not raised')
+        # The datastore's methods are restored
+        self.assertNotIn('find_connection', datastore.__dict__)
+
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_callback_urls_per_host(self, mock_authorize):
+        mock_authorize.return_value = 'Should be a redirect'
+
+        self.authenticate()
+        for host in ('http://example.com', 'https://other.example.org',
+                     'http://example.com'):
+            self.client.post('/connect/twitter', base_url=host)
+            self.assertEqual(mock_authorize.call_args[0][1],
+                             host + '/connect/twitter')
+
+        urls = self.app.social.callback_urls
+        self.assertEqual(len(urls), 2)
+        self.assertEqual(urls.get('http://example.com/'),
+                         {('connect', 'twitter'):
+                          'http://example.com/connect/twitter'})
+
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_runtime_provider_registration(self, mock_authorize):
+        mock_authorize.return_value = 'Should be a redirect'
+        self._get('/')
+        registry = self.app.extensions['social'].registry
+
+        with self.app.app_context():
+            registry.disable('twitter')
+        self.assertEqual(self._post('/login/twitter').status_code, 404)
+
+        with self.app.app_context():
+            registry.register('twitter', dict(consumer_key='new-key',
+                                              consumer_secret='secret'))
+        self._post('/login/twitter')
+        provider = mock_authorize.call_args[0][0]
+        self.assertEqual(provider.consumer_key, 'new-key')
+
+        with self.app.app_context():
+            # Another worker rotates the secret
+            datastore = registry.datastore
+            datastore.put_provider('twitter', dict(consumer_key='new-key',
+                                                   consumer_secret='rotated'))
+            datastore.commit()
+            self.assertEqual(registry.current('twitter').consumer_secret,
+                             'secret')
+            registry._next_poll = 0
+            self.assertEqual(registry.current('twitter').consumer_secret,
+                             'rotated')
+            self.assertEqual(registry.version,
+                             datastore.get_provider_version())
+            self.assertEqual(registry.version, 3)
+            self.assertEqual([row.provider_id
+                              for row in datastore.find_providers()],
+                             ['twitter'])
+
+class StatelessStateTwitterSocialTests(SocialTest):
+
+    SOCIAL_CONFIG = {'SOCIAL_STATELESS_STATE': True}
+
+    def _get_state(self, mock_authorize):
+        callback_url = mock_authorize.call_args[0][1]
+        query = urlparse.parse_qs(urlparse.urlparse(callback_url).query)
+        return query['state'][0]
+
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_connect_twitter_with_signed_state(self,
+                                               mock_authorize,
+                                               mock_handle_oauth1_response,
+                                               mock_get_connection_values):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter', data=dict(next='/profile'))
+        state = self._get_state(mock_authorize)
+        with self.client.session_transaction() as session:
+            self.assertNotIn('post_oauth_connect_url', session)
+
+        r = self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier&state=' + state)
+        self.assertEqual(r.status_code, 302)
+        self.assertTrue(r.location.endswith('/profile'))
+
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_tampered_state_is_rejected(self,
+                                        mock_authorize,
+                                        mock_handle_oauth1_response,
+                                        mock_get_connection_values):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        state = self._get_state(mock_authorize)
+        r = self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier&state=x' + state, follow_redirects=True)
+        self.assertIn('invalid or has expired', r.data)
+        self.assertFalse(mock_handle_oauth1_response.called)
+
+    @mock.patch('flask_social.providers.facebook.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.http_request')
+    def test_connect_facebook_with_signed_state(self,
+                                                mock_http_request,
+                                                mock_get_connection_values):
+        mock_get_connection_values.return_value = dict(
+            get_mock_twitter_connection_values(), provider_id='facebook',
+            secret=None)
+        mock_http_request.return_value = (
+            mock.Mock(code=200, headers={'content-type': 'application/json'}),
+            '{"access_token": "the_access_token"}')
+
+        self.authenticate()
+        r = self._post('/connect/facebook', data=dict(next='/profile'),
+                       follow_redirects=False)
+        query = urlparse.parse_qs(urlparse.urlparse(r.location).query)
+        redirect_uri = query['redirect_uri'][0]
+        self.assertEqual(redirect_uri, 'http://localhost/connect/facebook')
+        with self.client.session_transaction() as session:
+            self.assertNotIn('facebook_oauthredir', session)
+            self.assertNotIn('post_oauth_connect_url', session)
+
+        r = self._get('/connect/facebook?code=the_code&state=' +
+                      query['state'][0])
+        self.assertEqual(r.status_code, 302)
+        self.assertTrue(r.location.endswith('/profile'))
+
+        # The token request repeats the redirect URI of the authorization
+        token_url = mock_http_request.call_args[0][0]
+        token_query = urlparse.parse_qs(urlparse.urlparse(token_url).query)
+        self.assertEqual(token_query['redirect_uri'], [redirect_uri])
+        self.assertEqual(token_query['code'], ['the_code'])
+        response = mock_get_connection_values.call_args[0][0]
+        self.assertEqual(response['access_token'], 'the_access_token')
+
+        # A state signed for another provider is refused
+        r = self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier&state=' + query['state'][0], follow_redirects=True)
+        self.assertIn('invalid or has expired', r.data)
+
+
+class MultiTenantTwitterSocialTests(SocialTest):
+
+    CREDENTIALS = {
+        'a.example.com': dict(consumer_key='a-key', consumer_secret='a-secret')
+    }
+
+    def setUp(self):
+        super(MultiTenantTwitterSocialTests, self).setUp()
+        registry = self.app.extensions['social'].registry
+        self.loaded = []
+
+        @registry.credential_loader
+        def load_credentials(tenant_id, provider_id):
+            self.loaded.append((tenant_id, provider_id))
+            return self.CREDENTIALS.get(tenant_id)
+
+        @registry.tenant_getter
+        def get_tenant():
+            return request.host
+
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_login_uses_tenant_credentials(self, mock_authorize):
+        mock_authorize.return_value = 'Should be a redirect'
+
+        for x in range(2):
+            self.client.post('/login/twitter', base_url='http://a.example.com')
+            provider = mock_authorize.call_args[0][0]
+            self.assertEqual(provider.consumer_key, 'a-key')
+            self.assertEqual(provider.request_token_url,
+                             'https://api.twitter.com/oauth/request_token')
+        self.assertEqual(self.loaded, [('a.example.com', 'twitter')])
+
+        shared = self.app.extensions['social'].providers['twitter']
+        self.assertNotEqual(shared.consumer_key, 'a-key')
+        self.assertTrue(provider.bulkhead is shared.bulkhead)
+
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_unknown_tenant_is_not_found(self, mock_authorize):
+        r = self.client.post('/login/twitter', base_url='http://b.example.com')
+        self.assertEqual(r.status_code, 404)
+        self.assertFalse(mock_authorize.called)
+
+class IdentityFilterTwitterSocialTests(SocialTest):
+
+    SOCIAL_CONFIG = {'SOCIAL_USE_IDENTITY_FILTER': True}
+
+    def _login(self):
+        self._post('/login/twitter')
+        return self._get('/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+
+    def _build_filter(self):
+        self._get('/')
+        with self.app.app_context():
+            self.app.extensions['social'].identity_filter.rebuild()
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_social.providers.twitter.get_token_pair_from_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_unknown_identity_skips_datastore(self,
+                                              mock_authorize,
+                                              mock_handle_oauth1_response,
+                                              mock_get_token_pair_from_response,
+                                              mock_get_connection_values,
+                                              mock_get_twitter_api):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_get_token_pair_from_response.return_value = get_mock_twitter_token_pair()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+        state = self.app.extensions['social']
+        self._build_filter()
+
+        with mock.patch.object(state.datastore, 'find_connection') as find:
+            r = self._login()
+            self.assertIn('Twitter account not associated with an existing user', r.data)
+            self.assertFalse(find.called)
+
+        # Connections made after the filter was built are added to it
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+        self._get('/logout')
+        r = self._login()
+        self.assertIn('Hello matt@lp.com', r.data)
+
+        stats = state.identity_filter.stats()
+        self.assertEqual(stats['builds'], 1)
+        self.assertEqual(stats['items'], 1)
+        self.assertEqual(stats['checks'], 2)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['false_positives'], 0)
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    @mock.patch('flask_social.providers.twitter.get_token_pair_from_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_connections_made_elsewhere_are_found_after_rebuild(
+            self, mock_authorize, mock_handle_oauth1_response,
+            mock_get_token_pair_from_response, mock_get_twitter_api):
+        mock_get_token_pair_from_response.return_value = get_mock_twitter_token_pair()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+        state = self.app.extensions['social']
+        self._build_filter()
+
+        # As another process would, without the connection_created signal
+        with self.app.app_context():
+            cv = get_mock_twitter_connection_values()
+            state.datastore.create_connection(user_id=self.app.get_user().id,
+                                              **cv)
+            state.datastore.commit()
+
+        r = self._login()
+        self.assertIn('Twitter account not associated with an existing user', r.data)
+
+        with self.app.app_context():
+            state.identity_filter.rebuild()
+        r = self._login()
+        self.assertIn('Hello matt@lp.com', r.data)
+        stats = state.identity_filter.stats()
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['items'], 1)
+
+    @mock.patch('flask_social.providers.twitter.get_token_pair_from_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_build_errors_fall_back_to_datastore(
+            self, mock_authorize, mock_handle_oauth1_response,
+            mock_get_token_pair_from_response):
+        mock_get_token_pair_from_response.return_value = get_mock_twitter_token_pair()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+        state = self.app.extensions['social']
+        identity_filter = state.identity_filter
+
+        with mock.patch.object(state.datastore, 'iter_connections',
+                               side_effect=ValueError('down')):
+            with mock.patch.object(state.datastore, 'find_connection',
+                                   wraps=state.datastore.find_connection) as find:
+                r = self._login()
+                self.assertIn('Twitter account not associated with an existing user', r.data)
+                self.assertTrue(find.called)
+            for x in range(100):
+                if not identity_filter._building:
+                    break
+                time.sleep(0.01)
+
+        stats = identity_filter.stats()
+        self.assertEqual(stats['builds'], 0)
+        self.assertEqual(stats['fallbacks'], 1)
+        self.assertIn('down', stats['last_error'])
+
+class IdentityIndexTwitterSocialTests(SocialTest):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.SOCIAL_CONFIG = {'SOCIAL_IDENTITY_INDEX_PATH': self.path}
+        super(IdentityIndexTwitterSocialTests, self).setUp()
+
+    def tearDown(self):
+        super(IdentityIndexTwitterSocialTests, self).tearDown()
+        self.app.extensions['social'].identity_index.close()
+        os.remove(self.path)
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_social.providers.twitter.get_token_pair_from_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_login_uses_identity_index(self,
+                                       mock_authorize,
+                                       mock_handle_oauth1_response,
+                                       mock_get_token_pair_from_response,
+                                       mock_get_connection_values,
+                                       mock_get_twitter_api):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_get_token_pair_from_response.return_value = get_mock_twitter_token_pair()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+        index = self.app.extensions['social'].identity_index
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+        self.assertEqual(index.get('twitter', '1234'), None)
+
+        def login():
+            self._get('/logout')
+            self._post('/login/twitter')
+            r = self._get('/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+            self.assertIn('Hello matt@lp.com', r.data)
+
+        login()
+        tokens = ('the_oauth_token', 'the_oauth_token_secret')
+        connection_id, user_id = index.get('twitter', '1234', tokens)
+        self.assertEqual(user_id, self.app.get_user().id)
+
+        # Unchanged tokens log in without loading the connection
+        datastore = self.app.extensions['social'].datastore
+        with mock.patch.object(datastore, 'find_connection',
+                               wraps=datastore.find_connection) as find:
+            login()
+            # The profile page still loads the connection for get_api
+            for args, kwargs in find.call_args_list:
+                self.assertNotIn('provider_user_id', kwargs)
+        self.assertEqual(index.stats()['hits'], 2)
+
+        # New tokens are stored on the connection and in the index
+        mock_get_token_pair_from_response.return_value = dict(
+            access_token='new_token', secret='new_secret')
+        login()
+        self.assertEqual(index.get('twitter', '1234', tokens), None)
+        self.assertEqual(index.get('twitter', '1234',
+                                   ('new_token', 'new_secret')),
+                         (connection_id, user_id))
+        with self.app.test_request_context():
+            connection = datastore.find_connection(provider_id='twitter',
+                                                   provider_user_id='1234')
+            self.assertEqual(connection.access_token, 'new_token')
+
+        # Removed connections are dropped from the index
+        self.client.delete('/connect/twitter/1234', follow_redirects=True)
+        self.assertEqual(index.get('twitter', '1234'), None)
+
+        # Hits are confirmed against the datastore, which another host may
+        # have changed
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+        login()
+        self.assertNotEqual(index.get('twitter', '1234'), None)
+        with self.app.test_request_context():
+            datastore.delete_connection(provider_id='twitter',
+                                        provider_user_id='1234')
+            datastore.commit()
+        self._get('/logout')
+        self._post('/login/twitter')
+        r = self._get('/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+        self.assertNotIn('Hello matt@lp.com', r.data)
+        self.assertEqual(index.get('twitter', '1234'), None)
+
+class CallCountTwitterSocialTests(SocialTest):
+
+    SOCIAL_CONFIG = {'SOCIAL_DATASTORE_CALL_THRESHOLD': 1}
+
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_requests_over_threshold_are_logged(self,
+                                                mock_authorize,
+                                                mock_handle_oauth1_response,
+                                                mock_get_connection_values):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        with mock.patch.object(self.app.logger, 'warning') as warning:
+            self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+            self.assertEqual(warning.call_count, 1)
+            args = warning.call_args[0]
+            self.assertEqual(args[1:5], ('GET', '/connect/twitter', 3, 1))
+            self.assertIn('create_connection at ', args[5])
+            self.assertIn('in connect_handler', args[5])
+
+            self._get('/')
+            self.assertEqual(warning.call_count, 1)
+
+class HealthTwitterSocialTests(SocialTest):
+
+    SOCIAL_CONFIG = {'SOCIAL_HEALTH_CACHE_TTL': 0}
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_social.providers.twitter.get_token_pair_from_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_health_reports_observed_callbacks(self,
+                                               mock_authorize,
+                                               mock_handle_oauth1_response,
+                                               mock_get_token_pair_from_response,
+                                               mock_get_connection_values,
+                                               mock_get_twitter_api):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_get_token_pair_from_response.return_value = get_mock_twitter_token_pair()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        r = self._get('/health')
+        self.assertEqual(r.status_code, 200)
+        report = json.loads(r.data)
+        self.assertEqual(report['status'], 'ok')
+        self.assertEqual(report['providers']['twitter']['status'], 'unknown')
+
+        self._post('/login/twitter')
+        self._get('/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+        twitter = json.loads(self._get('/health').data)['providers']['twitter']
+        self.assertEqual(twitter['status'], 'ok')
+        # The token exchange and the profile lookup
+        self.assertEqual(twitter['samples'], 2)
+        self.assertTrue(twitter['last_token_exchange'] is not None)
+
+        mock_handle_oauth1_response.side_effect = IOError('unreachable')
+        for x in range(2):
+            self._post('/login/twitter')
+            self.assertRaises(IOError, self._get, '/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+        r = self._get('/health')
+        self.assertEqual(r.status_code, 503)
+        twitter = json.loads(r.data)['providers']['twitter']
+        self.assertEqual(twitter['status'], 'down')
+        self.assertNotIn('last_error', twitter)
+        health = self.app.extensions['social'].providers['twitter'].health
+        self.assertEqual(health.report()['last_error'], 'IOError: unreachable')
+
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_forged_callbacks_do_not_mark_provider_down(self, mock_authorize):
+        mock_authorize.return_value = 'Should be a redirect'
+
+        # No request token is in the session, so the exchange fails before
+        # any request is made
+        for x in range(3):
+            r = self._get('/login/twitter?oauth_token=x&oauth_verifier=x')
+            self.assertEqual(r.status_code, 302)
+        r = self._get('/health')
+        self.assertEqual(r.status_code, 200)
+        twitter = json.loads(r.data)['providers']['twitter']
+        self.assertEqual(twitter['error_rate'], 0)
+        self.assertEqual(twitter['status'], 'ok')
+
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_token_endpoint_errors_mark_provider_down(
+            self, mock_authorize, mock_handle_oauth1_response):
+        mock_authorize.return_value = 'Should be a redirect'
+        # What Flask-OAuthlib raises for a 5xx from the token endpoint
+        mock_handle_oauth1_response.side_effect = OAuthException(
+            'Invalid response from twitter', type='invalid_response',
+            data={})
+        for x in range(2):
+            self._post('/login/twitter')
+            r = self._get('/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+            self.assertEqual(r.status_code, 302)
+        twitter = json.loads(self._get('/health').data)['providers']['twitter']
+        self.assertEqual(twitter['status'], 'down')
+
+class WarmUpTwitterSocialTests(SocialTest):
+
+    SOCIAL_CONFIG = {'SOCIAL_WARM_API_CLIENTS': True}
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_social.providers.twitter.get_token_pair_from_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_login_warms_api_clients(self,
+                                     mock_authorize,
+                                     mock_handle_oauth1_response,
+                                     mock_get_token_pair_from_response,
+                                     mock_get_connection_values,
+                                     mock_get_twitter_api):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_get_token_pair_from_response.return_value = get_mock_twitter_token_pair()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+        pool = self.app.extensions['social'].client_pool
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+        self._get('/logout')
+        self._post('/login/twitter')
+        self._get('/login/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+        pool.join()
+        self.assertEqual(pool.stats()['built'], 1)
+
+        r = self._get('/profile')
+        self.assertIn('Profile Page', r.data)
+        self.assertEqual(mock_get_twitter_api.call_count, 1)
+        self.assertEqual(pool.stats()['hits'], 1)
+
+class AvatarTwitterSocialTests(SocialTest):
+
+    def _create_app(self, auth_config):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return create_sql_app(dict(SOCIAL_AVATAR_CACHE_DIR=path), False)
+
+    @mock.patch('flask_social.avatars.urlopen')
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_avatar_is_served_from_cache(self,
+                                         mock_authorize,
+                                         mock_handle_oauth1_response,
+                                         mock_get_connection_values,
+                                         mock_urlopen):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+        mock_urlopen.return_value.read.return_value = b'PNG'
+        mock_urlopen.return_value.info.return_value = {
+            'Content-Type': 'image/png'}
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+
+        with self.app.test_request_context():
+            connection = self.app.social.datastore.find_connection_record(
+                provider_id='twitter', provider_user_id='1234')
+            url = get_avatar_url(connection)
+        r = self._get(url)
+        self.assertEqual(r.status_code, 302)
+        self.assertEqual(r.headers['Location'],
+                         'https://cdn.twitter.com/something.png')
+        cache = self.app.extensions['social'].avatar_cache
+        for i in range(500):
+            if cache.stats()['fetched']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(mock_urlopen.call_count, 1)
+
+        r = self._get(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, b'PNG')
+        self.assertEqual(r.mimetype, 'image/png')
+        self.assertIn('public', r.headers['Cache-Control'])
+        self.assertIn('max-age=2592000', r.headers['Cache-Control'])
+        etag = r.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+
+        r = self._get(url, headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+
+        # URLs not made by the app look the same for unknown identities
+        self.assertEqual(self._get(url[:-1] + 'x').status_code, 404)
+        self.assertEqual(self._get(url.replace('1234', '4321')).status_code,
+                         404)
+
+        # A new image gets a new URL, so browsers may keep the old one
+        with self.app.test_request_context():
+            changed = mock.Mock(provider_id='twitter', provider_user_id='1234',
+                                image_url='https://cdn.twitter.com/new.png')
+            self.assertNotEqual(get_avatar_url(changed), url)
+
+        # Removed by another worker between the lookup and sending it
+        cached = cache.get('https://cdn.twitter.com/something.png')
+        os.remove(cached.path)
+        with mock.patch.object(cache, 'get', return_value=cached):
+            r = self._get(url)
+        self.assertEqual(r.status_code, 302)
+        self.assertEqual(r.headers['Location'],
+                         'https://cdn.twitter.com/something.png')
+
+
+class SQLAlchemyLookupCacheTests(SocialTest):
+
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_lookups_compile_once(self,
+                                  mock_authorize,
+                                  mock_handle_oauth1_response,
+                                  mock_get_connection_values):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+
+        datastore = self.app.social.datastore
+        with self.app.app_context():
+            def lookup():
+                connection = datastore.find_connection(
+                    provider_id='twitter', provider_user_id='1234')
+                record = datastore.find_connection_record(
+                    provider_id='twitter', user_id=connection.user_id)
+                projected = datastore.find_connection(
+                    only=TOKEN_FIELDS, provider_id='twitter',
+                    user_id=connection.user_id)
+                self.assertEqual(record.id, connection.id)
+                self.assertEqual(record.display_name, '@twitter_username')
+                self.assertEqual(projected.secret, 'the_oauth_token_secret')
+                self.assertEqual(datastore.find_connection(
+                    provider_id='twitter', provider_user_id='4321'), None)
+
+            lookup()
+            compiled = len(datastore._compiled_cache)
+            lookup()
+            self.assertEqual(len(datastore._compiled_cache), compiled)
+
+            # None is looked up with IS NULL rather than a bound parameter
+            connection = datastore.find_connection(provider_id='twitter',
+                                                   provider_user_id='1234')
+            connection.provider_user_id = None
+            datastore.put(connection)
+            datastore.commit()
+            self.assertEqual(datastore.find_connection_record(
+                provider_id='twitter', provider_user_id=None).id,
+                connection.id)
+            self.assertEqual(len(datastore._compiled_cache), compiled)
+
+
+class TracingTwitterSocialTests(SocialTest):
+
+    def _create_app(self, auth_config):
+        self.exporter = InMemorySpanExporter()
+        return create_sql_app(auth_config, False,
+                              tracer=Tracer(self.exporter))
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_social.providers.twitter.get_token_pair_from_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_callback_spans(self,
+                            mock_authorize,
+                            mock_handle_oauth1_response,
+                            mock_get_token_pair_from_response,
+                            mock_get_connection_values,
+                            mock_get_twitter_api):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_get_token_pair_from_response.return_value = get_mock_twitter_token_pair()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self.exporter.clear()
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier', follow_redirects=True)
+
+        spans = dict((s.name, s) for s in self.exporter.get_finished_spans())
+        root = spans['social.connect_callback']
+        self.assertEqual(root.parent_id, None)
+        self.assertEqual(root.attributes['social.provider_id'], 'twitter')
+        self.assertEqual(root.attributes['http.method'], 'GET')
+        for name in ('social.token_exchange', 'social.datastore.find_connection_record',
+                     'social.datastore.create_connection'):
+            self.assertEqual(spans[name].parent_id, root.span_id)
+            self.assertEqual(spans[name].trace_id, root.trace_id)
+        self.assertIn(('social.signal.connection_created',
+                       {'social.provider_id': 'twitter'}),
+                      [(e[0], e[2]) for e in root.events])
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    def test_api_calls_are_traced(self, mock_get_twitter_api):
+        mock_get_twitter_api.return_value.GetUser.return_value = 'user'
+        provider = self.app.extensions['social'].providers['twitter']
+        connection = mock.Mock(access_token='token', secret='secret')
+        with self.app.test_request_context():
+            api = provider.get_api(connection)
+            self.assertEqual(api.GetUser(user_id=1), 'user')
+            self.assertTrue(api.wrapped is mock_get_twitter_api.return_value)
+
+        spans = dict((s.name, s) for s in self.exporter.get_finished_spans())
+        self.assertEqual(spans['social.api.GetUser'].attributes,
+                         {'social.provider_id': 'twitter'})
 
 class MongoEngineTwitterSocialTests(TwitterSocialTests):
     APP_TYPE = 'mongo'
 
 class PeeweeTwitterSocialTests(TwitterSocialTests):
     APP_TYPE = 'peewee'
+
+    @mock.patch('flask_social.providers.twitter.get_connection_values')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.handle_oauth1_response')
+    @mock.patch('flask_oauthlib.client.OAuthRemoteApp.authorize')
+    def test_find_connections_only_selects_fields(self,
+                                                  mock_authorize,
+                                                  mock_handle_oauth1_response,
+                                                  mock_get_connection_values):
+        mock_get_connection_values.return_value = get_mock_twitter_connection_values()
+        mock_authorize.return_value = 'Should be a redirect'
+        mock_handle_oauth1_response.return_value = get_mock_twitter_response()
+
+        self.authenticate()
+        self._post('/connect/twitter')
+        self._get('/connect/twitter?oauth_token=oauth_token&oauth_verifier=oauth_verifier')
+
+        datastore = self.app.social.datastore
+        with self.app.app_context():
+            query = datastore.find_connections(only=TOKEN_FIELDS,
+                                               provider_id='twitter')
+            self.assertNotIn('image_url', query.sql()[0])
+            connection, = query
+            self.assertNotIn('image_url', connection._data)
+            self.assertEqual(connection._data['access_token'],
+                             'the_oauth_token')
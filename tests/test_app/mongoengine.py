@@ -9,7 +9,8 @@ sys.path.insert(0, os.getcwd())
 from flask.ext.mongoengine import MongoEngine
 from flask.ext.security import Security, UserMixin, RoleMixin, \
      MongoEngineUserDatastore
-from flask.ext.social import Social, MongoEngineConnectionDatastore
+from flask.ext.social import Social, MongoEngineConnectionDatastore, \
+     MongoEngineProviderDatastore, MongoEngineSocialEdgeDatastore
 
 from tests.test_app import create_app as create_base_app, populate_data
 
@@ -54,12 +55,32 @@ def create_app(auth_config=None, debug=True):
         def user(self):
             return User.objects(id=self.user_id).first()
 
+    class Provider(db.Document):
+        provider_id = db.StringField(max_length=255)
+        tenant_id = db.StringField(max_length=255)
+        config = db.StringField()
+        enabled = db.BooleanField(default=True)
+        version = db.IntField()
+
+    class SocialEdge(db.Document):
+        provider_id = db.StringField(max_length=255)
+        provider_user_id = db.StringField(max_length=255)
+        kind = db.StringField(max_length=20)
+        target_user_id = db.StringField(max_length=255)
+        generation = db.IntField()
+        meta = {'indexes': [('provider_id', 'provider_user_id', 'kind',
+                             'target_user_id')]}
+
     app.security = Security(app, MongoEngineUserDatastore(db, User, Role))
-    app.social = Social(app, MongoEngineConnectionDatastore(db, Connection))
+    app.social = Social(app, MongoEngineConnectionDatastore(db, Connection),
+                        provider_datastore=MongoEngineProviderDatastore(
+                            db, Provider),
+                        edge_datastore=MongoEngineSocialEdgeDatastore(
+                            db, SocialEdge))
 
     @app.before_first_request
     def before_first_request():
-        for m in [User, Role, Connection]:
+        for m in [User, Role, Connection, Provider, SocialEdge]:
             m.drop_collection()
         populate_data()
 
@@ -9,7 +9,8 @@ sys.path.insert(0, os.getcwd())
 from flask_peewee.db import Database
 from flask.ext.security import Security, UserMixin, RoleMixin, \
     PeeweeUserDatastore
-from flask.ext.social import Social, PeeweeConnectionDatastore
+from flask.ext.social import Social, PeeweeConnectionDatastore, \
+    PeeweeProviderDatastore, PeeweeSocialEdgeDatastore
 from peewee import *
 
 from tests.test_app import create_app as create_base_app, populate_data
@@ -59,12 +60,35 @@ def create_app(config=None, debug=True):
         image_url = TextField()
         rank = IntegerField(null=True)
 
+    class Provider(db.Model):
+        provider_id = TextField()
+        tenant_id = TextField(null=True)
+        config = TextField(null=True)
+        enabled = BooleanField(default=True)
+        version = IntegerField(index=True)
+
+    class SocialEdge(db.Model):
+        provider_id = TextField()
+        provider_user_id = TextField()
+        kind = TextField()
+        target_user_id = TextField()
+        generation = IntegerField()
+
+        class Meta:
+            indexes = (
+                (('provider_id', 'provider_user_id', 'kind',
+                  'target_user_id'), False),
+            )
+
     app.security = Security(app, PeeweeUserDatastore(db, User, Role, UserRoles))
-    app.social = Social(app, PeeweeConnectionDatastore(db, Connection))
+    app.social = Social(app, PeeweeConnectionDatastore(db, Connection),
+                        provider_datastore=PeeweeProviderDatastore(db, Provider),
+                        edge_datastore=PeeweeSocialEdgeDatastore(db, SocialEdge))
 
     @app.before_first_request
     def before_first_request():
-        for Model in (Role, User, UserRoles, Connection):
+        for Model in (Role, User, UserRoles, Connection, Provider,
+                      SocialEdge):
             Model.drop_table(fail_silently=True)
             Model.create_table(fail_silently=True)
         populate_data()
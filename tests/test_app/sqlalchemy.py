@@ -8,13 +8,14 @@ sys.path.insert(0, os.getcwd())
 
 from flask.ext.security import Security, UserMixin, RoleMixin, \
      SQLAlchemyUserDatastore
-from flask.ext.social import Social, SQLAlchemyConnectionDatastore
+from flask.ext.social import Social, SQLAlchemyConnectionDatastore, \
+     SQLAlchemyProviderDatastore, SQLAlchemySocialEdgeDatastore
 from flask.ext.sqlalchemy import SQLAlchemy
 
 from tests.test_app import create_app as create_base_app, populate_data
 
 
-def create_app(config=None, debug=True):
+def create_app(config=None, debug=True, **kwargs):
     app = create_base_app(config, debug)
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
 
@@ -52,8 +53,31 @@ def create_app(config=None, debug=True):
         image_url = db.Column(db.String(512))
         rank = db.Column(db.Integer)
 
+    class Provider(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        provider_id = db.Column(db.String(255))
+        tenant_id = db.Column(db.String(255))
+        config = db.Column(db.Text)
+        enabled = db.Column(db.Boolean())
+        version = db.Column(db.Integer, index=True)
+
+    class SocialEdge(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        provider_id = db.Column(db.String(255))
+        provider_user_id = db.Column(db.String(255))
+        kind = db.Column(db.String(20))
+        target_user_id = db.Column(db.String(255))
+        generation = db.Column(db.Integer)
+        __table_args__ = (db.Index('ix_social_edge_owner', 'provider_id',
+                                   'provider_user_id', 'kind',
+                                   'target_user_id'),)
+
     app.security = Security(app, SQLAlchemyUserDatastore(db, User, Role))
-    app.social = Social(app, SQLAlchemyConnectionDatastore(db, Connection))
+    app.social = Social(app, SQLAlchemyConnectionDatastore(db, Connection),
+                        provider_datastore=SQLAlchemyProviderDatastore(
+                            db, Provider),
+                        edge_datastore=SQLAlchemySocialEdgeDatastore(
+                            db, SocialEdge), **kwargs)
 
     @app.before_first_request
     def before_first_request():
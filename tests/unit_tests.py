@@ -1,5 +1,28 @@
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
 from unittest import TestCase
-from flask_social.core import _SocialState
+
+import mock
+
+from flask_social.avatars import AvatarCache, _is_public, urlopen
+from flask_social.core import (ProviderRegistry, Settings, _SocialState,
+                               _create_provider, default_config)
+from flask_social.datastore import ConnectionRecord
+from flask_social.health import HealthMonitor, ProviderHealth
+from flask_social.httpcache import CachedResponse, HTTPError, ResponseCache
+from flask_social.identity import (BloomFilter, IdentityFilter,
+                                   SharedIdentityIndex)
+from flask_social.providers import facebook
+from flask_social.ratelimit import (RateLimiter, RateLimitedAPI,
+                                    RateLimitExceeded)
+from flask_social.resilience import Bulkhead, BulkheadFull, RetryPolicy
+from flask_social.warmup import ClientPool
+from flask_social.tracing import InMemorySpanExporter, Tracer
 
 
 class FlaskSocialUnitTests(TestCase):
@@ -7,3 +30,691 @@ class FlaskSocialUnitTests(TestCase):
     def test_social_state_raises_attribute_error(self):
         state = _SocialState(providers={})
         self.assertRaises(AttributeError, lambda: state.something)
+
+
+class BulkheadTests(TestCase):
+
+    def test_bulkhead_counts_in_flight_calls(self):
+        bulkhead = Bulkhead('twitter', limit=2)
+        with bulkhead:
+            self.assertEqual(bulkhead.in_flight, 1)
+        self.assertEqual(bulkhead.in_flight, 0)
+
+    def test_bulkhead_rejects_after_max_wait(self):
+        bulkhead = Bulkhead('twitter', limit=1, timeout=0.01)
+        bulkhead.acquire()
+        self.assertRaises(BulkheadFull, bulkhead.acquire)
+        self.assertEqual(bulkhead.stats()['rejected'], 1)
+
+    def test_bulkhead_queues_until_slot_is_released(self):
+        bulkhead = Bulkhead('twitter', limit=1, timeout=5)
+        bulkhead.acquire()
+        timer = threading.Timer(0.05, bulkhead.release)
+        timer.start()
+        start = time.time()
+        with bulkhead:
+            self.assertTrue(time.time() - start >= 0.04)
+        timer.join()
+
+
+class RetryPolicyTests(TestCase):
+
+    def _flaky(self, failures, error):
+        calls = []
+
+        def func():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise error
+            return 'ok'
+        return func, calls
+
+    def test_retries_transient_errors(self):
+        policy = RetryPolicy('twitter', max_attempts=3, base_delay=0)
+        func, calls = self._flaky(2, IOError('connection reset'))
+        self.assertEqual(policy.call(func), 'ok')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(policy.stats()['retries'], 2)
+
+    def test_does_not_retry_client_errors(self):
+        error = IOError('forbidden')
+        error.code = 403
+        policy = RetryPolicy('twitter', max_attempts=3, base_delay=0)
+        func, calls = self._flaky(1, error)
+        self.assertRaises(IOError, policy.call, func)
+        self.assertEqual(len(calls), 1)
+
+    def test_retry_budget_limits_retries(self):
+        policy = RetryPolicy('twitter', max_attempts=5, base_delay=0,
+                             budget_rate=0, budget_capacity=1)
+        func, calls = self._flaky(5, IOError('connection reset'))
+        self.assertRaises(IOError, policy.call, func)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(policy.stats()['budget_exhausted'], 1)
+
+
+class RateLimitTests(TestCase):
+
+    class FakeClient(object):
+        rate_limit = 500
+        rate_remaining = 10
+
+        def users(self):
+            self.rate_remaining -= 1
+            return {'user': {'id': '1234'}}
+
+    class FakeModule(object):
+
+        @staticmethod
+        def get_rate_limit_status(api):
+            return dict(limit=api.rate_limit, remaining=api.rate_remaining)
+
+        @staticmethod
+        def is_rate_limit_error(error):
+            return isinstance(error, ValueError)
+
+    def test_wrapper_tracks_remaining_quota(self):
+        limiter = RateLimiter('foursquare')
+        api = RateLimitedAPI(self.FakeClient(), limiter, 'key',
+                             self.FakeModule)
+        self.assertEqual(api.users()['user']['id'], '1234')
+        self.assertEqual(limiter.quota('key')['remaining'], 9)
+
+    def test_wrapper_exposes_wrapped_client(self):
+        client = self.FakeClient()
+        api = RateLimitedAPI(client, RateLimiter('foursquare'), 'key',
+                             self.FakeModule)
+        self.assertFalse(isinstance(api, self.FakeClient))
+        self.assertTrue(api.wrapped is client)
+
+    def test_exhausted_quota_raises_with_retry_after(self):
+        limiter = RateLimiter('foursquare', retry_after=30)
+        client = self.FakeClient()
+        client.rate_remaining = 1
+        api = RateLimitedAPI(client, limiter, 'key', self.FakeModule)
+        api.users()
+        try:
+            api.users()
+        except RateLimitExceeded as e:
+            self.assertTrue(0 < e.retry_after <= 30)
+        else:
+            self.fail('RateLimitExceeded not raised')
+
+    def test_token_bucket_throttles_per_connection(self):
+        limiter = RateLimiter('vk', rate=1, burst=1)
+        limiter.acquire('a')
+        limiter.acquire('b')
+        self.assertRaises(RateLimitExceeded, limiter.acquire, 'a')
+        self.assertEqual(limiter.stats()['rejected'], 1)
+
+    def test_app_bucket_refusal_refunds_connection_token(self):
+        limiter = RateLimiter('vk', rate=0.01, burst=1, app_rate=0.01,
+                              app_burst=1)
+        limiter.acquire('a')
+        connection = limiter._get_connection('b')
+        self.assertFalse(limiter._consume(connection))
+        self.assertEqual(connection['bucket'].tokens, 1)
+
+    def test_rate_limit_is_opt_in(self):
+        config = dict(consumer_key='key', consumer_secret='secret')
+        self.assertEqual(_create_provider('twitter', config).rate_limiter,
+                         None)
+        limiter = _create_provider('twitter', dict(
+            config, rate_limit=True)).rate_limiter
+        self.assertEqual((limiter.rate, limiter.burst), (0.2, 15))
+        limiter = _create_provider('twitter', dict(
+            config, rate_limit=dict(burst=5, max_wait=0.5))).rate_limiter
+        self.assertEqual((limiter.rate, limiter.burst, limiter.max_wait),
+                         (0.2, 5, 0.5))
+
+
+class FacebookBatchTests(TestCase):
+
+    class Connection(object):
+        def __init__(self, access_token):
+            self.access_token = access_token
+
+    @mock.patch('facebook.GraphAPI.request')
+    def test_batch_maps_profiles_back_to_connections(self, mock_request):
+        def respond(path, post_args=None):
+            batch = json.loads(post_args['batch'])
+            rv = []
+            for i, item in enumerate(batch):
+                if 'expired' in item['relative_url']:
+                    rv.append({'code': 400, 'body': '{}'})
+                else:
+                    body = json.dumps({'id': str(i), 'name': 'User %s' % i})
+                    rv.append({'code': 200, 'body': body})
+            return rv
+        mock_request.side_effect = respond
+
+        tokens = ['token%s' % i for i in range(120)]
+        tokens[7] = 'expired'
+        connections = [self.Connection(t) for t in tokens]
+        values = facebook.get_connection_values_batch(
+            connections, consumer_key='id', consumer_secret='secret')
+
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(len(values), 120)
+        self.assertEqual(values[7], None)
+        self.assertEqual(values[51]['provider_user_id'], '1')
+        self.assertEqual(values[51]['access_token'], 'token51')
+
+
+class FacebookEdgeTests(TestCase):
+
+    def test_friends_are_paged_by_cursor(self):
+        api = mock.Mock()
+        api.get_connections.side_effect = [
+            {'data': [{'id': '1'}, {'id': '2'}],
+             'paging': {'cursors': {'after': 'abc'}, 'next': 'https://...'}},
+            {'data': [{'id': '3'}], 'paging': {'cursors': {'after': 'def'}}}]
+        pages = list(facebook.iter_edges(api, None, 'friends'))
+        self.assertEqual(pages, [(['1', '2'], 'abc'), (['3'], None)])
+        self.assertEqual(api.get_connections.call_args[1],
+                         dict(limit=facebook.EDGE_PAGE_SIZE, after='abc'))
+
+
+class ConnectionRecordTests(TestCase):
+
+    def test_record_is_immutable(self):
+        record = ConnectionRecord(id=1, provider_id='twitter')
+        self.assertEqual(record.provider_id, 'twitter')
+        self.assertEqual(record.secret, None)
+        self.assertRaises(AttributeError, setattr, record, 'secret', 'x')
+        self.assertRaises(AttributeError, setattr, record, 'other', 'x')
+
+    def test_record_can_be_pickled(self):
+        record = ConnectionRecord(id=1, provider_id='twitter',
+                                  access_token='token')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(pickle.loads(pickle.dumps(record, protocol)),
+                             record)
+
+
+class SettingsTests(TestCase):
+
+    def test_settings_are_frozen(self):
+        settings = Settings(default_config)
+        self.assertEqual(settings.blueprint_name, 'social')
+        self.assertEqual(settings.stateless_state, False)
+        self.assertRaises(AttributeError, setattr, settings,
+                          'blueprint_name', 'other')
+        self.assertRaises(AttributeError, setattr, settings, 'other', 1)
+        self.assertFalse(hasattr(settings, '__dict__'))
+
+
+class ProviderRegistryTests(TestCase):
+
+    def test_invalidate_rebuilds_providers(self):
+        keys = {'t1': 'key1', 't2': 'key2'}
+        registry = ProviderRegistry(
+            {}, {}, lambda tenant_id, provider_id: dict(
+                consumer_key=keys[tenant_id], consumer_secret='secret'))
+
+        provider = registry.get('t1', 'twitter')
+        self.assertEqual(provider.consumer_key, 'key1')
+        self.assertTrue(registry.get('t1', 'twitter') is provider)
+        self.assertEqual(registry.get('t2', 'facebook').consumer_key, 'key2')
+        self.assertEqual(registry.get(None, 'twitter'), None)
+
+        keys['t1'] = 'rotated'
+        registry.invalidate(tenant_id='t1')
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(registry.get('t1', 'twitter').consumer_key, 'rotated')
+
+    def test_refresh_polls_version_counter(self):
+        rows = []
+
+        def put(tenant_id, version):
+            rows.append(mock.Mock(
+                provider_id='twitter', tenant_id=tenant_id, enabled=True,
+                config=json.dumps(dict(consumer_key=str(version),
+                                       consumer_secret='secret')),
+                version=version))
+
+        datastore = mock.Mock()
+        datastore.get_provider_version.side_effect = lambda: len(rows)
+        datastore.find_providers.side_effect = lambda after_version: [
+            row for row in rows if row.version > after_version]
+        registry = ProviderRegistry({}, {}, datastore=datastore)
+
+        put('t1', 1)
+        registry.refresh()
+        put('t2', 2)
+        put('t3', 3)
+        registry.refresh()
+        for tenant_id, version in (('t1', 1), ('t2', 2), ('t3', 3)):
+            self.assertEqual(registry.get(tenant_id, 'twitter').consumer_key,
+                             str(version))
+        self.assertEqual(registry.version, 3)
+
+        # Providers are only read when the counter changed
+        registry.refresh()
+        self.assertEqual(datastore.find_providers.call_count, 2)
+        datastore.find_providers.assert_called_with(after_version=1)
+
+
+class BloomFilterTests(TestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        keys = [('twitter:%d' % i).encode('utf-8') for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+
+        false_positives = sum(1 for i in range(10000)
+                              if ('facebook:%d' % i).encode('utf-8') in bloom)
+        self.assertTrue(false_positives < 300)
+        self.assertTrue(0.005 < bloom.estimated_error_rate() < 0.02)
+
+
+class FakeConnection(object):
+
+    def __init__(self, id, provider_user_id):
+        self.id = id
+        self.provider_id = 'twitter'
+        self.provider_user_id = provider_user_id
+
+
+class FakeConnectionDatastore(object):
+
+    def __init__(self):
+        self.connections = []
+
+    def iter_connections(self, after=None, page_size=100):
+        page = sorted((c for c in self.connections
+                       if after is None or c.id > after),
+                      key=lambda c: c.id)
+        if page:
+            yield page
+
+
+class IdentityFilterTests(TestCase):
+
+    def setUp(self):
+        self.datastore = FakeConnectionDatastore()
+        self.identity_filter = IdentityFilter(self.datastore,
+                                              refresh_interval=60)
+        self.now = 100
+        patcher = mock.patch('flask_social.identity.time')
+        patcher.start().time.side_effect = lambda: self.now
+        self.addCleanup(patcher.stop)
+
+    def _commit(self, id):
+        self.datastore.connections.append(FakeConnection(id, str(id)))
+
+    def _might_contain(self, id):
+        return self.identity_filter.might_contain('twitter', str(id))
+
+    def _wait_for_build(self):
+        for x in range(100):
+            if not self.identity_filter._building:
+                break
+            time.sleep(0.01)
+
+    def test_negatives_do_not_read_datastore(self):
+        self._commit(1)
+        self.identity_filter.rebuild()
+        with mock.patch.object(self.datastore, 'iter_connections',
+                               wraps=self.datastore.iter_connections) as read:
+            self.assertTrue(self._might_contain(1))
+            self.assertFalse(self._might_contain(2))
+            self.assertFalse(read.called)
+        self.assertEqual(self.identity_filter.stats()['skipped'], 1)
+
+    def test_connections_made_elsewhere_are_found_after_rebuild(self):
+        self._commit(1)
+        self.identity_filter.rebuild()
+        self._commit(2)
+        self.assertFalse(self._might_contain(2))
+
+        # The filter is rebuilt in the background once the interval passed
+        self.now = 160
+        self.assertFalse(self._might_contain(2))
+        self._wait_for_build()
+        self.assertTrue(self._might_contain(2))
+
+        stats = self.identity_filter.stats()
+        self.assertEqual(stats['builds'], 2)
+        self.assertEqual(stats['items'], 2)
+
+    def test_stale_filter_falls_back(self):
+        self.identity_filter.rebuild()
+        with mock.patch.object(self.datastore, 'iter_connections',
+                               side_effect=ValueError('down')):
+            self.now = 160
+            self.assertFalse(self._might_contain(1))
+            self._wait_for_build()
+            self.now = 280
+            self.assertTrue(self._might_contain(1))
+            self._wait_for_build()
+
+        stats = self.identity_filter.stats()
+        self.assertEqual(stats['builds'], 1)
+        self.assertEqual(stats['fallbacks'], 1)
+        self.assertIn('down', stats['last_error'])
+
+
+class SharedIdentityIndexTests(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.index = SharedIdentityIndex(self.path, slots=64)
+
+    def tearDown(self):
+        self.index.close()
+        os.remove(self.path)
+
+    def test_entries_are_shared(self):
+        other = SharedIdentityIndex(self.path, slots=64)
+        self.index.set('twitter', '1234', 1, 2)
+        self.assertEqual(other.get('twitter', '1234'), (1, 2))
+        self.assertEqual(other.get('twitter', '5678'), None)
+
+        other.set('twitter', '1234', 3, 4)
+        self.assertEqual(self.index.get('twitter', '1234'), (3, 4))
+        other.close()
+
+        self.assertRaises(ValueError, SharedIdentityIndex, self.path, 128)
+
+    def test_delete_and_invalidate(self):
+        for i in range(20):
+            self.index.set('facebook', str(i), i, i * 10)
+        self.index.delete('facebook', '7')
+        self.assertEqual(self.index.get('facebook', '7'), None)
+        self.assertEqual(self.index.get('facebook', '8'), (8, 80))
+
+        self.index.invalidate()
+        self.assertEqual(self.index.get('facebook', '8'), None)
+        self.index.set('facebook', '8', 8, 80)
+        self.assertEqual(self.index.get('facebook', '8'), (8, 80))
+        self.assertEqual(self.index.stats()['generation'], 2)
+
+    def test_tokens_must_match(self):
+        self.index.set('twitter', '1234', 1, 2, ('token', 'secret'))
+        self.assertEqual(self.index.get('twitter', '1234'), (1, 2))
+        self.assertEqual(self.index.get('twitter', '1234',
+                                        ('token', 'secret')), (1, 2))
+        self.assertEqual(self.index.get('twitter', '1234',
+                                        ('token', 'other')), None)
+        self.index.set('twitter', '5678', 3, 4)
+        self.assertEqual(self.index.get('twitter', '5678',
+                                        ('token', 'secret')), None)
+
+    def test_forked_process_locks_its_own_file(self):
+        self.index.set('twitter', '1234', 1, 2)
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.index.set('twitter', '5678', 3, 4)
+                status = 0 if self.index._pid == os.getpid() else 1
+            finally:
+                os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(self.index.get('twitter', '5678'), (3, 4))
+
+    def test_full_table_replaces_entries(self):
+        for i in range(200):
+            self.index.set('vk', str(i), i, i)
+        self.assertEqual(self.index.get('vk', '199'), (199, 199))
+        self.assertFalse(self.index.set('vk', '1', 'not an id', 1))
+
+
+class TracerTests(TestCase):
+
+    def test_child_spans_share_the_trace(self):
+        exporter = InMemorySpanExporter()
+        tracer = Tracer(exporter)
+        with tracer.start_as_current_span('parent') as parent:
+            with tracer.start_as_current_span('child', {'a': 1}) as child:
+                self.assertTrue(tracer.get_current_span() is child)
+            self.assertTrue(tracer.get_current_span() is parent)
+        self.assertEqual(tracer.get_current_span(), None)
+
+        child, parent = exporter.get_finished_spans()
+        self.assertEqual(child.trace_id, parent.trace_id)
+        self.assertEqual(child.parent_id, parent.span_id)
+        self.assertEqual(child.attributes, {'a': 1})
+        self.assertTrue(parent.duration >= child.duration)
+
+    def test_exceptions_are_recorded(self):
+        tracer = Tracer()
+        try:
+            with tracer.start_as_current_span('failing'):
+                raise ValueError('boom')
+        except ValueError:
+            pass
+        span, = tracer.exporter.get_finished_spans()
+        self.assertEqual(span.status, 'ERROR')
+        self.assertEqual(span.events[0][0], 'exception')
+
+
+class ProviderHealthTests(TestCase):
+
+    def test_report_percentiles_and_error_rate(self):
+        health = ProviderHealth('twitter', window=10)
+        self.assertEqual(health.report()['status'], 'unknown')
+
+        for latency in range(1, 21):
+            health.record(latency / 100.0)
+        health.record(0.5, ValueError('boom'), token_exchange=True)
+        report = health.report()
+        self.assertEqual(report['samples'], 10)
+        self.assertEqual(report['latency'], dict(p50=0.16, p95=0.5, p99=0.5))
+        self.assertEqual(report['error_rate'], 0.1)
+        self.assertEqual(report['status'], 'ok')
+        self.assertEqual(report['last_error'], 'ValueError: boom')
+        self.assertEqual(report['last_token_exchange'], None)
+        self.assertEqual(health.report(error_threshold=0.1)['status'], 'down')
+
+    @mock.patch('flask_social.health.probe')
+    def test_monitor_caches_reports(self, mock_probe):
+        provider = mock.Mock(health=ProviderHealth('twitter'))
+        registry = mock.Mock(providers=dict(twitter=provider))
+        monitor = HealthMonitor(registry, cache_ttl=60)
+        self.assertEqual(monitor.report()['twitter']['status'], 'unknown')
+
+        mock_probe.side_effect = IOError('unreachable')
+        monitor.probe()
+        self.assertEqual(monitor.report()['twitter']['status'], 'unknown')
+        monitor._expires = 0
+        report = monitor.report()['twitter']
+        self.assertEqual(report['status'], 'down')
+        self.assertTrue(report['last_probe'] is not None)
+
+    @mock.patch('flask_social.health.probe')
+    def test_monitor_starts_on_first_request(self, mock_probe):
+        from flask import Flask
+        app = Flask(__name__)
+        monitor = HealthMonitor(mock.Mock(providers={}), interval=60)
+        monitor.init_app(app)
+        self.assertTrue(monitor._thread is None)
+        app.test_client().get('/')
+        self.assertTrue(monitor._thread is not None)
+        monitor.stop()
+        app.test_client().get('/')
+        self.assertTrue(monitor._thread is None)
+
+
+class ClientPoolTests(TestCase):
+
+    def setUp(self):
+        self.provider = mock.Mock(id='twitter', consumer_key='key',
+                                  consumer_secret='secret',
+                                  module='flask_social.providers.twitter')
+        self.connection = mock.Mock(access_token='token', secret='secret')
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    def test_clients_are_taken_once(self, mock_get_api):
+        pool = ClientPool()
+        pool.warm([(self.provider, self.connection)])
+        pool.join()
+        self.assertEqual(pool.take(self.provider, self.connection),
+                         mock_get_api.return_value)
+        self.assertEqual(pool.take(self.provider, self.connection), None)
+        self.assertEqual(pool.stats()['hits'], 1)
+        self.assertEqual(pool.stats()['misses'], 1)
+
+    @mock.patch('flask_social.providers.twitter.get_api')
+    def test_expired_clients_are_dropped(self, mock_get_api):
+        pool = ClientPool(ttl=-1)
+        pool.build(self.provider, self.connection)
+        self.assertEqual(pool.take(self.provider, self.connection), None)
+
+    def test_full_queue_skips_logins(self):
+        pool = ClientPool(queue_size=1)
+        pool._start = lambda: None
+        self.assertTrue(pool.warm([(self.provider, self.connection)]))
+        self.assertFalse(pool.warm([(self.provider, self.connection)]))
+        self.assertEqual(pool.stats()['skipped'], 1)
+
+
+class ResponseCacheTests(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def _respond(self, body, **headers):
+        response = mock.Mock()
+        response.read.return_value = body
+        response.info.return_value = headers
+        return response
+
+    @mock.patch('flask_social.httpcache.urlopen')
+    def test_not_modified_returns_cached_document(self, mock_urlopen):
+        url = 'https://graph.facebook.com/me'
+        cache = ResponseCache(path=self.path)
+        mock_urlopen.return_value = self._respond('{"id": "1"}', ETag='"v1"')
+        self.assertEqual(cache.get_json(url, 'token'), {'id': '1'})
+
+        mock_urlopen.side_effect = HTTPError(url, 304, 'Not Modified', {},
+                                             None)
+        self.assertEqual(cache.get_json(url, 'token'), {'id': '1'})
+        request = mock_urlopen.call_args[0][0]
+        self.assertEqual(request.get_header('If-none-match'), '"v1"')
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        # Tokens are cached apart, and revalidated from disk after a restart
+        self.assertNotEqual(cache.get(cache.key(url + '?', 'token')), None)
+        self.assertEqual(cache.get(cache.key(url + '?', 'other')), None)
+        cache = ResponseCache(path=self.path)
+        self.assertEqual(cache.get_json(url, 'token'), {'id': '1'})
+
+    @mock.patch('flask_social.httpcache.urlopen')
+    def test_responses_without_validators_are_not_cached(self, mock_urlopen):
+        cache = ResponseCache(max_size=1)
+        mock_urlopen.return_value = self._respond('{"id": "1"}')
+        cache.get_json('https://graph.facebook.com/me', 'token')
+        self.assertEqual(cache.stats()['stored'], 0)
+        self.assertEqual(mock_urlopen.call_args[0][0].headers, {})
+
+    @mock.patch('flask_social.httpcache.urlopen')
+    def test_facebook_profile_lookups_share_the_cache(self, mock_urlopen):
+        cache = ResponseCache()
+        mock_urlopen.return_value = self._respond('{"id": "1"}', ETag='"v1"')
+        response = dict(access_token='token')
+        self.assertEqual(facebook.get_provider_user_id(
+            response, profile_cache=cache), '1')
+        values = facebook.get_connection_values(response, profile_cache=cache)
+        self.assertEqual(values['provider_user_id'], '1')
+        self.assertEqual(mock_urlopen.call_args[0][0].get_header(
+            'If-none-match'), '"v1"')
+
+    def test_disk_tier_is_bounded_by_size_and_age(self):
+        item = CachedResponse('{"id": "1"}', etag='"v1"')
+        cache = ResponseCache(max_size=1, path=self.path,
+                              max_disk_size=2 * len(item.dumps()))
+        for key in ('a', 'b', 'c'):
+            cache.set(key, item)
+            os.utime(cache._filename(key), (time.time() - 10,) * 2)
+        cache.touch('b')
+        cache.set('d', item)
+        names = sorted(n for n in os.listdir(self.path) if n.endswith('.json'))
+        self.assertEqual(names, ['b.json', 'd.json'])
+        self.assertEqual(cache.stats()['evicted'], 2)
+
+        # Expired responses are neither read nor kept
+        os.utime(cache._filename('b'), (time.time() - 10,) * 2)
+        cache = ResponseCache(max_size=1, path=self.path, max_age=5)
+        self.assertEqual(cache.get('b'), None)
+        self.assertNotEqual(cache.get('d'), None)
+        self.assertFalse(os.path.exists(cache._filename('b')))
+
+    def test_directory_is_scanned_after_enough_writes(self):
+        item = CachedResponse('{"id": "1"}', etag='"v1"')
+        cache = ResponseCache(path=self.path,
+                              max_disk_size=30 * len(item.dumps()))
+        with mock.patch.object(cache, '_evict') as evict:
+            for x in range(6):
+                cache.set(str(x), item)
+            self.assertEqual(evict.call_count, 2)
+
+            cache._next_evict = 0
+            cache.set('a', item)
+            self.assertEqual(evict.call_count, 3)
+
+
+class AvatarCacheTests(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_concurrent_fills_are_coalesced(self):
+        cache = AvatarCache(self.path)
+        release = threading.Event()
+        calls = []
+
+        def download(url):
+            calls.append(url)
+            release.wait(5)
+            return b'PNG', 'image/png'
+        cache._download = download
+
+        first = cache.fill('http://example.com/a.png')
+        second = cache.fill('http://example.com/a.png')
+        self.assertTrue(first is second)
+        release.set()
+        first.wait(5)
+        self.assertEqual(calls, ['http://example.com/a.png'])
+        self.assertEqual(cache.get('http://example.com/a.png').mimetype,
+                         'image/png')
+
+    def test_least_recently_served_images_are_evicted(self):
+        cache = AvatarCache(self.path, max_size=6)
+        cache.put('a', b'aaa', 'image/png')
+        cache.put('b', b'bbb', 'image/png')
+        cache.get('a')
+        cache.put('c', b'ccc', 'image/png')
+        self.assertEqual(cache.get('b'), None)
+        self.assertNotEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['size'], 6)
+
+        # The index is rebuilt from disk
+        self.assertEqual(AvatarCache(self.path, max_size=6).stats()['images'],
+                         2)
+
+    def test_size_is_shared_by_caches_using_the_directory(self):
+        first = AvatarCache(self.path, max_size=6)
+        second = AvatarCache(self.path, max_size=6)
+        first.put('a', b'aaa', 'image/png')
+        second.put('b', b'bbb', 'image/png')
+        self.assertNotEqual(first.get('b'), None)
+        first.put('c', b'ccc', 'image/png')
+        self.assertEqual(second.get('a'), None)
+        self.assertEqual(first.stats()['images'], 2)
+
+    def test_only_public_http_urls_are_fetched(self):
+        self.assertRaises(ValueError, urlopen, 'file:///etc/passwd', 1)
+        self.assertRaises(ValueError, urlopen, 'ftp://example.com/a.png', 1)
+        for address in ('127.0.0.1', '10.1.2.3', '169.254.169.254',
+                        '192.168.0.1', '::1', 'fe80::1', 'fd00::1',
+                        '::ffff:127.0.0.1'):
+            self.assertFalse(_is_public(address), address)
+        for address in ('8.8.8.8', '2001:4860:4860::8888'):
+            self.assertTrue(_is_public(address), address)